@@ -8,48 +8,168 @@ __version__ = "1.0.0"
 
 
 from contextlib import contextmanager
-from cayenne.client import CayenneMQTTClient
-import cayenne_credentials
 import config
-import logging
+import homegrid_logger
+import metrics
+from mqtt_connector import Mqtt_connector
+import numpy as np
 import persistent_data_utils
 import threading
-from typing import List, Optional
+import time
+from typing import Any, Dict, List, Optional
 from smartswitch import (
     SmartSwitch,
     SmartSwitchSerializable,
     smart_switch_serializable_to_switch,
 )
+from switch_history import Switch_history
 
 
 class Active_switch_list:
+    """
+    Registry of the switches known to the hub.
+
+    Lookups by MAC and GUID go through dict indexes and never take a lock, so
+    they can run while another thread adds, removes or re-keys a switch.
+    Writers serialize on registry_lock and publish a new active_switches list
+    on every change, so readers iterating the old list are never disturbed.
+    Listeners that cache switches by MAC, like the Zigbee_process_pool, are
+    told of every removal and MAC change under the same lock.
+    """
+
     def __init__(self):
-        self.logger = logging.getLogger(__name__)
-        logging.basicConfig(format=config.LOGGING_FORMAT)
-        self.logger.setLevel(config.LOG_LEVEL)
+        self.logger = homegrid_logger.Logger(__name__)
+        self.active_switches = []
+        self.switches_by_MAC = {}
+        self.switches_by_GUID = {}
+        self.registry_lock = threading.Lock()
+        # Objects with forget(MAC) and rekey(old_MAC, new_MAC).
+        self.listeners: List[Any] = []
+        self.last_saved_snapshots = {}
+        self.state_journal = persistent_data_utils.State_journal(self.logger)
+        # Set by load_persistent_data with the "mmap" backend.
+        self.state_file: Optional[persistent_data_utils.Mapped_state_file] = None
 
-    active_switches: List[SmartSwitch] = []
-    logger = logging.getLogger(__name__)
+    active_switches: List[SmartSwitch]
+    switches_by_MAC: Dict[str, SmartSwitch]
+    switches_by_GUID: Dict[str, SmartSwitch]
+    last_saved_snapshots: Dict[str, SmartSwitchSerializable]
     ready = False
 
     def get_switch_from_GUID(self, GUID: str) -> Optional[SmartSwitch]:
-        for switch in self.active_switches:
-            if GUID == switch.GUID:
-                return switch
-        return None
+        return self.switches_by_GUID.get(GUID)
 
     def get_switch_from_MAC(self, MAC: str) -> Optional[SmartSwitch]:
-        for switch in self.active_switches:
-            if MAC == switch.MAC:
-                return switch
-        return None
+        return self.switches_by_MAC.get(MAC)
+
+    def query_history(
+        self,
+        MAC: str,
+        start_time: float,
+        end_time: float,
+        resolution_seconds: Optional[int] = None,
+    ) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Returns the readings of one switch between start_time and end_time.
+
+        resolution_seconds of None returns raw readings, otherwise one of the
+        HISTORY_ROLLUPS resolutions. The arrays are copies, so they stay valid
+        after the lock is released. None if the MAC is unknown.
+        """
+        switch = self.get_switch_from_MAC(MAC)
+        if switch is None:
+            return None
+        with switch.lock:
+            history = switch.history
+            if history is None:
+                # Never reported; answer from an empty history without
+                # keeping it allocated.
+                history = Switch_history()
+            return history.query(start_time, end_time, resolution_seconds)
+
+    def add_listener(self, listener):
+        with self.registry_lock:
+            self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener):
+        with self.registry_lock:
+            self.listeners = [l for l in self.listeners if l is not listener]
+
+    def add_switches(self, switches: List[SmartSwitch]):
+        with self.registry_lock:
+            for switch in switches:
+                if switch.MAC in self.switches_by_MAC:
+                    raise ValueError(f"Duplicate Switch MAC: {switch.MAC}")
+                if switch.GUID in self.switches_by_GUID:
+                    raise ValueError(f"Duplicate Switch GUID: {switch.GUID}")
+            if self.state_file is not None:
+                for switch in switches:
+                    if switch.state_record is None:
+                        self.state_file.attach(switch)
+            for switch in switches:
+                self.switches_by_MAC[switch.MAC] = switch
+                self.switches_by_GUID[switch.GUID] = switch
+            self.active_switches = self.active_switches + list(switches)
+
+    def add_switch(self, switch: SmartSwitch):
+        self.add_switches([switch])
+
+    def remove_switch(self, switch: SmartSwitch):
+        with self.registry_lock:
+            if self.switches_by_MAC.get(switch.MAC) is not switch:
+                raise ValueError(f"Switch not Registered: {switch.MAC}")
+            del self.switches_by_MAC[switch.MAC]
+            del self.switches_by_GUID[switch.GUID]
+            self.active_switches = [s for s in self.active_switches if s is not switch]
+            if self.state_file is not None:
+                self.state_file.release(switch)
+            for listener in self.listeners:
+                listener.forget(switch.MAC)
+
+    def rekey_switch(
+        self, switch: SmartSwitch, MAC: Optional[str] = None, GUID: Optional[str] = None
+    ):
+        new_MAC = switch.MAC if MAC is None else MAC
+        new_GUID = switch.GUID if GUID is None else GUID
+        with self.registry_lock:
+            if self.switches_by_MAC.get(switch.MAC) is not switch:
+                raise ValueError(f"Switch not Registered: {switch.MAC}")
+            if self.switches_by_MAC.get(new_MAC, switch) is not switch:
+                raise ValueError(f"Duplicate Switch MAC: {new_MAC}")
+            if self.switches_by_GUID.get(new_GUID, switch) is not switch:
+                raise ValueError(f"Duplicate Switch GUID: {new_GUID}")
+            # Index the new keys before dropping the old ones so a concurrent
+            # lookup finds the switch under at least one of them.
+            self.switches_by_MAC[new_MAC] = switch
+            self.switches_by_GUID[new_GUID] = switch
+            with switch.acquire_lock():
+                old_MAC, old_GUID = switch.MAC, switch.GUID
+                switch.MAC = new_MAC
+                switch.GUID = new_GUID
+                switch.update_snapshot()
+            if old_MAC != new_MAC:
+                del self.switches_by_MAC[old_MAC]
+                for listener in self.listeners:
+                    listener.rekey(old_MAC, new_MAC)
+            if old_GUID != new_GUID:
+                del self.switches_by_GUID[old_GUID]
 
     def load_persistent_data(self):
+        if "mmap" == config.PERSISTENT_DATA_BACKEND:
+            self.state_file = persistent_data_utils.Mapped_state_file(self.logger)
+            self.add_switches(self.state_file.load())
+            return
         serializable_switch_list: List[
             SmartSwitchSerializable
-        ] = persistent_data_utils.load(self.logger)
-        for switch in serializable_switch_list:
-            self.active_switches.append(smart_switch_serializable_to_switch(switch))
+        ] = self.state_journal.load()
+        switches = [
+            smart_switch_serializable_to_switch(switch)
+            for switch in serializable_switch_list
+        ]
+        self.add_switches(switches)
+        self.last_saved_snapshots = {
+            switch.snapshot.MAC: switch.snapshot for switch in switches
+        }
 
     @contextmanager
     def acquire_lock(self):
@@ -60,48 +180,73 @@ class Active_switch_list:
             switch.lock.release()
 
     def save_persistent_data(self):
-        serializable_switch_list: List[SmartSwitchSerializable] = []
-        with self.acquire_lock():
-            for switch in self.active_switches:
-                serializable_switch_list.append(SmartSwitchSerializable(switch))
+        start_time = time.perf_counter()
+        if self.state_file is not None:
+            # Every change is already in the mapped file; only msync it.
             try:
-                persistent_data_utils.dump(serializable_switch_list, self.logger)
+                self.state_file.flush()
             except Exception as e:
-                self.logger.error(f"{e}")
-
-    def initialize_clients(self, callback):
+                self.logger.error("%s", e)
+            metrics.PERSISTENCE_SAVE_SECONDS.observe(time.perf_counter() - start_time)
+            return
+        # Each switch publishes an immutable snapshot whenever its state
+        # changes, so a consistent view is collected without taking any
+        # switch lock and message handling keeps running during the write.
+        snapshots: Dict[str, SmartSwitchSerializable] = {}
         for switch in self.active_switches:
-            switch.client = CayenneMQTTClient()
-            switch.client.on_message = callback
-            self.logger.debug("Connecting Device:")
-            self.logger.debug(f"Username: {str(cayenne_credentials.MQTT_USERNAME)}")
-            self.logger.debug(f"Password: {str(cayenne_credentials.MQTT_PASSWORD)}")
-            self.logger.debug(f"GUID: {switch.GUID}")
-            self.logger.debug(f"Port: {int(cayenne_credentials.MQTT_PORT)}")
-            switch.client.begin(
-                str(cayenne_credentials.MQTT_USERNAME),
-                str(cayenne_credentials.MQTT_PASSWORD),
-                switch.GUID,
-                port=int(cayenne_credentials.MQTT_PORT),
-            )
-            self.logger.debug(f"Finished Connecting")
-            self.ready = True
+            snapshot = switch.snapshot
+            snapshots[snapshot.MAC] = snapshot
+        changed = [
+            snapshot
+            for MAC, snapshot in snapshots.items()
+            if self.last_saved_snapshots.get(MAC) is not snapshot
+        ]
+        removed_MACs = [
+            MAC for MAC in self.last_saved_snapshots if MAC not in snapshots
+        ]
+        if not changed and not removed_MACs:
+            self.logger.debug("No Switch State Changed since Last Save")
+            return
+        try:
+            if "journal" == config.PERSISTENT_DATA_BACKEND:
+                self.state_journal.append(changed, removed_MACs)
+                if self.state_journal.needs_compaction():
+                    self.state_journal.compact(list(snapshots.values()))
+            else:
+                persistent_data_utils.dump(list(snapshots.values()), self.logger)
+            self.last_saved_snapshots = snapshots
+        except Exception as e:
+            self.logger.error("%s", e)
+        save_seconds = time.perf_counter() - start_time
+        metrics.PERSISTENCE_SAVE_SECONDS.observe(save_seconds)
+        self.logger.debug(
+            "Saved %d Changed and %d Removed Switches in %.1f ms",
+            len(changed),
+            len(removed_MACs),
+            save_seconds * 1000.0,
+        )
 
-    def loop(self):
-        self.logger.debug("Attempting to start loop")
-        for switch in self.active_switches:
-            with switch.acquire_lock():
-                try:
-                    switch.client.loop()
-                except Exception as e:
-                    self.logger.error(f"Error: {e}")
-                
+    def close_persistent_data(self):
+        self.state_journal.close()
+        if self.state_file is not None:
+            self.state_file.close()
+
+    def initialize_clients(self, callback, on_open=None, on_connected=None) -> Mqtt_connector:
+        """
+        Starts opening every switch's MQTT connection in the background and
+        returns the Mqtt_connector doing it; see Mqtt_connector for the
+        callbacks.
+        """
+        connector = Mqtt_connector(callback, on_open, on_connected)
+        connector.start(self.active_switches)
+        self.ready = True
+        return connector
 
-    def __test_populate(self):
+    def _test_populate(self):
         for i in range(10):
             print(f"{i}")
             switch = SmartSwitch(f"MAC: {i}", f"GUID: {i}")
-            self.active_switches.append(switch)
+            self.add_switch(switch)
             print(
                 f"MAC: {switch.MAC}, GUID: {switch.GUID},\n client: {switch.client}, last_time_seen {switch.last_time_seen}"
             )
@@ -109,15 +254,14 @@ class Active_switch_list:
 
 if __name__ == "__main__":
     sl = Active_switch_list()
-    sl.__test_populate()
+    sl._test_populate()
 
     for i in range(10):
-        switch = sl.get_switch_from_GUID(sl.active_switches[i].GUID)
-        switch.GUID = f"GUID: {i + 10}"
-        switch.MAC = f"MAC: {i + 10}"
+        switch = sl.get_switch_from_GUID(f"GUID: {i}")
+        sl.rekey_switch(switch, MAC=f"MAC: {i + 10}", GUID=f"GUID: {i + 10}")
     print("After:")
     for i in range(10):
-        switch = sl.get_switch_from_GUID(sl.active_switches[i].GUID)
+        switch = sl.get_switch_from_MAC(f"MAC: {i + 10}")
         print(
             f"MAC: {switch.MAC}, GUID: {switch.GUID},\n client: {switch.client}, last_time_seen {switch.last_time_seen}"
         )
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Multiple Coordinator Benchmark
+
+Starts a real hub with one pty per simulated coordinator and the fleet split
+evenly between them. Each coordinator carries at most --link-readings-per-
+second readings, standing in for one radio's airtime; readings over that
+budget are lost on the air. For each coordinator count it reports:
+
+- offered, written and published readings per second, the aggregate the hub
+  gets through all of its coordinators;
+- where a storm of toggle commands came out: on the coordinator of the plug
+  (routed), or on another one as well;
+- with two or more coordinators, failover: coordinator 0 goes silent, its
+  plugs rejoin coordinator 1 after --rejoin-seconds, and toggles sent to them
+  meanwhile have to be retried through a coordinator that can reach them.
+
+    python3 benchmarks/bench_coordinators.py --plugs 600 --coordinators 1 2 4
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import config
+import fleet_simulator
+import heapq
+from local_mqtt_broker import Local_mqtt_broker
+import logging
+import selectors
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import tty
+from typing import Dict, List
+
+SILENT_SECONDS = 2
+
+
+class Coordinator_fleet:
+    """The plugs of a Fleet_simulator spread over several simulated radios."""
+
+    def __init__(self, arguments: argparse.Namespace, coordinators: int):
+        self.arguments = arguments
+        self.simulator = fleet_simulator.Fleet_simulator(
+            fleet_simulator.parse_arguments(
+                [
+                    "--plugs", str(arguments.plugs),
+                    "--report-interval", str(arguments.report_interval),
+                    "--malformed-rate", "0",
+                    "--runtime", arguments.runtime,
+                ]
+            )
+        )
+        self.plugs = self.simulator.plugs
+        self.indexes = {plug.MAC: index for index, plug in enumerate(self.plugs)}
+        # Plug index -> the coordinator it has joined.
+        self.home = [index % coordinators for index in range(len(self.plugs))]
+        self.silenced = [False] * coordinators
+        self.airtime_drops = 0
+        self.commands_routed = 0
+        self.commands_elsewhere = 0
+
+    def writer_thread(self, coordinator: int, master_fd: int):
+        simulator = self.simulator
+        interval = self.arguments.report_interval
+        rate = self.arguments.link_readings_per_second
+        start = last = time.monotonic()
+        schedule = [
+            (start + interval * index / len(self.plugs), index)
+            for index in range(len(self.plugs))
+        ]
+        heapq.heapify(schedule)
+        tokens = 0.0
+        needs_newline = False
+        while not simulator.stopped:
+            now = time.monotonic()
+            # A sleep that overruns the tick still earns its airtime.
+            tokens = min(tokens + rate * (now - last), 0.05 * rate + 1.0)
+            last = now
+            chunk = bytearray(b"\n" if (needs_newline) else b"")
+            frames = []
+            while schedule and schedule[0][0] <= now:
+                due, index = heapq.heappop(schedule)
+                heapq.heappush(schedule, (due + interval, index))
+                if self.home[index] != coordinator or self.silenced[coordinator]:
+                    continue
+                if tokens < 1.0:
+                    self.airtime_drops += 1
+                    continue
+                tokens -= 1.0
+                plug = self.plugs[index]
+                chunk += simulator.frame(plug)
+                frames.append((plug, plug.sequence, len(chunk)))
+            if len(chunk) > (1 if (needs_newline) else 0):
+                needs_newline = simulator.write_frames(master_fd, chunk, frames, 0)
+            time.sleep(fleet_simulator.TICK_SECONDS)
+
+    def command_reader_thread(self, coordinator: int, master_fd: int):
+        simulator = self.simulator
+        selector = selectors.DefaultSelector()
+        selector.register(master_fd, selectors.EVENT_READ)
+        buffer = bytearray()
+        while not simulator.stopped:
+            if not selector.select(timeout=0.2):
+                continue
+            try:
+                buffer += os.read(master_fd, 65536)
+            except (BlockingIOError, OSError):
+                continue
+            last_end = 0
+            for match in fleet_simulator.COMMAND_PATTERN.finditer(buffer):
+                last_end = match.end()
+                index = self.indexes.get(match.group(1).decode())
+                if index is None:
+                    continue
+                plug = self.plugs[index]
+                with simulator.lock:
+                    if self.silenced[coordinator]:
+                        continue
+                    if self.home[index] != coordinator:
+                        # A copy for a plug this radio cannot reach.
+                        self.commands_elsewhere += 1
+                        continue
+                    self.commands_routed += 1
+                plug.power_state = b"on" == match.group(2)
+            del buffer[:last_end]
+
+    def toggle(self, broker: Local_mqtt_broker, indexes: List[int]):
+        channel = config.VIRTUAL_CHANNEL.POWER_TOGGLE.value
+        for message_id, index in enumerate(indexes, 1):
+            plug = self.plugs[index]
+            value = 0 if (plug.power_state) else 1
+            with self.simulator.lock:
+                self.simulator.commands_sent += 1
+                plug.awaiting_confirmation = (1 == value, time.monotonic())
+            broker.publish(
+                f"v1/{fleet_simulator.USERNAME}/things/{plug.GUID}/cmd/{channel}",
+                f"{message_id},{value}".encode(),
+            )
+
+    def wait_for_confirmations(self, indexes: List[int], timeout: float) -> int:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.simulator.lock:
+                waiting = sum(
+                    1 for index in indexes if self.plugs[index].awaiting_confirmation is not None
+                )
+            if 0 == waiting:
+                break
+            time.sleep(0.1)
+        return len(indexes) - waiting
+
+
+def measure(arguments: argparse.Namespace, coordinators: int) -> Dict[str, float]:
+    fleet = Coordinator_fleet(arguments, coordinators)
+    simulator = fleet.simulator
+    results: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory(prefix="homegrid-coordinators-") as directory:
+        ptys = []
+        for _ in range(coordinators):
+            master_fd, slave_fd = os.openpty()
+            tty.setraw(slave_fd)
+            os.set_blocking(master_fd, False)
+            ptys.append((master_fd, slave_fd))
+        ports = [os.ttyname(slave_fd) for _, slave_fd in ptys]
+        broker = Local_mqtt_broker(on_publish=simulator.on_publish).start()
+        hub = simulator.start_hub(
+            directory,
+            ports[0],
+            broker,
+            config_overrides={
+                "SERIAL_PORTS": ports,
+                "COORDINATOR_SILENT_SECONDS": SILENT_SECONDS,
+            },
+        )
+        threads = []
+        try:
+            simulator.wait_for_connections(broker, hub)
+            for coordinator, (master_fd, _) in enumerate(ptys):
+                threads.append(
+                    threading.Thread(target=fleet.writer_thread, args=(coordinator, master_fd))
+                )
+                threads.append(
+                    threading.Thread(
+                        target=fleet.command_reader_thread, args=(coordinator, master_fd)
+                    )
+                )
+            for thread in threads:
+                thread.start()
+            # Every plug is heard once, so the hub has learned its route.
+            time.sleep(2.0 * arguments.report_interval)
+            written, delivered = simulator.frames_written, simulator.delivered
+            airtime_drops = fleet.airtime_drops
+            time.sleep(arguments.duration)
+            results["written/s"] = (simulator.frames_written - written) / arguments.duration
+            results["published/s"] = (simulator.delivered - delivered) / arguments.duration
+            results["airtime drops/s"] = (fleet.airtime_drops - airtime_drops) / arguments.duration
+
+            storm = simulator.random.sample(range(len(fleet.plugs)), arguments.storm_size)
+            fleet.toggle(broker, storm)
+            results["storm confirmed"] = fleet.wait_for_confirmations(storm, 15.0)
+            results["routed"] = fleet.commands_routed
+            results["elsewhere"] = fleet.commands_elsewhere
+
+            if coordinators > 1:
+                moved = [index for index in range(len(fleet.plugs)) if 0 == fleet.home[index]]
+                fleet.silenced[0] = True
+                time.sleep(0.5)
+                failover = moved[: arguments.storm_size]
+                start = time.monotonic()
+                fleet.toggle(broker, failover)
+                time.sleep(arguments.rejoin_seconds)
+                for index in moved:
+                    fleet.home[index] = 1
+                results["failover confirmed"] = fleet.wait_for_confirmations(failover, 30.0)
+                results["failover s"] = time.monotonic() - start
+        finally:
+            simulator.stopped = True
+            for thread in threads:
+                thread.join()
+            hub.send_signal(signal.SIGINT)
+            try:
+                hub.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                hub.kill()
+                hub.wait()
+            broker.stop()
+            for master_fd, slave_fd in ptys:
+                os.close(master_fd)
+                os.close(slave_fd)
+            simulator.hub_log.close()
+    return results
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--plugs", type=int, default=600)
+    parser.add_argument("--report-interval", type=float, default=1.0)
+    parser.add_argument("--coordinators", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument(
+        "--link-readings-per-second", type=float, default=150.0,
+        help="readings one coordinator's radio can carry",
+    )
+    parser.add_argument("--duration", type=int, default=10, help="seconds of load measured")
+    parser.add_argument("--storm-size", type=int, default=40)
+    parser.add_argument("--rejoin-seconds", type=float, default=3.0)
+    parser.add_argument("--runtime", choices=["threads", "asyncio"], default=config.HUB_RUNTIME)
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    config.LOG_LEVEL = logging.WARNING
+    results = {count: measure(arguments, count) for count in arguments.coordinators}
+    print(
+        f"{arguments.plugs} plugs every {arguments.report_interval:g} s "
+        f"({arguments.plugs / arguments.report_interval:.0f} readings/s offered), "
+        f"{arguments.link_readings_per_second:.0f} readings/s per coordinator, "
+        f"{arguments.runtime} runtime"
+    )
+    names = []
+    for result in results.values():
+        names += [name for name in result if name not in names]
+    print(f"{'coordinators':>12} " + " ".join(f"{name:>18}" for name in names))
+    for count, result in results.items():
+        print(
+            f"{count:>12} "
+            + " ".join(
+                f"{result[name]:>18.1f}" if name in result else f"{'-':>18}" for name in names
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Energy Accounting Benchmark
+
+Accuracy of the old fixed-interval formula against timestamp integration
+when radio frames are dropped, and the time to re-integrate a month of
+readings for a fleet with integrate_fleet against a per-reading loop.
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config
+import energy_accounting
+import numpy as np
+import time
+
+SWITCHES = 10
+REPORT_INTERVAL_SECONDS = 1.0
+DAYS = 30
+DROP_RATE = 0.05
+LOOP_SAMPLE = 1_000_000
+
+
+def old_watts_to_kwh(watts: float) -> float:
+    return watts * (1.0 / 60.0) * config.NODE_POWER_AVERAGING_INTERVAL_SECONDS / 1000.0
+
+
+def accuracy():
+    rng = np.random.default_rng(1)
+    seconds = 24 * 3600
+    watts = 60.0 + 40.0 * np.sin(np.arange(seconds) / 3600.0) ** 2
+    truth = watts.sum() / 3_600_000.0
+    # A reading reports the mean draw since the previous delivered reading.
+    delivered = np.flatnonzero(rng.random(seconds) >= DROP_RATE)
+    cumulative = np.r_[0.0, np.cumsum(watts)]
+    previous = np.r_[-1, delivered[:-1]]
+    reported = (cumulative[delivered + 1] - cumulative[previous + 1]) / (delivered - previous)
+
+    old = sum(old_watts_to_kwh(w) for w in reported.tolist())
+    new = energy_accounting.integrate_readings(delivered + 1.0, reported, 0.0)
+    print(f"one day at 1 Hz, {DROP_RATE:.0%} of frames dropped")
+    print(f"{'true energy':>22}: {truth:.4f} kWh")
+    print(f"{'fixed 1/60 interval':>22}: {old:.4f} kWh ({(old - truth) / truth:+.1%})")
+    print(f"{'timestamp integration':>22}: {new:.4f} kWh ({(new - truth) / truth:+.2%})")
+
+
+def reintegration():
+    readings_per_switch = int(DAYS * 86400 / REPORT_INTERVAL_SECONDS)
+    rows = SWITCHES * readings_per_switch
+    rng = np.random.default_rng(2)
+    switch = np.repeat(np.arange(SWITCHES, dtype=np.int32), readings_per_switch)
+    timestamps = np.tile(
+        np.arange(readings_per_switch, dtype=np.float64) * REPORT_INTERVAL_SECONDS,
+        SWITCHES,
+    )
+    power_draw = rng.uniform(0.0, 1500.0, rows).astype(np.float32)
+
+    start = time.perf_counter()
+    energy = energy_accounting.integrate_fleet(switch, timestamps, power_draw)
+    vectorized = time.perf_counter() - start
+    assert len(energy) == SWITCHES
+
+    order = rng.permutation(rows)
+    shuffled = (switch[order], timestamps[order], power_draw[order])
+    start = time.perf_counter()
+    shuffled_energy = energy_accounting.integrate_fleet(*shuffled)
+    unordered = time.perf_counter() - start
+    del shuffled, order
+    assert all(
+        abs(shuffled_energy[key][0] - energy[key][0]) < 1e-6 * energy[key][0]
+        for key in energy
+    )
+
+    sample_timestamps = timestamps[:LOOP_SAMPLE].tolist()
+    sample_power = power_draw[:LOOP_SAMPLE].tolist()
+    start = time.perf_counter()
+    previous = None
+    total = 0.0
+    for timestamp, watts in zip(sample_timestamps, sample_power):
+        interval = energy_accounting.reading_interval_seconds(previous, timestamp)
+        previous = timestamp
+        total += energy_accounting.watts_to_kwh(watts, interval)
+    per_reading = (time.perf_counter() - start) / LOOP_SAMPLE
+
+    print(f"\n{SWITCHES} switches x {DAYS} days at {REPORT_INTERVAL_SECONDS:g} s = {rows / 1e6:.0f}M readings")
+    print(f"{'per-reading loop':>22}: {per_reading * rows:7.1f} s (extrapolated from {LOOP_SAMPLE / 1e6:.0f}M)")
+    print(f"{'integrate_fleet':>22}: {vectorized:7.1f} s (grouped by switch)")
+    print(f"{'integrate_fleet':>22}: {unordered:7.1f} s (shuffled)")
+
+
+if __name__ == "__main__":
+    accuracy()
+    reintegration()
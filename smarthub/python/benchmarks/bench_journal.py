@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+State Journal Benchmark
+
+Compares bytes written and time per backup for the "pickle" and "journal"
+persistence backends when only a few switches change between backups, and
+the startup replay time of the journal.
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from active_switch_list import Active_switch_list
+import config
+import contextlib
+import logging
+import persistent_data_utils
+import random
+from smartswitch import SmartSwitch
+import tempfile
+import time
+from xbee_message_parser import Xbee_coordinator_message
+
+FLEET_SIZE = 10_000
+CHANGED_PER_BACKUP = 50
+BACKUPS = 200
+
+
+class Stub_client:
+    def virtualWrite(self, channel, value, dataType="", dataUnit=""):
+        pass
+
+
+def written_bytes(directory: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(directory, filename))
+        for filename in os.listdir(directory)
+    )
+
+
+def run_backend(backend: str) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        config.PERSISTENT_DATA_FILENAME = os.path.join(directory, "bench.bin")
+        config.PERSISTENT_DATA_BACKEND = backend
+        switch_list = Active_switch_list()
+        switch_list.add_switches(
+            [SmartSwitch(f"{i:016x}", f"GUID-{i:08d}") for i in range(FLEET_SIZE)]
+        )
+        for switch in switch_list.active_switches:
+            switch.client = Stub_client()
+        persistent_data_utils.dump(
+            [switch.snapshot for switch in switch_list.active_switches], None
+        )
+        switch_list.last_saved_snapshots = {
+            switch.MAC: switch.snapshot for switch in switch_list.active_switches
+        }
+
+        message = Xbee_coordinator_message("", True, 15.169, 122.5637)
+        total_bytes = 0
+        total_time = 0.0
+        for _ in range(BACKUPS):
+            for switch in random.sample(switch_list.active_switches, CHANGED_PER_BACKUP):
+                switch.handle_serial_message(message)
+            before = written_bytes(directory)
+            start = time.perf_counter()
+            switch_list.save_persistent_data()
+            total_time += time.perf_counter() - start
+            # The pickle backend rewrites the file, so count its full size.
+            after = written_bytes(directory)
+            total_bytes += after if "pickle" == backend else after - before
+        switch_list.state_journal.close()
+
+        start = time.perf_counter()
+        loaded = Active_switch_list()
+        loaded.load_persistent_data()
+        load_time = time.perf_counter() - start
+        assert len(loaded.active_switches) == FLEET_SIZE
+
+        return {
+            "bytes_per_backup": total_bytes / BACKUPS,
+            "ms_per_backup": 1000.0 * total_time / BACKUPS,
+            "load_ms": 1000.0 * load_time,
+        }
+
+
+def main():
+    config.LOG_LEVEL = logging.WARNING
+    results = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for backend in ("pickle", "journal"):
+            results[backend] = run_backend(backend)
+
+    print(
+        f"{FLEET_SIZE} switches, {CHANGED_PER_BACKUP} changed per backup, "
+        f"{BACKUPS} backups"
+    )
+    print(f"{'':>8} {'bytes/backup':>13} {'ms/backup':>10} {'startup load (ms)':>18}")
+    for backend, result in results.items():
+        print(
+            f"{backend:>8} {result['bytes_per_backup']:>13.0f} "
+            f"{result['ms_per_backup']:>10.2f} {result['load_ms']:>18.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Logging Overhead Benchmark
+
+Cost of the logging done for one cloud command (the cloud job processor's
+lines, print_message and the lock prints) at DEBUG and INFO, for the previous
+synchronous f-string logging and for homegrid_logger.
+
+homegrid_logger is reported twice: the time spent in the calling thread, which
+is what the serial and MQTT threads see, and that plus the time its writer
+thread needs to format and write the same records. Messages are sent in bursts
+that fit in LOG_QUEUE_SIZE and the queue is emptied between bursts, so nothing
+is dropped. Output goes to /dev/null, so this is the floor; a real terminal or
+journald only makes the synchronous path slower.
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config
+import contextlib
+import homegrid_logger
+import logging
+import time
+from typing import Tuple
+
+MESSAGES = 20_000
+# Messages per burst; each produces at most five records.
+BURST = 1_000
+
+
+class Item:
+    GUID = "XXXXXXXX-XXXX-XXXX-XXXX-000000000001"
+    topic = "cmd"
+    channel = config.VIRTUAL_CHANNEL.POWER_TOGGLE
+    message_id = "1234"
+    power_state = True
+
+
+class Switch:
+    MAC = "0013a20000000001"
+    GUID = Item.GUID
+
+
+def legacy_message(logger: logging.Logger, item: Item, switch: Switch):
+    # SmartHub.__cloud_job_processor_thread and print_message as they were.
+    logger.debug(f"Popped: {item}")
+    logger.debug(f"Getting Switch from {item.GUID}")
+    print_logger = logging.getLogger("legacy.print_message")
+    logging.basicConfig(format=config.LOGGING_FORMAT)
+    print_logger.setLevel(logger.level)
+    print_logger.debug(f"TEST: GUID: {item.GUID}")
+    print_logger.debug(f"TEST: topic: {item.topic}")
+    print_logger.debug(f"TEST: channel: {item.channel}")
+    print_logger.debug(f"TEST: message_id: {item.message_id}")
+    print_logger.debug(f"TEST: Power State: {item.power_state}")
+    print(f"ACQUIRED LOCK: True {switch}")
+    logger.debug("Got Switch: ")
+    logger.debug(f"MAC: {switch.MAC}")
+    logger.debug(f"GUID: {switch.GUID}")
+    serial_message = switch.MAC + "," + ("on" if (item.power_state) else "off")
+    logger.info("Sending Message to Coordinator: " + serial_message)
+    print(f"RELEASING LOCK: {switch}")
+    print(f"RELEASED LOCK: {switch}")
+
+
+def current_message(logger: homegrid_logger.Logger, item: Item, switch: Switch):
+    logger.debug("Popped: %s", item)
+    logger.debug("Getting Switch from %s", item.GUID)
+    logger.debug(
+        "Cayenne Message: GUID %s, topic %s, channel %s, message_id %s, Power State %s",
+        item.GUID,
+        item.topic,
+        item.channel,
+        item.message_id,
+        item.power_state,
+    )
+    logger.debug("Got Switch: MAC %s, GUID %s", switch.MAC, switch.GUID)
+    serial_message = switch.MAC + "," + ("on" if (item.power_state) else "off")
+    logger.info("Sending Message to Coordinator: %s", serial_message)
+
+
+def time_messages(function, logger) -> float:
+    item, switch = Item(), Switch()
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        function(logger, item, switch)
+    return (time.perf_counter() - start) / MESSAGES
+
+
+def time_deferred_messages(function, logger) -> Tuple[float, float]:
+    """Returns (caller, caller + writer) seconds per message."""
+    handler = homegrid_logger.Logger.handler
+    item, switch = Item(), Switch()
+    caller = writer = 0.0
+    for _ in range(MESSAGES // BURST):
+        start = time.perf_counter()
+        for _ in range(BURST):
+            function(logger, item, switch)
+        flush_start = time.perf_counter()
+        # Doing the writer thread's work here attributes it to this burst.
+        handler.flush()
+        end = time.perf_counter()
+        caller += flush_start - start
+        writer += end - flush_start
+    return caller / MESSAGES, (caller + writer) / MESSAGES
+
+
+def main():
+    devnull = open(os.devnull, "w")
+    # homegrid_logger's writer thread writes to the stderr it finds at start-up.
+    real_stderr, sys.stderr = sys.stderr, devnull
+    current_logger = homegrid_logger.Logger("bench.current")
+    sys.stderr = real_stderr
+
+    legacy_logger = logging.getLogger("bench.legacy")
+    legacy_logger.propagate = False
+    legacy_handler = logging.StreamHandler(devnull)
+    legacy_handler.setFormatter(logging.Formatter(config.LOGGING_FORMAT))
+    legacy_logger.addHandler(legacy_handler)
+    print_logger = logging.getLogger("legacy.print_message")
+    print_logger.propagate = False
+    print_logger.addHandler(legacy_handler)
+
+    print("us per message")
+    print(f"{'level':>6} {'legacy':>8} {'caller':>8} {'total':>8} {'caller speedup':>15}")
+    for level in [logging.DEBUG, logging.INFO]:
+        legacy_logger.setLevel(level)
+        current_logger.logger.setLevel(level)
+        with contextlib.redirect_stdout(devnull):
+            legacy = time_messages(legacy_message, legacy_logger)
+        caller, total = time_deferred_messages(current_message, current_logger)
+        print(
+            f"{logging.getLevelName(level):>6} {legacy * 1e6:>8.1f} {caller * 1e6:>8.1f} "
+            f"{total * 1e6:>8.1f} {legacy / caller:>14.1f}x"
+        )
+    homegrid_logger.Logger.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Memory Benchmark
+
+Uses tracemalloc to measure bytes per switch and per coordinator message at
+fleet scale for the slotted record types, next to dict-backed equivalents of
+the classes they replaced (a switch that always carried a client, a
+message object per reading). Also measures the Switch_history a switch
+allocates on its first reading, fresh and after a day and a year of
+readings, with HISTORY_OBJECTS histories each.
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cayenne.client import CayenneMQTTClient
+from cayenne_message_parser import Cayenne_switch_message
+import config
+import pickle
+from smartswitch import SmartSwitch, smart_switch_to_serializable
+from switch_history import Switch_history
+import threading
+import time
+import tracemalloc
+from xbee_message_parser import Xbee_coordinator_message
+
+FLEET_SIZE = 100_000
+# Histories are large, so fewer are measured.
+HISTORY_OBJECTS = 200
+DAY_SECONDS = 86400
+
+
+class Dict_switch:
+    def __init__(self, MAC, GUID):
+        self.MAC = MAC
+        self.GUID = GUID
+        self.client = CayenneMQTTClient()
+        self.last_time_seen = time.time()
+        self.lock = threading.Lock()
+        self.current_power_state = False
+        self.cumulative_power_consumption_kwh = 0.0
+        self.cumulative_power_cost_dollars = 0.0
+
+
+class Dict_serializable:
+    def __init__(self, switch):
+        self.MAC = switch.MAC
+        self.GUID = switch.GUID
+        self.last_time_seen = switch.last_time_seen
+        self.current_power_state = switch.current_power_state
+        self.cumulative_power_consumption_kwh = switch.cumulative_power_consumption_kwh
+        self.cumulative_power_cost_dollars = switch.cumulative_power_cost_dollars
+
+
+class Dict_xbee_message:
+    def __init__(self, MAC, power_state, power_draw, voltage):
+        self.MAC = MAC
+        self.power_state = power_state
+        self.power_draw = power_draw
+        self.voltage = voltage
+        self.timestamp = time.time()
+
+
+class Dict_cayenne_message:
+    def __init__(self, GUID, topic, channel, message_id, power_state):
+        self.GUID = GUID
+        self.topic = topic
+        self.channel = channel
+        self.message_id = message_id
+        self.power_state = power_state
+
+
+def history_timestamps(seconds: int):
+    """
+    Enough readings to fill every ring a switch reporting for seconds would
+    have: one per raw slot and minute over the last day, one per hour over
+    the last two weeks and one per day before that.
+    """
+    end = 1_700_000_000.0
+    timestamps = set()
+    for spacing, span in ((1, config.HISTORY_RAW_CAPACITY), (60, DAY_SECONDS)):
+        timestamps.update(end - offset for offset in range(0, min(span, seconds), spacing))
+    timestamps.update(end - offset for offset in range(0, min(14 * DAY_SECONDS, seconds), 3600))
+    timestamps.update(end - offset for offset in range(0, seconds, DAY_SECONDS))
+    return sorted(timestamps)
+
+
+def filled_history(timestamps) -> Switch_history:
+    history = Switch_history()
+    for timestamp in timestamps:
+        history.add(timestamp, True, 15.169, 122.5637)
+    return history
+
+
+def bytes_per_item(factory, count: int = FLEET_SIZE) -> float:
+    # Keys are built outside the measured region; only the objects count.
+    keys = [(f"{i:016x}", f"{i:08d}-0000-0000-0000-000000000000") for i in range(count)]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    items = [factory(MAC, GUID) for MAC, GUID in keys]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    # The list holding the items is not part of the per-item cost.
+    allocated -= sys.getsizeof(items)
+    return allocated / count
+
+
+def main():
+    rows = [
+        ("switch (dict + client)", lambda MAC, GUID: Dict_switch(MAC, GUID)),
+        ("switch (slots + snapshot)", lambda MAC, GUID: SmartSwitch(MAC, GUID)),
+        (
+            "persisted (dict)",
+            lambda MAC, GUID: Dict_serializable(SmartSwitch(MAC, GUID)),
+        ),
+        (
+            "persisted (slots)",
+            lambda MAC, GUID: smart_switch_to_serializable(SmartSwitch(MAC, GUID)),
+        ),
+        (
+            "xbee message (dict)",
+            lambda MAC, GUID: Dict_xbee_message(MAC, True, 15.169, 122.5637),
+        ),
+        (
+            "xbee message (slots)",
+            lambda MAC, GUID: Xbee_coordinator_message(MAC, True, 15.169, 122.5637),
+        ),
+        (
+            "cayenne message (dict)",
+            lambda MAC, GUID: Dict_cayenne_message(GUID, "cmd", 1, "id", True),
+        ),
+        (
+            "cayenne message (slots)",
+            lambda MAC, GUID: Cayenne_switch_message(
+                GUID, "cmd", config.VIRTUAL_CHANNEL.POWER_TOGGLE, "id", True
+            ),
+        ),
+    ]
+    print(f"{FLEET_SIZE} objects each")
+    print(f"{'':>26} {'bytes/object':>13}")
+    for name, factory in rows:
+        print(f"{name:>26} {bytes_per_item(factory):>13.0f}")
+
+    print(f"\n{HISTORY_OBJECTS} histories each")
+    for name, seconds in (
+        ("history, first reading", 1),
+        ("history, 1 day", DAY_SECONDS),
+        ("history, 1 year", 365 * DAY_SECONDS),
+    ):
+        timestamps = history_timestamps(seconds)
+        allocated = bytes_per_item(lambda MAC, GUID: filled_history(timestamps), HISTORY_OBJECTS)
+        print(f"{name:>26} {allocated:>13.0f}")
+
+    # Persisted objects are measured with their switch alive, so report the
+    # pickled size as well.
+    switches = [SmartSwitch(f"{i:016x}", f"GUID-{i:08d}") for i in range(FLEET_SIZE)]
+    legacy = pickle.dumps([Dict_serializable(switch) for switch in switches])
+    slotted = pickle.dumps([switch.snapshot for switch in switches])
+    print(f"\npickled bytes/switch: dict {len(legacy) / FLEET_SIZE:.0f}, slots {len(slotted) / FLEET_SIZE:.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+MQTT Event Loop Benchmark
+
+Connects SWITCHES Cayenne clients to a local broker stand-in and measures
+cloud command latency for the old polling loop (client.loop() on each switch
+in turn, then sleep MQTT_LOOP_TIME_SECONDS) and for Mqtt_event_loop, along
+with file-descriptor and thread counts.
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cayenne.client import CayenneMQTTClient
+import config
+import contextlib
+import gc
+from local_mqtt_broker import Local_mqtt_broker
+import logging
+from mqtt_event_loop import Mqtt_event_loop
+import random
+import threading
+import time
+
+SWITCHES = 500
+COMMANDS = 50
+COMMAND_INTERVAL_SECONDS = 0.1
+WINDOW_SECONDS = 20.0
+LEGACY_MQTT_LOOP_TIME_SECONDS = 2
+USERNAME = "bench-user"
+
+
+def open_fd_count() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+def connect_clients(broker: Local_mqtt_broker, on_message):
+    clients = []
+    for index in range(SWITCHES):
+        client = CayenneMQTTClient()
+        client.on_message = on_message
+        client.begin(USERNAME, "password", f"GUID-{index}", hostname=broker.host, port=broker.port)
+        clients.append(client)
+    return clients
+
+
+def run(mode: str) -> dict:
+    sent = {}
+    latencies = []
+
+    def on_message(message):
+        start = sent.pop(message.msg_id, None)
+        if start is not None:
+            latencies.append(time.perf_counter() - start)
+
+    # Let sockets from the previous run's clients be closed before counting.
+    gc.collect()
+    broker = Local_mqtt_broker().start()
+    fds_before = open_fd_count()
+    threads_before = threading.active_count()
+    clients = connect_clients(broker, on_message)
+    stop = threading.Event()
+
+    if "polling" == mode:
+
+        def loop():
+            while not stop.is_set():
+                for client in clients:
+                    if stop.is_set():
+                        return
+                    client.loop()
+                time.sleep(LEGACY_MQTT_LOOP_TIME_SECONDS)
+
+        thread = threading.Thread(target=loop)
+    else:
+        event_loop = Mqtt_event_loop(lambda: clients)
+        thread = threading.Thread(target=event_loop.run, args=(stop.is_set,))
+    thread.start()
+
+    # Give both loops the same head start to process CONNACKs and subscribe.
+    time.sleep(LEGACY_MQTT_LOOP_TIME_SECONDS)
+    # The broker runs in this process; leave its side of each connection out.
+    fds_during = open_fd_count() - len(broker.connections)
+    threads_during = threading.active_count()
+
+    for index in range(COMMANDS):
+        message_id = f"cmd-{index}"
+        GUID = f"GUID-{random.randrange(SWITCHES)}"
+        sent[message_id] = time.perf_counter()
+        broker.publish(f"v1/{USERNAME}/things/{GUID}/cmd/1", f"{message_id},1".encode())
+        time.sleep(COMMAND_INTERVAL_SECONDS)
+
+    deadline = time.monotonic() + WINDOW_SECONDS
+    while sent and time.monotonic() < deadline:
+        time.sleep(0.05)
+    stop.set()
+    if "event" == mode:
+        event_loop.stop()
+    thread.join()
+    for client in clients:
+        client.client.disconnect()
+        client.client.socket() and client.client.socket().close()
+    broker.stop()
+
+    latencies.sort()
+    return {
+        "delivered": len(latencies),
+        "p50_ms": 1000.0 * latencies[len(latencies) // 2] if latencies else float("nan"),
+        "max_ms": 1000.0 * latencies[-1] if latencies else float("nan"),
+        "fds": fds_during - fds_before,
+        "threads": threads_during - threads_before,
+    }
+
+
+def main():
+    config.LOG_LEVEL = logging.WARNING
+    results = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for mode in ("polling", "event"):
+            results[mode] = run(mode)
+
+    print(
+        f"{SWITCHES} switches, {COMMANDS} commands, "
+        f"{WINDOW_SECONDS:.0f} s delivery window"
+    )
+    print(
+        f"{'':>8} {'delivered':>10} {'p50 (ms)':>9} {'max (ms)':>9} "
+        f"{'client fds':>11} {'extra threads':>14}"
+    )
+    for mode, result in results.items():
+        print(
+            f"{mode:>8} {result['delivered']:>10} {result['p50_ms']:>9.1f} "
+            f"{result['max_ms']:>9.1f} {result['fds']:>11} {result['threads']:>14}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Persistence Stall Benchmark
+
+Measures how long Zigbee message handling stalls while the backup thread
+saves the switch list, for the lock-everything save it replaced and for the
+snapshot-based Active_switch_list.save_persistent_data.
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from active_switch_list import Active_switch_list
+import config
+import contextlib
+import logging
+import persistent_data_utils
+import random
+from smartswitch import SmartSwitch, smart_switch_to_serializable
+import tempfile
+import threading
+import time
+from xbee_message_parser import Xbee_coordinator_message
+
+FLEET_SIZE = 20_000
+SAVES = 5
+
+
+class Stub_client:
+    def virtualWrite(self, channel, value, dataType="", dataUnit=""):
+        pass
+
+
+def locked_save(switch_list: Active_switch_list):
+    # The save path before snapshots: every switch lock is held while the
+    # serializable list is built and pickled to disk.
+    with switch_list.acquire_lock():
+        persistent_data_utils.dump(
+            [smart_switch_to_serializable(switch) for switch in switch_list.active_switches],
+            None,
+        )
+
+
+def measure(switch_list: Active_switch_list, save) -> dict:
+    latencies = []
+    stop = threading.Event()
+    message = Xbee_coordinator_message("", True, 15.169, 122.5637)
+
+    def handler():
+        switches = switch_list.active_switches
+        while not stop.is_set():
+            switch = random.choice(switches)
+            start = time.perf_counter()
+            switch.handle_serial_message(message)
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.0005)
+
+    thread = threading.Thread(target=handler)
+    thread.start()
+    save_times = []
+    for _ in range(SAVES):
+        time.sleep(0.2)
+        start = time.perf_counter()
+        save(switch_list)
+        save_times.append(time.perf_counter() - start)
+    stop.set()
+    thread.join()
+    latencies.sort()
+    return {
+        "save_ms": 1000.0 * sum(save_times) / len(save_times),
+        "handled": len(latencies),
+        "p99_ms": 1000.0 * latencies[int(len(latencies) * 0.99)],
+        "max_ms": 1000.0 * latencies[-1],
+    }
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        config.PERSISTENT_DATA_FILENAME = os.path.join(directory, "bench.bin")
+        config.LOG_LEVEL = logging.WARNING
+        switch_list = Active_switch_list()
+        switch_list.add_switches(
+            [SmartSwitch(f"{i:016x}", f"GUID-{i:08d}") for i in range(FLEET_SIZE)]
+        )
+        for switch in switch_list.active_switches:
+            switch.client = Stub_client()
+
+        # SmartSwitch.acquire_lock prints on every lock; keep it off the report.
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            before = measure(switch_list, locked_save)
+            after = measure(
+                switch_list, lambda switches: switches.save_persistent_data()
+            )
+
+    print(f"{FLEET_SIZE} switches, {SAVES} saves each")
+    print(f"{'':>10} {'save (ms)':>10} {'handled':>8} {'p99 (ms)':>9} {'max stall (ms)':>15}")
+    for name, result in (("locked", before), ("snapshot", after)):
+        print(
+            f"{name:>10} {result['save_ms']:>10.1f} {result['handled']:>8} "
+            f"{result['p99_ms']:>9.2f} {result['max_ms']:>15.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Readings Archive Benchmark
+
+Measures the SQLite readings archive for a fleet reporting once a second:
+
+- archive() cost: what a Zigbee worker pays per reading, with the writer
+  thread running;
+- sustained insert rate: readings per second through the writer thread,
+  rollups included, with the producer blocking instead of dropping when the
+  queue is full;
+- query latency on a year of data: the database holds what retention keeps
+  after a year, that is ARCHIVE_RAW_RETENTION_SECONDS of raw readings, 31
+  days of minute rollups and a year of hourly and daily rollups. The raw
+  readings go through Readings_archive.insert(); the older rollups are bulk
+  loaded, since a year of raw readings would be retained for a day only.
+
+    python3 benchmarks/bench_readings_archive.py --plugs 200 --raw-hours 24
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import config
+import logging
+import random
+from readings_archive import open_database, Readings_archive, UPSERT_ROLLUP
+import statistics
+from telemetry_publisher import Switch_telemetry
+import tempfile
+import time
+from typing import Iterator, List
+
+YEAR_SECONDS = 365 * 86400
+
+
+def fleet_readings(plugs: int, start: float, seconds: int) -> Iterator[Switch_telemetry]:
+    """One reading per plug per second, in arrival order."""
+    kwh = [0.0] * plugs
+    for second in range(seconds):
+        timestamp = start + second
+        for plug in range(plugs):
+            power_draw = 40.0 + (plug * 7 + second) % 60
+            kwh[plug] += power_draw / 3.6e6
+            yield Switch_telemetry(
+                None,
+                f"GUID-{plug:04d}",
+                True,
+                power_draw,
+                120.0,
+                kwh[plug],
+                kwh[plug] * 0.15,
+                timestamp,
+            )
+
+
+def bulk_load_rollups(
+    archive: Readings_archive, plugs: int, resolution: int, start: float, end: float
+):
+    archive.connection.executemany(
+        "INSERT OR IGNORE INTO switches (GUID) VALUES (?)",
+        [(f"GUID-{plug:04d}",) for plug in range(plugs)],
+    )
+    ids = dict(archive.connection.execute("SELECT GUID, id FROM switches"))
+    count = resolution
+    rows = (
+        (
+            ids[f"GUID-{plug:04d}"],
+            bucket,
+            count,
+            70.0 * count,
+            40.0,
+            99.0,
+            120.0 * count,
+            119.0,
+            121.0,
+            0.0,
+            0.0,
+        )
+        for bucket in range(int(start // resolution), int(end // resolution))
+        for plug in range(plugs)
+    )
+    with archive.connection:
+        archive.connection.executemany(UPSERT_ROLLUP.format(resolution=resolution), rows)
+
+
+def timed_queries(query, runs: int) -> float:
+    """Median milliseconds of runs calls of query()."""
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        query()
+        durations.append(time.perf_counter() - start)
+    return 1000.0 * statistics.median(durations)
+
+
+def measure_ingest(arguments: argparse.Namespace, directory: str):
+    archive = Readings_archive()
+    archive.start(os.path.join(directory, "ingest.sqlite3"))
+    readings = list(
+        fleet_readings(
+            arguments.plugs, time.time() - arguments.ingest_seconds, arguments.ingest_seconds
+        )
+    )
+
+    # What a worker pays: put_nowait on a queue with room to spare.
+    sample = readings[: min(len(readings), config.ARCHIVE_QUEUE_SIZE // 2)]
+    start = time.perf_counter()
+    for telemetry in sample:
+        archive.archive(telemetry)
+    archive_us = 1e6 * (time.perf_counter() - start) / len(sample)
+    archive.stop()
+
+    archive = Readings_archive()
+    archive.start(os.path.join(directory, "ingest.sqlite3"))
+    start = time.perf_counter()
+    for telemetry in readings:
+        # Block rather than drop, to measure what the writer sustains.
+        archive.archive_queue.put(telemetry)
+    archive.stop()
+    rate = len(readings) / (time.perf_counter() - start)
+    return archive_us, rate
+
+
+def measure_queries(arguments: argparse.Namespace, directory: str):
+    filename = os.path.join(directory, "year.sqlite3")
+    # Populated through insert() directly, without the writer thread.
+    archive = Readings_archive()
+    archive.filename = filename
+    archive.connection = open_database(filename)
+    now = time.time()
+    bulk_load_rollups(archive, arguments.plugs, 86400, now - YEAR_SECONDS, now)
+    bulk_load_rollups(archive, arguments.plugs, 3600, now - YEAR_SECONDS, now)
+    raw_seconds = int(arguments.raw_hours * 3600)
+    bulk_load_rollups(archive, arguments.plugs, 60, now - 31 * 86400, now - raw_seconds)
+    batch: List[Switch_telemetry] = []
+    raw_rows = 0
+    load_start = time.perf_counter()
+    for telemetry in fleet_readings(arguments.plugs, now - raw_seconds, raw_seconds):
+        batch.append(telemetry)
+        if len(batch) == config.ARCHIVE_BATCH_SIZE:
+            archive.insert(batch)
+            raw_rows += len(batch)
+            batch = []
+    if batch:
+        archive.insert(batch)
+        raw_rows += len(batch)
+    load_seconds = time.perf_counter() - load_start
+    archive.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    archive.connection.close()
+
+    rng = random.Random(1)
+    guids = [f"GUID-{plug:04d}" for plug in range(arguments.plugs)]
+    queries = {
+        "raw, last hour": lambda: archive.readings(rng.choice(guids), now - 3600, now),
+        "1 min, last day": lambda: archive.rollups(rng.choice(guids), 60, now - 86400, now),
+        "1 min, last 31 days": lambda: archive.rollups(
+            rng.choice(guids), 60, now - 31 * 86400, now
+        ),
+        "1 h, last year": lambda: archive.rollups(
+            rng.choice(guids), 3600, now - YEAR_SECONDS, now
+        ),
+        "1 day, last year": lambda: archive.rollups(
+            rng.choice(guids), 86400, now - YEAR_SECONDS, now
+        ),
+    }
+    results = {name: timed_queries(query, arguments.query_runs) for name, query in queries.items()}
+    rows = {name: len(query()) for name, query in queries.items()}
+    return raw_rows, load_seconds, os.path.getsize(filename), results, rows
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--plugs", type=int, default=200)
+    parser.add_argument(
+        "--ingest-seconds", type=int, default=600, help="fleet seconds fed to the writer thread"
+    )
+    parser.add_argument(
+        "--raw-hours",
+        type=float,
+        default=config.ARCHIVE_RAW_RETENTION_SECONDS / 3600,
+        help="raw readings held in the year database",
+    )
+    parser.add_argument("--query-runs", type=int, default=50)
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    config.LOG_LEVEL = logging.WARNING
+    with tempfile.TemporaryDirectory(prefix="homegrid-archive-") as directory:
+        archive_us, rate = measure_ingest(arguments, directory)
+        raw_rows, load_seconds, size, results, rows = measure_queries(arguments, directory)
+
+    print(f"{arguments.plugs} plugs")
+    print(f"archive() per reading      {archive_us:8.2f} us")
+    print(
+        f"sustained insert rate      {rate:8.0f} readings/s "
+        f"({rate / arguments.plugs:.0f}x real time)"
+    )
+    print(
+        f"year database              {size / 2**20:8.1f} MiB, {raw_rows} raw readings "
+        f"inserted at {raw_rows / load_seconds:.0f}/s"
+    )
+    print(f"{'query':>20} {'rows':>7} {'median (ms)':>12}")
+    for name, milliseconds in results.items():
+        print(f"{name:>20} {rows[name]:>7} {milliseconds:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Hub Runtime Benchmark
+
+Compares HUB_RUNTIME "threads" with "asyncio" on a real hub process, driven
+through a pty and a Local_mqtt_broker the way fleet_simulator.py does it:
+
+- idle wakeups: context switches per second, summed over every thread of the
+  hub, with all plugs connected and nothing being sent;
+- idle CPU: user plus system CPU time over the same window;
+- reading latency: from a reading being written to the pty to its telemetry
+  reaching the broker, at a low steady rate;
+- command latency: from a toggle being published to the broker to the
+  command coming out of the hub's serial port, sent slower than
+  COMMAND_WRITES_PER_SECOND so the pacing adds nothing;
+- shutdown: from SIGINT to the process exiting.
+
+    python3 benchmarks/bench_runtime.py --plugs 50 --idle-seconds 10
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import config
+import fleet_simulator
+from local_mqtt_broker import Local_mqtt_broker
+import logging
+import signal
+import tempfile
+import threading
+import time
+import tty
+from typing import Dict, Tuple
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def process_counters(pid: int) -> Tuple[int, float]:
+    """Returns (context switches, CPU seconds) summed over every thread."""
+    switches = 0
+    for thread in os.listdir(f"/proc/{pid}/task"):
+        try:
+            with open(f"/proc/{pid}/task/{thread}/status") as fh:
+                for line in fh:
+                    if line.startswith(("voluntary_ctxt_switches", "nonvoluntary_ctxt_switches")):
+                        switches += int(line.split()[1])
+        except FileNotFoundError:
+            pass
+    with open(f"/proc/{pid}/stat") as fh:
+        # The command name can hold spaces, so count fields after it.
+        fields = fh.read().rsplit(")", 1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return switches, cpu_seconds
+
+
+def measure_runtime(runtime: str, arguments: argparse.Namespace) -> Dict[str, float]:
+    simulator = fleet_simulator.Fleet_simulator(
+        fleet_simulator.parse_arguments(
+            [
+                "--plugs",
+                str(arguments.plugs),
+                "--runtime",
+                runtime,
+                "--malformed-rate",
+                "0",
+                "--storm-interval",
+                "0",
+            ]
+        )
+    )
+    results: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory(prefix="homegrid-runtime-") as directory:
+        master_fd, slave_fd = os.openpty()
+        tty.setraw(slave_fd)
+        os.set_blocking(master_fd, False)
+        broker = Local_mqtt_broker(on_publish=simulator.on_publish).start()
+        hub = simulator.start_hub(directory, os.ttyname(slave_fd), broker)
+        reader = threading.Thread(target=simulator.serial_command_reader_thread, args=(master_fd,))
+        try:
+            simulator.wait_for_connections(broker, hub)
+            reader.start()
+            # Let start-up work, like the first keepalive pass, settle.
+            time.sleep(arguments.settle_seconds)
+
+            switches_before, cpu_before = process_counters(hub.pid)
+            time.sleep(arguments.idle_seconds)
+            switches_after, cpu_after = process_counters(hub.pid)
+            results["idle wakeups/s"] = (switches_after - switches_before) / arguments.idle_seconds
+            results["idle CPU %"] = 100.0 * (cpu_after - cpu_before) / arguments.idle_seconds
+
+            for index in range(arguments.readings):
+                plug = simulator.plugs[index % len(simulator.plugs)]
+                chunk = bytearray(simulator.frame(plug))
+                simulator.write_frames(master_fd, chunk, [(plug, plug.sequence, len(chunk))], 0)
+                time.sleep(1.0 / arguments.reading_rate)
+            channel = config.VIRTUAL_CHANNEL.POWER_TOGGLE.value
+            for index in range(arguments.commands):
+                plug = simulator.plugs[index % len(simulator.plugs)]
+                with simulator.lock:
+                    simulator.pending_commands[plug.GUID].append(time.monotonic())
+                    simulator.commands_sent += 1
+                broker.publish(
+                    f"v1/{fleet_simulator.USERNAME}/things/{plug.GUID}/cmd/{channel}",
+                    f"{index},{0 if (plug.power_state) else 1}".encode(),
+                )
+                time.sleep(1.0 / arguments.command_rate)
+            time.sleep(arguments.drain_seconds)
+            with simulator.lock:
+                results["reading p50 ms"] = 1000.0 * fleet_simulator.percentile(
+                    simulator.reading_latencies, 0.5
+                )
+                results["reading p99 ms"] = 1000.0 * fleet_simulator.percentile(
+                    simulator.reading_latencies, 0.99
+                )
+                results["command p50 ms"] = 1000.0 * fleet_simulator.percentile(
+                    simulator.command_latencies, 0.5
+                )
+                results["readings lost"] = arguments.readings - len(simulator.reading_latencies)
+
+            start = time.monotonic()
+            hub.send_signal(signal.SIGINT)
+            hub.wait(timeout=60)
+            results["shutdown ms"] = 1000.0 * (time.monotonic() - start)
+        finally:
+            simulator.stopped = True
+            if hub.poll() is None:
+                hub.kill()
+                hub.wait()
+            if reader.is_alive():
+                reader.join()
+            broker.stop()
+            os.close(master_fd)
+            os.close(slave_fd)
+            simulator.hub_log.close()
+            with open(os.path.join(directory, "hub.log"), "rb") as log:
+                results["hub log lines"] = len(log.read().splitlines())
+    return results
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--plugs", type=int, default=50)
+    parser.add_argument("--settle-seconds", type=float, default=3.0)
+    parser.add_argument("--idle-seconds", type=float, default=10.0)
+    parser.add_argument("--readings", type=int, default=200)
+    parser.add_argument("--commands", type=int, default=50)
+    parser.add_argument("--reading-rate", type=float, default=50.0, help="readings per second")
+    parser.add_argument("--command-rate", type=float, default=10.0, help="commands per second")
+    parser.add_argument("--drain-seconds", type=float, default=2.0)
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    config.LOG_LEVEL = logging.WARNING
+    results = {runtime: measure_runtime(runtime, arguments) for runtime in ["threads", "asyncio"]}
+    print(f"{arguments.plugs} plugs")
+    print(f"{'':>16} {'threads':>10} {'asyncio':>10}")
+    for name in results["threads"]:
+        print(f"{name:>16} {results['threads'][name]:>10.1f} {results['asyncio'][name]:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Serial Ingestion Benchmark
+
+Writes coordinator lines into a pty and measures how fast the old
+readline-per-message receiver and the chunked Serial_line_framer receiver
+turn them into parsed messages. A pty is not baud-limited, so this measures
+the hub's CPU cost of ingestion, not the radio link.
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config
+from serial_line_framer import Serial_line_framer
+import serial
+import threading
+import time
+import tty
+from xbee_message_parser import xbee_message_to_object
+
+LINES = 200_000
+PLUGS = 2_000
+
+
+def sample_lines():
+    lines = []
+    for index in range(LINES):
+        lines.append(
+            f"{index % PLUGS:016x},{index & 1},{13.0 + (index % 97) / 10:.4f},"
+            f"{122.0 + (index % 13) / 10:.4f}\r\n"
+        )
+    return "".join(lines).encode()
+
+
+def readline_receiver(port: serial.Serial, count: list, done: threading.Event):
+    while not done.is_set():
+        serial_message = port.readline().strip()
+        decoded_serial_message = serial_message.decode()
+        if 0 == len(decoded_serial_message):
+            continue
+        if xbee_message_to_object(decoded_serial_message) is not None:
+            count[0] += 1
+            if count[0] >= LINES:
+                done.set()
+
+
+def chunked_receiver(port: serial.Serial, count: list, done: threading.Event):
+    framer = Serial_line_framer()
+    while not done.is_set():
+        data = port.read(min(max(1, port.in_waiting), config.SERIAL_READ_CHUNK_BYTES))
+        for line in framer.feed(data):
+            if xbee_message_to_object(line) is not None:
+                count[0] += 1
+        if count[0] >= LINES:
+            done.set()
+
+
+def run(receiver) -> float:
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    port = serial.Serial(os.ttyname(slave), baudrate=config.SERIAL_BAUDRATE, timeout=0.5)
+    payload = sample_lines()
+    count = [0]
+    done = threading.Event()
+    thread = threading.Thread(target=receiver, args=(port, count, done))
+    thread.start()
+
+    start = time.perf_counter()
+    view = memoryview(payload)
+    while view:
+        written = os.write(master, view[:65536])
+        view = view[written:]
+    done.wait(timeout=120)
+    elapsed = time.perf_counter() - start
+    done.set()
+    thread.join()
+    port.close()
+    os.close(master)
+    os.close(slave)
+    return count[0] / elapsed
+
+
+def main():
+    line_bytes = len(sample_lines()) / LINES
+    print(f"{LINES} lines, {line_bytes:.1f} bytes/line")
+    print(
+        f"115200 baud carries at most {11520 / line_bytes:.0f} lines/s "
+        f"(8N1, {11520} bytes/s)"
+    )
+    for name, receiver in (("readline", readline_receiver), ("chunked", chunked_receiver)):
+        print(f"{name:>10}: {run(receiver):>10.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
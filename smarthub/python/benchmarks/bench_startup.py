@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Hub Start-up Benchmark
+
+Starts a real hub against a TLS broker with an injected round trip, the way
+a hub on a home connection reaches Cayenne, and feeds it readings from the
+moment it starts. For each MQTT_CONNECT_CONCURRENCY it reports, measured from
+the start of SmartHub.run():
+
+- first reading: the first reading processed, as the hub logs it;
+- all opened: every MQTT connection open, as the hub logs it;
+- first publish and all connected: seen from the broker, measured from the
+  process being started.
+
+The local broker is reached through a relay that delays every chunk by half
+the round trip in each direction and a TLS terminator holding a self-signed
+certificate, so each connection pays the TCP connect and the TLS 1.2
+handshake, three round trips, before it can send anything. With a
+concurrency of 1 the connections open one after another, as they did before
+the hub opened them in the background, when no reading was processed until
+the last one was open.
+
+    python3 benchmarks/bench_startup.py --plugs 100 --rtt-ms 50
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import asyncio
+import collections
+import config
+import fleet_simulator
+from local_mqtt_broker import Local_mqtt_broker
+import logging
+import mqtt_connector
+import re
+import signal
+import ssl
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import tty
+from typing import Deque, Dict, Optional, Tuple
+
+TLS_PORT = 8883
+
+
+class Tls_latency_front:
+    """
+    Accepts connections on 127.0.0.1:8883, delays each direction by half the
+    round trip, terminates TLS and forwards the plaintext to the broker.
+    Runs on its own asyncio loop in a background thread.
+    """
+
+    def __init__(
+        self, broker: Local_mqtt_broker, certificate: str, key: str, rtt_seconds: float
+    ):
+        self.broker = broker
+        self.delay = rtt_seconds / 2.0
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(certificate, key)
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def __run(self):
+        asyncio.set_event_loop(self.loop)
+        terminator = self.loop.run_until_complete(
+            asyncio.start_server(self.__terminate, "127.0.0.1", 0, ssl=self.ssl_context)
+        )
+        self.terminator_port = terminator.sockets[0].getsockname()[1]
+        relay = self.loop.run_until_complete(
+            asyncio.start_server(self.__relay, "127.0.0.1", TLS_PORT)
+        )
+        self.ready.set()
+        self.loop.run_forever()
+        # Free the port for the next run.
+        relay.close()
+        terminator.close()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    async def __relay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(
+                "127.0.0.1", self.terminator_port
+            )
+        except OSError:
+            writer.close()
+            return
+        await asyncio.gather(
+            self.__pump(reader, upstream_writer, self.delay),
+            self.__pump(upstream_reader, writer, self.delay),
+        )
+
+    async def __terminate(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        upstream_reader, upstream_writer = await asyncio.open_connection(
+            self.broker.host, self.broker.port
+        )
+        await asyncio.gather(
+            self.__pump(reader, upstream_writer, 0.0),
+            self.__pump(upstream_reader, writer, 0.0),
+        )
+
+    async def __pump(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, delay: float
+    ):
+        # Chunks keep their order: each is written delay after it was read.
+        queued: Deque[Tuple[float, bytes]] = collections.deque()
+
+        def deliver():
+            now = self.loop.time()
+            while queued and queued[0][0] <= now:
+                data = queued.popleft()[1]
+                if data:
+                    writer.write(data)
+                else:
+                    writer.close()
+            if queued:
+                self.loop.call_at(queued[0][0], deliver)
+
+        try:
+            while True:
+                data = await reader.read(65536)
+                if delay:
+                    queued.append((self.loop.time() + delay, data))
+                    if 1 == len(queued):
+                        self.loop.call_at(queued[0][0], deliver)
+                elif data:
+                    writer.write(data)
+                else:
+                    writer.close()
+                if not data:
+                    return
+        except (ConnectionError, OSError):
+            writer.close()
+
+
+def create_certificate(directory: str) -> Tuple[str, str]:
+    certificate = os.path.join(directory, "broker.pem")
+    key = os.path.join(directory, "broker.key")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-keyout", key, "-out", certificate, "-days", "1",
+            "-subj", "/CN=localhost",
+            "-addext", "subjectAltName=DNS:localhost",
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return certificate, key
+
+
+def logged_seconds(log: str, pattern: str) -> Optional[float]:
+    match = re.search(pattern, log)
+    return float(match.group(1)) if match else None
+
+
+def measure_concurrency(
+    concurrency: int, arguments: argparse.Namespace, certificate: str, key: str
+) -> Dict[str, float]:
+    simulator = fleet_simulator.Fleet_simulator(
+        fleet_simulator.parse_arguments(
+            ["--plugs", str(arguments.plugs), "--malformed-rate", "0", "--storm-interval", "0"]
+        )
+    )
+    results: Dict[str, float] = {}
+    first_publish = []
+
+    def on_publish(client_id: str, topic: str, payload: bytes):
+        if not first_publish and topic.endswith("/data/json"):
+            first_publish.append(time.monotonic())
+
+    with tempfile.TemporaryDirectory(prefix="homegrid-startup-") as directory:
+        master_fd, slave_fd = os.openpty()
+        tty.setraw(slave_fd)
+        os.set_blocking(master_fd, False)
+        broker = Local_mqtt_broker(on_publish=on_publish).start()
+        front = Tls_latency_front(broker, certificate, key, arguments.rtt_ms / 1000.0)
+        front.start()
+        start = time.monotonic()
+        hub = simulator.start_hub(
+            directory,
+            os.ttyname(slave_fd),
+            broker,
+            config_overrides={
+                "LOG_LEVEL": logging.INFO,
+                "MQTT_CA_CERTS": certificate,
+                "MQTT_CONNECT_CONCURRENCY": concurrency,
+            },
+            broker_address=("localhost", TLS_PORT),
+        )
+        writer = threading.Thread(target=simulator.coordinator_writer_thread, args=(master_fd,))
+        writer.start()
+        try:
+            simulator.wait_for_connections(broker, hub)
+            results["all connected s"] = time.monotonic() - start
+            deadline = time.monotonic() + 10.0
+            while not first_publish and time.monotonic() < deadline:
+                time.sleep(0.01)
+            results["first publish s"] = (first_publish or [float("nan")])[0] - start
+        finally:
+            simulator.stopped = True
+            writer.join()
+            hub.send_signal(signal.SIGINT)
+            try:
+                hub.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                hub.kill()
+                hub.wait()
+            front.stop()
+            broker.stop()
+            os.close(master_fd)
+            os.close(slave_fd)
+            simulator.hub_log.close()
+            with open(os.path.join(directory, "hub.log"), "rb") as log:
+                hub_log = log.read().decode(errors="replace")
+    results["first reading s"] = logged_seconds(
+        hub_log, r"Processed First Reading ([\d.]+) s after Start-up"
+    )
+    results["all opened s"] = logged_seconds(
+        hub_log, r"Opened \d+ MQTT Connections in ([\d.]+) s"
+    )
+    return results
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--plugs", type=int, default=100)
+    parser.add_argument("--rtt-ms", type=float, default=50.0, help="round trip to the broker")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    config.LOG_LEVEL = logging.WARNING
+    with tempfile.TemporaryDirectory(prefix="homegrid-certificate-") as directory:
+        certificate, key = create_certificate(directory)
+        results = {
+            concurrency: measure_concurrency(concurrency, arguments, certificate, key)
+            for concurrency in arguments.concurrency
+        }
+        config.MQTT_CA_CERTS = certificate
+        durations = []
+        for _ in range(20):
+            start = time.perf_counter()
+            mqtt_connector.create_ssl_context()
+            durations.append(time.perf_counter() - start)
+
+    print(f"{arguments.plugs} plugs, {arguments.rtt_ms:.0f} ms round trip")
+    names = list(results[arguments.concurrency[0]])
+    print(f"{'concurrency':>11} " + " ".join(f"{name:>17}" for name in names))
+    for concurrency, result in results.items():
+        print(f"{concurrency:>11} " + " ".join(f"{result[name]:>17.3f}" for name in names))
+    print(
+        f"SSLContext with the CA bundle loaded: {1000.0 * statistics.median(durations):.1f} ms, "
+        f"now created once rather than per switch"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+State Backend Benchmark
+
+Compares the "pickle", "journal" and "mmap" persistence backends at 100k
+switches: startup load time, the time of one backup after 1% and after all
+of the switches changed, and the per-reading cost of keeping the saved state
+current (SmartSwitch.update_snapshot, which builds a snapshot for pickle and
+journal and writes the mapped record for mmap).
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from active_switch_list import Active_switch_list
+import config
+import logging
+import persistent_data_utils
+import random
+from smartswitch import SmartSwitch, smart_switch_to_serializable
+import tempfile
+import time
+from typing import Dict, List
+
+FLEET_SIZE = 100_000
+UPDATE_SAMPLES = 200_000
+
+
+def change(switches: List[SmartSwitch]):
+    # What handle_serial_message does to the saved state, without allocating
+    # a reading history for every switch.
+    for switch in switches:
+        with switch.lock:
+            switch.cumulative_power_consumption_kwh += 0.001
+            switch.cumulative_power_cost_dollars += 0.00015
+            switch.last_time_seen += 1.0
+            switch.update_snapshot()
+
+
+def timed(function) -> float:
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def run_backend(backend: str, directory: str) -> Dict[str, float]:
+    config.PERSISTENT_DATA_FILENAME = os.path.join(directory, f"{backend}.bin")
+    config.PERSISTENT_DATA_BACKEND = backend
+    # Every backend starts from the same pickled fleet; mmap imports it on
+    # its first load.
+    persistent_data_utils.dump(
+        [
+            smart_switch_to_serializable(SmartSwitch(f"{i:016x}", f"GUID-{i:08d}"))
+            for i in range(FLEET_SIZE)
+        ],
+        None,
+    )
+    if "mmap" == backend:
+        # The import is a one-off; measure loading the mapped file itself.
+        importer = Active_switch_list()
+        importer.load_persistent_data()
+        importer.close_persistent_data()
+
+    switch_list = Active_switch_list()
+    results = {"load_ms": 1000.0 * timed(switch_list.load_persistent_data)}
+    switches = switch_list.active_switches
+    assert FLEET_SIZE == len(switches)
+
+    rng = random.Random(1)
+    change(rng.sample(switches, FLEET_SIZE // 100))
+    results["save_1%_ms"] = 1000.0 * timed(switch_list.save_persistent_data)
+    change(switches)
+    results["save_all_ms"] = 1000.0 * timed(switch_list.save_persistent_data)
+
+    sample = [rng.choice(switches) for _ in range(UPDATE_SAMPLES)]
+    results["update_us"] = 1e6 * timed(lambda: change(sample)) / UPDATE_SAMPLES
+    switch_list.save_persistent_data()
+    switch_list.close_persistent_data()
+
+    reloaded = Active_switch_list()
+    reloaded.load_persistent_data()
+    reloaded_switch = reloaded.get_switch_from_MAC(sample[-1].MAC)
+    assert (
+        reloaded_switch.cumulative_power_consumption_kwh
+        == sample[-1].cumulative_power_consumption_kwh
+    )
+    reloaded.close_persistent_data()
+    return results
+
+
+def main():
+    config.LOG_LEVEL = logging.WARNING
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="homegrid-state-") as directory:
+        for backend in ["pickle", "journal", "mmap"]:
+            results[backend] = run_backend(backend, directory)
+
+    print(f"{FLEET_SIZE} switches")
+    print(
+        f"{'':>8} {'load (ms)':>10} {'save 1% (ms)':>13} {'save all (ms)':>14} "
+        f"{'update (us)':>12}"
+    )
+    for backend, result in results.items():
+        print(
+            f"{backend:>8} {result['load_ms']:>10.1f} {result['save_1%_ms']:>13.1f} "
+            f"{result['save_all_ms']:>14.1f} {result['update_us']:>12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Switch Registry Benchmark
+
+Compares the indexed Active_switch_list lookups against the linear scan they
+replaced, at 10, 1k and 100k switches.
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from active_switch_list import Active_switch_list
+import random
+from smartswitch import SmartSwitch
+import time
+
+FLEET_SIZES = [10, 1_000, 100_000]
+LOOKUPS = 20_000
+
+
+def linear_get_switch_from_MAC(switches, MAC):
+    for switch in switches:
+        if MAC == switch.MAC:
+            return switch
+    return None
+
+
+def time_lookups(lookup, keys) -> float:
+    start = time.perf_counter()
+    for key in keys:
+        lookup(key)
+    return (time.perf_counter() - start) / len(keys)
+
+
+def main():
+    print(f"{'switches':>10} {'linear (us)':>12} {'indexed (us)':>13} {'speedup':>9}")
+    for fleet_size in FLEET_SIZES:
+        switch_list = Active_switch_list()
+        switch_list.add_switches(
+            [
+                SmartSwitch(f"{i:016x}", f"GUID-{i:08d}")
+                for i in range(fleet_size)
+            ]
+        )
+        keys = [f"{random.randrange(fleet_size):016x}" for _ in range(LOOKUPS)]
+        # The linear scan is O(fleet); keep the 100k run to a sane duration.
+        linear_keys = keys[: max(10, LOOKUPS * 1_000 // fleet_size)]
+
+        linear = time_lookups(
+            lambda MAC: linear_get_switch_from_MAC(switch_list.active_switches, MAC),
+            linear_keys,
+        )
+        indexed = time_lookups(switch_list.get_switch_from_MAC, keys)
+        print(
+            f"{fleet_size:>10} {linear * 1e6:>12.3f} {indexed * 1e6:>13.3f} "
+            f"{linear / indexed:>8.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
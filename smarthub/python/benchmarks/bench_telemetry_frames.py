@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Telemetry Frame Benchmark
+
+Compares the plug's text readings, "<state>,<power>,<vrms>", with binary
+telemetry frames for the same readings. Power and voltage come from raw
+sensor values converted the way plug.py does, printed as the XBee's
+single-precision floats would be. Reported per format:
+
+- air bytes: payload bytes the plug transmits per reading;
+- serial bytes: the line the coordinator writes to the hub, checksum and
+  newline included; binary frames travel as hex;
+- per-line us: unframe_coordinator_line and xbee_message_to_object, plus
+  Reading_sequences.accept, as SmartHub.__parse_coordinator_data runs them;
+- batch us: xbee_messages_to_batch over batches of --batch-size lines.
+
+    python3 benchmarks/bench_telemetry_frames.py --readings 200000
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import config
+import logging
+import numpy as np
+import random
+from reading_sequences import Reading_sequences
+import time
+from typing import Dict, List
+from xbee_message_parser import (
+    TELEMETRY_FRAME,
+    TELEMETRY_FRAME_VERSION,
+    TELEMETRY_SEQUENCE_MODULUS,
+    unframe_coordinator_line,
+    xbee_message_to_object,
+    xbee_messages_to_batch,
+)
+
+
+def make_payloads(arguments: argparse.Namespace) -> Dict[str, List[bytes]]:
+    rng = random.Random(1)
+    payloads: Dict[str, List[bytes]] = {"text": [], "binary": []}
+    for index in range(arguments.readings):
+        state = index & 1
+        # Same conversions as read_power_avg and read_vrms_irms_avg.
+        power = rng.randrange(10, 8000) * 0.2167
+        vrms = rng.randrange(16700, 17100) / 16880.0 * 122
+        payloads["text"].append(
+            f"{state},{str(np.float32(power))},{str(np.float32(vrms))}".encode()
+        )
+        payloads["binary"].append(
+            TELEMETRY_FRAME.pack(
+                TELEMETRY_FRAME_VERSION,
+                state,
+                index // arguments.plugs % TELEMETRY_SEQUENCE_MODULUS + 1,
+                int(power * 100 + 0.5),
+                int(vrms * 100 + 0.5),
+            )
+        )
+    return payloads
+
+
+def coordinator_lines(payloads: List[bytes], plugs: int) -> List[str]:
+    # What coordinator.py writes: binary frames as hex, then "*<checksum>".
+    lines = []
+    for index, payload in enumerate(payloads):
+        if payload[0] < 0x20:
+            payload = payload.hex().encode()
+        line = f"0013a200{index % plugs:08x},".encode() + payload
+        lines.append((line + b"*%02x" % (0xFF - (sum(line) & 0xFF))).decode())
+    return lines
+
+
+def measure(payloads: List[bytes], arguments: argparse.Namespace) -> Dict[str, float]:
+    lines = coordinator_lines(payloads, arguments.plugs)
+    sequences = Reading_sequences()
+
+    start = time.perf_counter()
+    accepted = 0
+    for line in lines:
+        message = xbee_message_to_object(unframe_coordinator_line(line))
+        if message is not None and sequences.accept(message):
+            accepted += 1
+    per_line = (time.perf_counter() - start) / len(lines)
+    assert accepted == len(lines)
+
+    bodies = [unframe_coordinator_line(line) for line in lines]
+    start = time.perf_counter()
+    accepted = 0
+    for offset in range(0, len(bodies), arguments.batch_size):
+        batch, rejects = xbee_messages_to_batch(bodies[offset : offset + arguments.batch_size])
+        accepted += len(batch)
+    per_batched_line = (time.perf_counter() - start) / len(bodies)
+    assert accepted == len(bodies)
+
+    return {
+        "air bytes": sum(len(payload) for payload in payloads) / len(payloads),
+        "serial bytes": sum(len(line) + 1 for line in lines) / len(lines),
+        "per-line us": 1e6 * per_line,
+        "batch us": 1e6 * per_batched_line,
+    }
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--readings", type=int, default=200000)
+    parser.add_argument("--plugs", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    config.LOG_LEVEL = logging.WARNING
+    payloads = make_payloads(arguments)
+    print(f"{arguments.readings} readings from {arguments.plugs} plugs")
+    print(f"{'format':>8} {'air bytes':>10} {'serial bytes':>13} {'per-line us':>12} {'batch us':>9}")
+    for name, format_payloads in payloads.items():
+        result = measure(format_payloads, arguments)
+        print(
+            f"{name:>8} {result['air bytes']:>10.1f} {result['serial bytes']:>13.1f} "
+            f"{result['per-line us']:>12.2f} {result['batch us']:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Telemetry Publisher Benchmark
+
+Compares lock hold time and reading throughput of the old in-lock publishing
+(seven virtualWrite calls per reading) against handle_serial_message handing
+its record to the Telemetry_publisher, using a client whose publishes take
+PUBLISH_LATENCY_SECONDS like a slow network.
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import contextlib
+import logging
+import config
+from smartswitch import SmartSwitch
+from telemetry_publisher import Telemetry_publisher, telemetry_to_channels
+import time
+from xbee_message_parser import Xbee_coordinator_message
+
+SWITCHES = 20
+READINGS = 4_000
+PUBLISH_LATENCY_SECONDS = 0.0002
+
+
+class Slow_paho_client:
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        time.sleep(PUBLISH_LATENCY_SECONDS)
+        self.published += 1
+
+
+class Slow_cayenne_client:
+    connected = True
+    rootTopic = "v1/user/things/guid"
+
+    def __init__(self):
+        self.client = Slow_paho_client()
+
+    def virtualWrite(self, channel, value, dataType="", dataUnit=""):
+        self.client.publish(f"{self.rootTopic}/data/{channel}", f"{dataType},{dataUnit}={value}")
+
+
+def run(mode: str) -> dict:
+    switches = [SmartSwitch(f"{i:016x}", f"GUID-{i}") for i in range(SWITCHES)]
+    for switch in switches:
+        switch.client = Slow_cayenne_client()
+    message = Xbee_coordinator_message("", True, 15.169, 122.5637)
+    publisher = Telemetry_publisher()
+    publisher.start()
+    hold_times = []
+
+    start = time.perf_counter()
+    for index in range(READINGS):
+        switch = switches[index % SWITCHES]
+        hold_start = time.perf_counter()
+        if "in-lock" == mode:
+            # The same writes the old handle_serial_message made; they ran
+            # under the switch lock, so this is its lock hold time.
+            for channel in telemetry_to_channels(switch.handle_serial_message(message)):
+                switch.client.virtualWrite(
+                    channel["channel"],
+                    channel["value"],
+                    dataType=channel["type"],
+                    dataUnit=channel["unit"],
+                )
+        else:
+            publisher.publish(switch.handle_serial_message(message))
+        hold_times.append(time.perf_counter() - hold_start)
+    handled = time.perf_counter() - start
+    publisher.stop()
+    drained = time.perf_counter() - start
+
+    hold_times.sort()
+    return {
+        "readings_per_s": READINGS / handled,
+        "drained_s": drained,
+        "hold_p50_us": 1e6 * hold_times[len(hold_times) // 2],
+        "hold_p99_us": 1e6 * hold_times[int(len(hold_times) * 0.99)],
+        "publishes": sum(switch.client.client.published for switch in switches),
+    }
+
+
+def main():
+    config.LOG_LEVEL = logging.WARNING
+    results = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for mode, batch in (("in-lock", False), ("publisher", False), ("batched", True)):
+            config.TELEMETRY_BATCH_PUBLISH = batch
+            results[mode] = run(mode)
+
+    print(
+        f"{SWITCHES} switches, {READINGS} readings, "
+        f"{PUBLISH_LATENCY_SECONDS * 1e6:.0f} us per publish"
+    )
+    print(
+        f"{'':>10} {'readings/s':>11} {'drained (s)':>12} {'hold p50 (us)':>14} "
+        f"{'hold p99 (us)':>14} {'publishes':>10}"
+    )
+    for mode, result in results.items():
+        print(
+            f"{mode:>10} {result['readings_per_s']:>11.0f} {result['drained_s']:>12.2f} "
+            f"{result['hold_p50_us']:>14.1f} {result['hold_p99_us']:>14.1f} "
+            f"{result['publishes']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
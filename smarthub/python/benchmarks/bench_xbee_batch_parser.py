@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+XBee Batch Parser Benchmark
+
+Per-reading parse cost of xbee_message_to_object against
+xbee_messages_to_batch at several batch sizes, with 1% rejected lines.
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import time
+from xbee_message_parser import xbee_message_to_object, xbee_messages_to_batch
+
+READINGS = 200_000
+BATCH_SIZES = [1, 10, 100, 1_000, 10_000]
+
+
+def sample_lines():
+    lines = []
+    for index in range(READINGS):
+        if index % 100 == 99:
+            lines.append(f"{index:016x},Config Success")
+        else:
+            lines.append(
+                f"{index % 2000:016x},{index & 1},{13.0 + (index % 97) / 10:.4f},"
+                f"{122.0 + (index % 13) / 10:.4f}"
+            )
+    return lines
+
+
+def main():
+    lines = sample_lines()
+
+    start = time.perf_counter()
+    parsed = [xbee_message_to_object(line) for line in lines]
+    per_object = (time.perf_counter() - start) / READINGS
+    assert sum(message is not None for message in parsed) == READINGS * 99 // 100
+
+    print(f"{READINGS} lines, 1% rejects")
+    print(f"{'per-object':>16}: {per_object * 1e9:>8.0f} ns/line")
+    for batch_size in BATCH_SIZES:
+        accepted = 0
+        start = time.perf_counter()
+        for offset in range(0, READINGS, batch_size):
+            batch, rejects = xbee_messages_to_batch(lines[offset : offset + batch_size])
+            accepted += len(batch)
+        per_line = (time.perf_counter() - start) / READINGS
+        assert accepted == READINGS * 99 // 100
+        print(
+            f"{f'batch of {batch_size}':>16}: {per_line * 1e9:>8.0f} ns/line "
+            f"({per_object / per_line:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
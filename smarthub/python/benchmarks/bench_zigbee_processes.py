@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Zigbee Worker Mode Benchmark
+
+Pushes the same readings through Zigbee_worker_pool (threads) and
+Zigbee_process_pool (processes) for each worker count, and checks that
+every switch ends with the same energy totals in both. Per reading, the
+threads mode runs handle_serial_message and builds the Cayenne JSON payload
+the way the Telemetry_publisher would; the processes mode does both in the
+workers and the hub process only applies the results.
+
+Reported per mode and worker count:
+
+- readings/s: wall-clock throughput from the first submit to the last
+  result;
+- hub CPU/reading: CPU time of the hub process alone, which is what caps a
+  threads hub at one core;
+- hub ceiling/s: readings per second the hub process could take at that
+  cost on one core, the limit once workers have cores of their own.
+
+With --kill-worker, worker process 0 is killed halfway through the
+processes runs; the pool restarts it and the energy totals must still
+match.
+
+    python3 benchmarks/bench_zigbee_processes.py --switches 2000 --readings 100000
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from active_switch_list import Active_switch_list
+import argparse
+import config
+import json
+import logging
+import random
+import signal
+from smartswitch import SmartSwitch
+from telemetry_publisher import Switch_telemetry, telemetry_to_channels
+import threading
+import time
+from typing import Dict, List, Tuple
+from xbee_message_parser import Xbee_coordinator_message
+from zigbee_process_pool import Zigbee_process_pool
+from zigbee_worker_pool import Zigbee_worker_pool
+
+# Readings per submit, about what one serial read carries at full load.
+BATCH_READINGS = 128
+
+
+def make_readings(arguments: argparse.Namespace) -> List[List[Xbee_coordinator_message]]:
+    rng = random.Random(1)
+    start = time.time()
+    batches = []
+    batch = []
+    for index in range(arguments.readings):
+        MAC = f"{rng.randrange(arguments.switches):016x}"
+        message = Xbee_coordinator_message(
+            MAC, bool(index & 1), 10.0 + rng.random() * 1000.0, 120.0 + rng.random()
+        )
+        message.timestamp = start + index * 0.001
+        batch.append(message)
+        if BATCH_READINGS == len(batch):
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def make_switch_list(switches: int) -> Active_switch_list:
+    switch_list = Active_switch_list()
+    switch_list.add_switches(
+        [SmartSwitch(f"{index:016x}", f"GUID-{index:08d}", 0.0) for index in range(switches)]
+    )
+    return switch_list
+
+
+def measure(
+    mode: str, workers: int, arguments: argparse.Namespace, batches
+) -> Tuple[Dict[str, float], Dict[str, float]]:
+    switch_list = make_switch_list(arguments.switches)
+    readings = sum(len(batch) for batch in batches)
+    total = readings
+    handled = [0]
+    done = threading.Event()
+    lock = threading.Lock()
+
+    def count():
+        with lock:
+            handled[0] += 1
+            if handled[0] == total:
+                done.set()
+
+    def handle_message(message: Xbee_coordinator_message):
+        telemetry = switch_list.get_switch_from_MAC(message.MAC).handle_serial_message(message)
+        json.dumps(telemetry_to_channels(telemetry))
+        count()
+
+    def handle_result(switch: SmartSwitch, telemetry: Switch_telemetry):
+        count()
+
+    if "threads" == mode:
+        pool = Zigbee_worker_pool(handle_message, workers)
+    else:
+        pool = Zigbee_process_pool(switch_list, handle_result, lambda message: None, workers)
+    pool.start()
+    if "processes" == mode:
+        # Spawned workers import the hub's modules; keep that out of the
+        # timing with a reading from a switch of its own.
+        warm_up = SmartSwitch("warm-up", "GUID-warm-up", 0.0)
+        switch_list.add_switch(warm_up)
+        with lock:
+            total += 1
+        pool.submit([Xbee_coordinator_message(warm_up.MAC, True, 1.0, 120.0)])
+        while not handled[0]:
+            time.sleep(0.01)
+        switch_list.remove_switch(warm_up)
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    for index, batch in enumerate(batches):
+        if "processes" == mode and arguments.kill_worker and len(batches) // 2 == index:
+            os.kill(pool.workers[0].process.pid, signal.SIGKILL)
+        pool.submit(batch)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    pool.stop()
+    totals = {
+        switch.MAC: round(switch.cumulative_power_consumption_kwh, 9)
+        for switch in switch_list.active_switches
+    }
+    return (
+        {
+            "readings/s": readings / elapsed,
+            "hub CPU/reading us": 1e6 * cpu / readings,
+            "hub ceiling/s": readings / cpu,
+        },
+        totals,
+    )
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--switches", type=int, default=2000)
+    parser.add_argument("--readings", type=int, default=100000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument(
+        "--kill-worker", action="store_true", help="kill worker process 0 halfway through"
+    )
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    config.LOG_LEVEL = logging.WARNING
+    batches = make_readings(arguments)
+    print(
+        f"{arguments.readings} readings from {arguments.switches} switches, "
+        f"{os.cpu_count()} CPU(s)"
+    )
+    print(f"{'mode':>10} {'workers':>8} {'readings/s':>11} {'hub CPU/reading us':>19} {'hub ceiling/s':>14}")
+    reference = None
+    for workers in arguments.workers:
+        for mode in ["threads", "processes"]:
+            result, totals = measure(mode, workers, arguments, batches)
+            if reference is None:
+                reference = totals
+            elif totals != reference:
+                print(f"{mode} with {workers} workers: energy totals differ")
+            print(
+                f"{mode:>10} {workers:>8} {result['readings/s']:>11.0f} "
+                f"{result['hub CPU/reading us']:>19.1f} {result['hub ceiling/s']:>14.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Zigbee Worker Pool Benchmark
+
+Feeds readings from SWITCHES plugs, one of which blocks for
+SLOW_SWITCH_DELAY_SECONDS per reading, through Zigbee_worker_pool with one
+worker (the old single processor thread) and with several, and reports
+per-shard queue wait and end-to-end latency. Per-switch ordering is checked.
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config
+import logging
+import time
+from xbee_message_parser import Xbee_coordinator_message
+from zigbee_worker_pool import Zigbee_worker_pool
+
+SWITCHES = 200
+READINGS_PER_SWITCH = 20
+REPORT_INTERVAL_SECONDS = 0.002
+SLOW_SWITCH_DELAY_SECONDS = 0.02
+WORKER_COUNTS = [1, 4, 8]
+
+
+def run(worker_count: int):
+    last_sequence = {}
+    out_of_order = [0]
+    slow_MAC = f"{0:016x}"
+
+    def handle(message: Xbee_coordinator_message):
+        if message.power_draw <= last_sequence.get(message.MAC, -1):
+            out_of_order[0] += 1
+        last_sequence[message.MAC] = message.power_draw
+        if message.MAC == slow_MAC:
+            time.sleep(SLOW_SWITCH_DELAY_SECONDS)
+
+    pool = Zigbee_worker_pool(handle, worker_count)
+    pool.start()
+    start = time.perf_counter()
+    for sequence in range(READINGS_PER_SWITCH):
+        batch = [
+            Xbee_coordinator_message(f"{index:016x}", True, float(sequence), 122.0)
+            for index in range(SWITCHES)
+        ]
+        pool.submit(batch)
+        time.sleep(REPORT_INTERVAL_SECONDS)
+    pool.stop()
+    elapsed = time.perf_counter() - start
+    return elapsed, out_of_order[0], pool.take_stats(), pool.shard_for(slow_MAC)
+
+
+def main():
+    config.LOG_LEVEL = logging.WARNING
+    print(
+        f"{SWITCHES} switches x {READINGS_PER_SWITCH} readings, one switch blocks "
+        f"{SLOW_SWITCH_DELAY_SECONDS * 1000:.0f} ms per reading"
+    )
+    for worker_count in WORKER_COUNTS:
+        elapsed, out_of_order, stats, slow_shard = run(worker_count)
+        print(
+            f"\n{worker_count} worker(s): drained in {elapsed:.2f} s, "
+            f"{out_of_order} out-of-order readings"
+        )
+        print(
+            f"{'shard':>6} {'handled':>8} {'wait mean':>10} {'wait max':>9} "
+            f"{'e2e mean':>9} {'e2e max':>8}  (ms)"
+        )
+        for shard in stats:
+            marker = " <- slow switch" if shard["shard"] == slow_shard else ""
+            print(
+                f"{shard['shard']:>6} {shard['handled']:>8} "
+                f"{shard['queue_wait_mean_ms']:>10.1f} {shard['queue_wait_max_ms']:>9.1f} "
+                f"{shard['end_to_end_mean_ms']:>9.1f} {shard['end_to_end_max_ms']:>8.1f}"
+                f"{marker}"
+            )
+
+
+if __name__ == "__main__":
+    main()
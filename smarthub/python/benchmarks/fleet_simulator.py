@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+"""
+Fleet Simulator
+
+Drives a real SmartHub process with a synthetic fleet of plugs. The hub runs
+as a child process with its serial port pointed at a pty whose other end is
+the simulated coordinator, and with Cayenne pointed at a Local_mqtt_broker,
+so every reading goes through the same serial framing, worker pool and
+telemetry publishing as on the Pi.
+
+Each plug reports every --report-interval seconds. Its power_draw carries a
+per-plug sequence number, so a reading seen on the broker can be matched to
+the moment it was written to the pty. A reading that never reaches the broker
+but is followed by a later one from the same plug was coalesced by the
+Telemetry_publisher; one with no later reading is counted as dropped. Frames
+the pty would not accept without blocking are counted as overruns, like a
+UART with a full receive buffer. --storm-interval sends --storm-size toggle
+commands at once through the broker and times how long each takes to come
+back out of the hub's serial port, and how long until the plug's telemetry
+shows the new state. --command-loss-rate makes the simulated radio lose that
+fraction of commands, so the hub has to notice and send them again. Lines
+carry the coordinator's checksum unless --unframed is given, and --binary
+sends readings as binary telemetry frames rather than text.
+
+    python3 benchmarks/fleet_simulator.py --plugs 500 --report-interval 1 --duration 60
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+HUB_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, HUB_DIRECTORY)
+
+import argparse
+import collections
+import config
+import heapq
+import json
+from local_mqtt_broker import Local_mqtt_broker
+import logging
+import persistent_data_utils
+import random
+import re
+import selectors
+import signal
+from smartswitch import SmartSwitchSerializable
+import subprocess
+import tempfile
+import threading
+import time
+import tty
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from xbee_message_parser import (
+    TELEMETRY_FRAME,
+    TELEMETRY_FRAME_VERSION,
+    TELEMETRY_SEQUENCE_MODULUS,
+)
+
+USERNAME = "fleet-simulator"
+COMMAND_PATTERN = re.compile(rb"([0-9a-f]{16}),(on|off)\n")
+TICK_SECONDS = 0.005
+
+# Runs in the hub's child process: apply the simulator's settings to config
+# and the Cayenne credentials before anything reads them, then start the hub
+# exactly as smarthub.py would.
+HUB_BOOTSTRAP = """
+import json, sys
+settings = json.loads(sys.argv[1])
+sys.path.insert(0, settings["hub_directory"])
+import config, cayenne_credentials
+for name, value in settings["config"].items():
+    setattr(config, name, value)
+for name, value in settings["credentials"].items():
+    setattr(cayenne_credentials, name, value)
+import smarthub
+smarthub.main()
+"""
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(values: List[float]) -> str:
+    return (
+        f"p50 {percentile(values, 0.50) * 1000:6.1f} ms  "
+        f"p99 {percentile(values, 0.99) * 1000:6.1f} ms  "
+        f"max {max(values, default=float('nan')) * 1000:6.1f} ms"
+    )
+
+
+class Simulated_plug:
+    def __init__(self, index: int):
+        self.MAC = f"{0x0013A20000000000 + index:016x}"
+        self.GUID = f"sim-{index:06d}"
+        self.power_state = True
+        self.sequence = 0
+        # (sequence, write time) of readings not yet seen on the broker.
+        self.in_flight: Deque[Tuple[int, float]] = collections.deque()
+        # (requested power_state, publish time) of the newest toggle not yet
+        # reflected in the plug's telemetry.
+        self.awaiting_confirmation: Optional[Tuple[bool, float]] = None
+
+
+class Fleet_simulator:
+    def __init__(self, arguments: argparse.Namespace):
+        self.arguments = arguments
+        self.random = random.Random(arguments.seed)
+        self.plugs = [Simulated_plug(index) for index in range(arguments.plugs)]
+        self.plugs_by_GUID = {plug.GUID: plug for plug in self.plugs}
+        self.plugs_by_MAC = {plug.MAC: plug for plug in self.plugs}
+        self.lock = threading.Lock()
+        self.stopped = False
+        # Cleared after the drain period so a backlog the hub works off while
+        # shutting down is counted as dropped rather than late.
+        self.counting = True
+        self.frames_written = 0
+        self.malformed_written = 0
+        self.overruns = 0
+        self.delivered = 0
+        self.coalesced = 0
+        self.reading_latencies: List[float] = []
+        self.commands_sent = 0
+        self.commands_seen = 0
+        self.commands_lost = 0
+        self.commands_confirmed = 0
+        self.command_latencies: List[float] = []
+        self.confirmation_latencies: List[float] = []
+        self.pending_commands: Dict[str, Deque[float]] = collections.defaultdict(
+            collections.deque
+        )
+
+    def on_publish(self, client_id: str, topic: str, payload: bytes):
+        # Broker thread. Only the batched JSON telemetry carries readings.
+        if not self.counting or not topic.endswith("/data/json"):
+            return
+        now = time.monotonic()
+        plug = self.plugs_by_GUID.get(client_id)
+        if plug is None:
+            return
+        sequence = power_bit = None
+        for channel in json.loads(payload):
+            if config.VIRTUAL_CHANNEL.POWER_DRAW.value == channel["channel"]:
+                sequence = int(round(channel["value"]))
+            elif config.VIRTUAL_CHANNEL.POWER_TOGGLE.value == channel["channel"]:
+                power_bit = channel["value"]
+        if sequence is None:
+            return
+        with self.lock:
+            awaiting = plug.awaiting_confirmation
+            if awaiting is not None and (1 if (awaiting[0]) else 0) == power_bit:
+                plug.awaiting_confirmation = None
+                self.commands_confirmed += 1
+                self.confirmation_latencies.append(now - awaiting[1])
+            while plug.in_flight and plug.in_flight[0][0] <= sequence:
+                in_flight_sequence, written = plug.in_flight.popleft()
+                if in_flight_sequence == sequence:
+                    self.delivered += 1
+                    self.reading_latencies.append(now - written)
+                else:
+                    self.coalesced += 1
+
+    def frame(self, plug: Simulated_plug) -> bytes:
+        # power_state "0" means on, matching xbee_message_to_object.
+        plug.sequence += 1
+        if self.arguments.binary:
+            # Relayed as hex by the coordinator, like plug.py's frames.
+            frame = TELEMETRY_FRAME.pack(
+                TELEMETRY_FRAME_VERSION,
+                0 if plug.power_state else 1,
+                (plug.sequence - 1) % TELEMETRY_SEQUENCE_MODULUS + 1,
+                100 * plug.sequence,
+                12000 + self.random.randrange(100),
+            )
+            line = f"{plug.MAC},{frame.hex()}".encode()
+        else:
+            line = (
+                f"{plug.MAC},{0 if plug.power_state else 1},"
+                f"{plug.sequence}.0,{120.0 + self.random.random():.4f}"
+            ).encode()
+        if self.arguments.unframed:
+            return line + b"\n"
+        # "*<checksum>" as the coordinator firmware appends it.
+        return line + b"*%02x\n" % (0xFF - (sum(line) & 0xFF))
+
+    def malformed_frame(self) -> bytes:
+        plug = self.random.choice(self.plugs)
+        return self.random.choice(
+            [
+                f"{plug.MAC},Config Success\n".encode(),
+                f"{plug.MAC},1,12.\n".encode(),
+                f"{plug.MAC},x,1.0,120.0\n".encode(),
+                bytes(self.random.getrandbits(8) | 0x80 for _ in range(24)) + b"\n",
+            ]
+        )
+
+    def coordinator_writer_thread(self, master_fd: int):
+        interval = self.arguments.report_interval
+        start = time.monotonic()
+        schedule = [
+            (start + interval * index / len(self.plugs), index)
+            for index in range(len(self.plugs))
+        ]
+        heapq.heapify(schedule)
+        # Set when an overrun left a partial line in the pty.
+        needs_newline = False
+        while not self.stopped:
+            now = time.monotonic()
+            chunk = bytearray(b"\n" if (needs_newline) else b"")
+            # (plug, sequence, offset just past the frame's newline)
+            frames: List[Tuple[Simulated_plug, int, int]] = []
+            malformed = 0
+            while schedule and schedule[0][0] <= now:
+                due, index = heapq.heappop(schedule)
+                heapq.heappush(schedule, (due + interval, index))
+                if self.random.random() < self.arguments.malformed_rate:
+                    chunk += self.malformed_frame()
+                    malformed += 1
+                    continue
+                plug = self.plugs[index]
+                chunk += self.frame(plug)
+                frames.append((plug, plug.sequence, len(chunk)))
+            if len(chunk) > (1 if (needs_newline) else 0):
+                needs_newline = self.write_frames(master_fd, chunk, frames, malformed)
+            time.sleep(TICK_SECONDS)
+
+    def write_frames(self, master_fd: int, chunk: bytearray, frames, malformed: int) -> bool:
+        """Returns True if a partial line was left in the pty."""
+        try:
+            written = os.write(master_fd, chunk)
+        except BlockingIOError:
+            written = 0
+        now = time.monotonic()
+        with self.lock:
+            self.malformed_written += malformed
+            for plug, sequence, end in frames:
+                # Like a UART overrun, whatever the pty did not take is lost.
+                if end <= written:
+                    plug.in_flight.append((sequence, now))
+                    self.frames_written += 1
+                else:
+                    self.overruns += 1
+        if 0 == written:
+            return chunk.startswith(b"\n")
+        return written < len(chunk) and chunk[written - 1] != ord("\n")
+
+    def serial_command_reader_thread(self, master_fd: int):
+        # The hub writes one "MAC,on" / "MAC,off" command per line.
+        selector = selectors.DefaultSelector()
+        selector.register(master_fd, selectors.EVENT_READ)
+        buffer = bytearray()
+        while not self.stopped:
+            if not selector.select(timeout=0.2):
+                continue
+            try:
+                buffer += os.read(master_fd, 65536)
+            except (BlockingIOError, OSError):
+                continue
+            now = time.monotonic()
+            last_end = 0
+            for match in COMMAND_PATTERN.finditer(buffer):
+                last_end = match.end()
+                plug = self.plugs_by_MAC.get(match.group(1).decode())
+                if plug is None:
+                    continue
+                with self.lock:
+                    pending = self.pending_commands[plug.GUID]
+                    if pending:
+                        self.commands_seen += 1
+                        self.command_latencies.append(now - pending.popleft())
+                    if self.random.random() < self.arguments.command_loss_rate:
+                        self.commands_lost += 1
+                        continue
+                plug.power_state = b"on" == match.group(2)
+            del buffer[:last_end]
+            if len(buffer) > 4096:
+                del buffer[:-64]
+
+    def toggle_storm_thread(self, broker: Local_mqtt_broker):
+        channel = config.VIRTUAL_CHANNEL.POWER_TOGGLE.value
+        message_id = 0
+        while not self.stopped:
+            time.sleep(self.arguments.storm_interval)
+            if self.stopped:
+                return
+            for plug in self.random.sample(
+                self.plugs, min(self.arguments.storm_size, len(self.plugs))
+            ):
+                message_id += 1
+                value = 0 if (plug.power_state) else 1
+                with self.lock:
+                    now = time.monotonic()
+                    self.pending_commands[plug.GUID].append(now)
+                    self.commands_sent += 1
+                    plug.awaiting_confirmation = (1 == value, now)
+                broker.publish(
+                    f"v1/{USERNAME}/things/{plug.GUID}/cmd/{channel}",
+                    f"{message_id},{value}".encode(),
+                )
+
+    def seed_persistent_data(self, directory: str) -> str:
+        filename = os.path.join(directory, "homegrid_persistent_data.bin")
+        config.PERSISTENT_DATA_FILENAME = filename
+        persistent_data_utils.dump(
+            [
+                SmartSwitchSerializable(plug.MAC, plug.GUID, time.time(), True, 0.0, 0.0)
+                for plug in self.plugs
+            ],
+            logging.getLogger(__name__),
+        )
+        return filename
+
+    def start_hub(
+        self,
+        directory: str,
+        serial_port: str,
+        broker: Local_mqtt_broker,
+        config_overrides: Optional[Dict[str, Any]] = None,
+        broker_address: Optional[Tuple[str, int]] = None,
+    ):
+        host, port = (broker.host, broker.port) if broker_address is None else broker_address
+        settings = {
+            "hub_directory": os.path.abspath(HUB_DIRECTORY),
+            "config": {
+                "LOG_LEVEL": logging.WARNING,
+                "PERSISTENT_DATA_FILENAME": self.seed_persistent_data(directory),
+                "ARCHIVE_FILENAME": os.path.join(directory, "archive.sqlite3"),
+                "SERIAL_PORT": serial_port,
+                "ZIGBEE_WORKER_COUNT": self.arguments.workers,
+                "ZIGBEE_WORKER_MODE": self.arguments.worker_mode,
+                "HUB_RUNTIME": self.arguments.runtime,
+                "METRICS_PORT": 0,
+            },
+            "credentials": {
+                "MQTT_USERNAME": USERNAME,
+                "MQTT_PASSWORD": "password",
+                "MQTT_HOSTNAME": host,
+                "MQTT_PORT": port,
+            },
+        }
+        settings["config"].update(config_overrides or {})
+        self.hub_log = open(os.path.join(directory, "hub.log"), "wb")
+        # The Cayenne library prints every connect and publish; keep only
+        # the hub's own log.
+        return subprocess.Popen(
+            [sys.executable, "-c", HUB_BOOTSTRAP, json.dumps(settings)],
+            stdout=subprocess.DEVNULL,
+            stderr=self.hub_log,
+        )
+
+    def wait_for_connections(self, broker: Local_mqtt_broker, hub: subprocess.Popen):
+        deadline = time.monotonic() + self.arguments.connect_timeout
+        while len(broker.connected_client_ids()) < len(self.plugs):
+            if hub.poll() is not None:
+                raise RuntimeError(f"Hub Exited with {hub.returncode} during Start-up")
+            if time.monotonic() > deadline:
+                raise RuntimeError(
+                    f"Only {len(broker.connected_client_ids())} of {len(self.plugs)} "
+                    f"Plugs Connected"
+                )
+            time.sleep(0.1)
+
+    def snapshot(self) -> Tuple[int, int, int, int, int, int, int]:
+        with self.lock:
+            return (
+                self.frames_written,
+                self.delivered,
+                self.coalesced,
+                self.overruns,
+                len(self.reading_latencies),
+                self.commands_seen,
+                self.commands_confirmed,
+            )
+
+    def run(self) -> int:
+        arguments = self.arguments
+        with tempfile.TemporaryDirectory(prefix="homegrid-fleet-") as directory:
+            master_fd, slave_fd = os.openpty()
+            tty.setraw(slave_fd)
+            os.set_blocking(master_fd, False)
+            broker = Local_mqtt_broker(on_publish=self.on_publish).start()
+            start_time = time.monotonic()
+            hub = self.start_hub(directory, os.ttyname(slave_fd), broker)
+            try:
+                self.wait_for_connections(broker, hub)
+                print(
+                    f"{len(self.plugs)} plugs connected in "
+                    f"{time.monotonic() - start_time:.1f} s; "
+                    f"offering {len(self.plugs) / arguments.report_interval:.0f} readings/s"
+                )
+                threads = [
+                    threading.Thread(target=self.coordinator_writer_thread, args=(master_fd,)),
+                    threading.Thread(target=self.serial_command_reader_thread, args=(master_fd,)),
+                ]
+                if arguments.storm_interval > 0:
+                    threads.append(threading.Thread(target=self.toggle_storm_thread, args=(broker,)))
+                for thread in threads:
+                    thread.start()
+                self.report(hub)
+                self.stopped = True
+                for thread in threads:
+                    thread.join()
+                # Let in-flight readings reach the broker before counting drops.
+                time.sleep(arguments.drain_seconds)
+            finally:
+                self.stopped = True
+                self.counting = False
+                hub.send_signal(signal.SIGINT)
+                try:
+                    hub.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    hub.kill()
+                    hub.wait()
+                broker.stop()
+                os.close(master_fd)
+                os.close(slave_fd)
+                self.hub_log.close()
+                with open(os.path.join(directory, "hub.log"), "rb") as log:
+                    hub_errors = log.read().decode(errors="replace").splitlines()
+            self.summarize(hub_errors)
+        return 0
+
+    def report(self, hub: subprocess.Popen):
+        print(
+            f"{'t':>5} {'written/s':>10} {'published/s':>12} {'coalesced/s':>12} "
+            f"{'overruns/s':>11} {'reading latency':>42} {'commands':>9} {'confirmed':>10}"
+        )
+        previous = self.snapshot()
+        previous_latencies = 0
+        for second in range(1, self.arguments.duration + 1):
+            time.sleep(1.0)
+            if hub.poll() is not None:
+                print(f"Hub Exited with {hub.returncode}")
+                return
+            current = self.snapshot()
+            with self.lock:
+                latencies = self.reading_latencies[previous_latencies:]
+            previous_latencies = current[4]
+            print(
+                f"{second:>5} {current[0] - previous[0]:>10} {current[1] - previous[1]:>12} "
+                f"{current[2] - previous[2]:>12} {current[3] - previous[3]:>11} "
+                f"{latency_summary(latencies):>42} {current[5] - previous[5]:>9} "
+                f"{current[6] - previous[6]:>10}"
+            )
+            previous = current
+
+    def summarize(self, hub_errors: List[str]):
+        dropped = sum(len(plug.in_flight) for plug in self.plugs)
+        duration = self.arguments.duration
+        print()
+        print(f"{'frames written':>24}: {self.frames_written} ({self.frames_written / duration:.0f}/s)")
+        print(f"{'malformed frames':>24}: {self.malformed_written}")
+        print(f"{'pty overruns':>24}: {self.overruns}")
+        print(f"{'published':>24}: {self.delivered} ({self.delivered / duration:.0f}/s)")
+        print(f"{'coalesced':>24}: {self.coalesced}")
+        print(f"{'dropped':>24}: {dropped}")
+        print(f"{'reading latency':>24}: {latency_summary(self.reading_latencies)}")
+        print(
+            f"{'commands':>24}: {self.commands_seen}/{self.commands_sent} reached the serial port"
+        )
+        if self.command_latencies:
+            print(f"{'command latency':>24}: {latency_summary(self.command_latencies)}")
+        print(f"{'lost by the radio':>24}: {self.commands_lost}")
+        print(
+            f"{'confirmed':>24}: {self.commands_confirmed}/{self.commands_sent} "
+            f"shown in telemetry"
+        )
+        if self.confirmation_latencies:
+            print(
+                f"{'confirmation latency':>24}: {latency_summary(self.confirmation_latencies)}"
+            )
+        print(f"{'hub log lines':>24}: {len(hub_errors)}")
+        for line in hub_errors[-5:]:
+            print(f"{'':>26}{line}")
+
+
+def parse_arguments(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--plugs", type=int, default=100)
+    parser.add_argument("--report-interval", type=float, default=1.0, help="seconds between readings of one plug")
+    parser.add_argument("--duration", type=int, default=30, help="seconds of load after all plugs connect")
+    parser.add_argument("--malformed-rate", type=float, default=0.01, help="fraction of frames that are malformed")
+    parser.add_argument("--storm-interval", type=float, default=10.0, help="seconds between toggle storms, 0 to disable")
+    parser.add_argument("--storm-size", type=int, default=50, help="toggle commands per storm")
+    parser.add_argument("--command-loss-rate", type=float, default=0.0, help="fraction of commands the radio loses")
+    parser.add_argument("--binary", action="store_true", help="send binary telemetry frames instead of text readings")
+    parser.add_argument("--unframed", action="store_true", help="send lines without checksums, as older coordinator firmware did")
+    parser.add_argument("--workers", type=int, default=config.ZIGBEE_WORKER_COUNT)
+    parser.add_argument("--worker-mode", choices=["threads", "processes"], default=config.ZIGBEE_WORKER_MODE)
+    parser.add_argument("--runtime", choices=["threads", "asyncio"], default=config.HUB_RUNTIME)
+    parser.add_argument("--connect-timeout", type=float, default=120.0)
+    parser.add_argument("--drain-seconds", type=float, default=3.0)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    config.LOG_LEVEL = logging.WARNING
+    sys.exit(Fleet_simulator(parse_arguments()).run())
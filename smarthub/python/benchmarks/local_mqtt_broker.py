@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Local MQTT Broker Stand-in
+
+A minimal single-threaded MQTT 3.1.1 broker for benchmarks and the fleet
+simulator. It accepts any credentials, routes QoS 0/1 publishes to matching
+subscriptions (with + and # wildcards) and reports every publish it receives
+to an optional callback. It is not a real broker: no retained messages, no
+sessions, no QoS 2.
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import selectors
+import socket
+import struct
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+SUBSCRIBE = 0x80
+SUBACK = 0x90
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+def encode_remaining_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+def encode_publish(topic: str, payload: bytes) -> bytes:
+    topic_bytes = topic.encode()
+    body = struct.pack("!H", len(topic_bytes)) + topic_bytes + payload
+    return bytes([PUBLISH]) + encode_remaining_length(len(body)) + body
+
+
+def topic_matches(subscription: str, topic: str) -> bool:
+    subscription_levels = subscription.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(subscription_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(subscription_levels) == len(topic_levels)
+
+
+class Broker_connection:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.client_id = ""
+        self.subscriptions: List[str] = []
+        self.in_buffer = bytearray()
+        self.out_buffer = bytearray()
+
+
+class Local_mqtt_broker:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        on_publish: Optional[Callable[[str, str, bytes], None]] = None,
+    ):
+        self.on_publish = on_publish
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1024)
+        self.listener.setblocking(False)
+        self.host, self.port = self.listener.getsockname()
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ, "wake")
+        self.connections: Dict[socket.socket, Broker_connection] = {}
+        self.outgoing_lock = threading.Lock()
+        self.outgoing: List[Tuple[str, bytes]] = []
+        self.stopped = False
+        self.thread = threading.Thread(target=self.__serve, daemon=True)
+
+    def start(self) -> "Local_mqtt_broker":
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        self.wake_writer.send(b"x")
+        self.thread.join()
+        for connection in list(self.connections.values()):
+            connection.sock.close()
+        self.listener.close()
+
+    def connected_client_ids(self) -> List[str]:
+        return [connection.client_id for connection in list(self.connections.values())]
+
+    def publish(self, topic: str, payload: bytes):
+        # Thread-safe: queue the message and let the broker thread route it.
+        with self.outgoing_lock:
+            self.outgoing.append((topic, payload))
+        self.wake_writer.send(b"x")
+
+    def __serve(self):
+        while not self.stopped:
+            for key, mask in self.selector.select(timeout=1.0):
+                if key.data is None:
+                    self.__accept()
+                elif key.data == "wake":
+                    try:
+                        self.wake_reader.recv(65536)
+                    except BlockingIOError:
+                        pass
+                    self.__route_outgoing()
+                else:
+                    connection: Broker_connection = key.data
+                    if mask & selectors.EVENT_READ:
+                        self.__read(connection)
+                    if mask & selectors.EVENT_WRITE and connection.sock in self.connections:
+                        self.__flush(connection)
+
+    def __accept(self):
+        try:
+            sock, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = Broker_connection(sock)
+        self.connections[sock] = connection
+        self.selector.register(sock, selectors.EVENT_READ, connection)
+
+    def __close(self, connection: Broker_connection):
+        self.connections.pop(connection.sock, None)
+        try:
+            self.selector.unregister(connection.sock)
+        except (KeyError, ValueError):
+            pass
+        connection.sock.close()
+
+    def __send(self, connection: Broker_connection, data: bytes):
+        connection.out_buffer += data
+        self.__flush(connection)
+
+    def __flush(self, connection: Broker_connection):
+        try:
+            sent = connection.sock.send(connection.out_buffer)
+            del connection.out_buffer[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.__close(connection)
+            return
+        events = selectors.EVENT_READ
+        if connection.out_buffer:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(connection.sock, events, connection)
+
+    def __read(self, connection: Broker_connection):
+        try:
+            data = connection.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.__close(connection)
+            return
+        connection.in_buffer += data
+        while True:
+            packet = self.__next_packet(connection)
+            if packet is None:
+                return
+            self.__handle(connection, *packet)
+            if connection.sock not in self.connections:
+                return
+
+    @staticmethod
+    def __next_packet(connection: Broker_connection):
+        buffer = connection.in_buffer
+        if len(buffer) < 2:
+            return None
+        multiplier, length, index = 1, 0, 1
+        while True:
+            if index >= len(buffer):
+                return None
+            byte = buffer[index]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            index += 1
+            if not byte & 0x80:
+                break
+        if len(buffer) < index + length:
+            return None
+        header = buffer[0]
+        body = bytes(buffer[index : index + length])
+        del buffer[: index + length]
+        return header, body
+
+    def __handle(self, connection: Broker_connection, header: int, body: bytes):
+        packet_type = header & 0xF0
+        if packet_type == CONNECT:
+            protocol_length = struct.unpack_from("!H", body, 0)[0]
+            offset = 2 + protocol_length + 4
+            client_id_length = struct.unpack_from("!H", body, offset)[0]
+            connection.client_id = body[offset + 2 : offset + 2 + client_id_length].decode()
+            self.__send(connection, bytes([CONNACK, 2, 0, 0]))
+        elif packet_type == SUBSCRIBE:
+            packet_id = body[:2]
+            offset = 2
+            granted = bytearray()
+            while offset < len(body):
+                topic_length = struct.unpack_from("!H", body, offset)[0]
+                topic = body[offset + 2 : offset + 2 + topic_length].decode()
+                connection.subscriptions.append(topic)
+                offset += 2 + topic_length + 1
+                granted.append(0)
+            payload = packet_id + bytes(granted)
+            self.__send(connection, bytes([SUBACK, len(payload)]) + payload)
+        elif packet_type == PUBLISH:
+            qos = (header >> 1) & 0x03
+            topic_length = struct.unpack_from("!H", body, 0)[0]
+            topic = body[2 : 2 + topic_length].decode()
+            offset = 2 + topic_length
+            if qos:
+                packet_id = body[offset : offset + 2]
+                offset += 2
+                self.__send(connection, bytes([PUBACK, 2]) + packet_id)
+            payload = body[offset:]
+            if self.on_publish is not None:
+                self.on_publish(connection.client_id, topic, payload)
+            self.__route(topic, payload)
+        elif packet_type == PINGREQ:
+            self.__send(connection, bytes([PINGRESP, 0]))
+        elif packet_type == DISCONNECT:
+            self.__close(connection)
+
+    def __route_outgoing(self):
+        with self.outgoing_lock:
+            outgoing, self.outgoing = self.outgoing, []
+        for topic, payload in outgoing:
+            self.__route(topic, payload)
+
+    def __route(self, topic: str, payload: bytes):
+        packet = None
+        for connection in list(self.connections.values()):
+            for subscription in connection.subscriptions:
+                if topic_matches(subscription, topic):
+                    if packet is None:
+                        packet = encode_publish(topic, payload)
+                    self.__send(connection, packet)
+                    break
+
+
+if __name__ == "__main__":
+    import time
+
+    broker = Local_mqtt_broker(port=1883).start()
+    print(f"Listening on {broker.host}:{broker.port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        broker.stop()
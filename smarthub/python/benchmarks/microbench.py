@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Hot Path Microbenchmarks
+
+Times the hub's per-reading and per-save paths at fleet sizes from 10 to
+100k and compares them with a stored baseline:
+
+    python3 benchmarks/microbench.py                      # run and compare
+    python3 benchmarks/microbench.py --save-baseline      # record a new baseline
+    python3 benchmarks/microbench.py --filter get_switch  # only matching cases
+
+Each case is calibrated to run for at least MIN_REPEAT_SECONDS, repeated
+REPEATS times, and reported as the fastest repeat per operation, which is the
+figure least disturbed by other load on the machine. A case slower than the
+baseline by more than --threshold is measured again (CONFIRM_RUNS) and, if
+still slow, reported as a regression that makes the script exit non-zero.
+Baselines only mean something on the machine that recorded them; re-record
+after changing hardware or Python.
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from active_switch_list import Active_switch_list
+import argparse
+from cayenne.client import CayenneMessage
+import cayenne_message_parser
+import config
+import contextlib
+import itertools
+import json
+import logging
+import metrics
+import persistent_data_utils
+import platform
+import random
+from smartswitch import SmartSwitch, smart_switch_to_serializable
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from unknown_switches import Unknown_MAC_cache
+from xbee_message_parser import xbee_message_to_object
+
+BASELINE_FILENAME = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "microbench_baseline.json"
+)
+FLEET_SIZES = [10, 1_000, 10_000, 100_000]
+MIN_REPEAT_SECONDS = 0.2
+REPEATS = 7
+# A case that looks like a regression is measured again this many times, and
+# the fastest measurement kept, before it is reported.
+CONFIRM_RUNS = 2
+
+# A case takes a fleet size and returns a function that runs the operation
+# `loops` times.
+Case = Callable[[int], Callable[[int], None]]
+
+
+class Stub_mqtt_client:
+    """Stands in for CayenneMQTTClient; handle_serial_message only carries it."""
+
+    connected = True
+    rootTopic = "v1/bench/things/stub"
+
+
+class Stub_paho_message:
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
+
+
+def make_switches(fleet_size: int) -> List[SmartSwitch]:
+    return [SmartSwitch(f"{i:016x}", f"GUID-{i:08d}") for i in range(fleet_size)]
+
+
+def make_switch_list(fleet_size: int) -> Active_switch_list:
+    switch_list = Active_switch_list()
+    switch_list.add_switches(make_switches(fleet_size))
+    return switch_list
+
+
+def bench_xbee_message_to_object(fleet_size: int):
+    lines = [
+        f"{i % fleet_size:016x},{i & 1},{13.0 + (i % 97) / 10:.4f},{122.0 + (i % 13) / 10:.4f}"
+        for i in range(1024)
+    ]
+
+    def run(loops: int):
+        for line in itertools.islice(itertools.cycle(lines), loops):
+            xbee_message_to_object(line)
+
+    return run
+
+
+def bench_cayenne_message_to_object(fleet_size: int):
+    messages = [
+        CayenneMessage(
+            Stub_paho_message(
+                f"v1/bench/things/GUID-{i % fleet_size:08d}/cmd/"
+                f"{config.VIRTUAL_CHANNEL.POWER_TOGGLE.value}",
+                f"msg-{i},{i & 1}".encode(),
+            )
+        )
+        for i in range(1024)
+    ]
+
+    def run(loops: int):
+        for message in itertools.islice(itertools.cycle(messages), loops):
+            cayenne_message_parser.cayenne_message_to_object(message)
+
+    return run
+
+
+def bench_handle_serial_message(fleet_size: int):
+    switch_list = make_switch_list(fleet_size)
+    client = Stub_mqtt_client()
+    for switch in switch_list.active_switches:
+        switch.client = client
+    rng = random.Random(1)
+    pairs = []
+    for i in range(1024):
+        switch = switch_list.active_switches[rng.randrange(fleet_size)]
+        message = xbee_message_to_object(f"{switch.MAC},{i & 1},{13.0 + i % 7},122.0")
+        pairs.append((switch, message))
+    # Allocate the histories the way a running hub already would have.
+    for switch, message in pairs:
+        switch.handle_serial_message(message)
+
+    def run(loops: int):
+        for switch, message in itertools.islice(itertools.cycle(pairs), loops):
+            message.timestamp += 1.0
+            switch.handle_serial_message(message)
+
+    return run
+
+
+def bench_get_switch_from_MAC(fleet_size: int):
+    switch_list = make_switch_list(fleet_size)
+    rng = random.Random(1)
+    keys = [f"{rng.randrange(fleet_size):016x}" for _ in range(1024)]
+
+    def run(loops: int):
+        lookup = switch_list.get_switch_from_MAC
+        for key in itertools.islice(itertools.cycle(keys), loops):
+            lookup(key)
+
+    return run
+
+
+def bench_get_switch_from_GUID(fleet_size: int):
+    switch_list = make_switch_list(fleet_size)
+    rng = random.Random(1)
+    keys = [f"GUID-{rng.randrange(fleet_size):08d}" for _ in range(1024)]
+
+    def run(loops: int):
+        lookup = switch_list.get_switch_from_GUID
+        for key in itertools.islice(itertools.cycle(keys), loops):
+            lookup(key)
+
+    return run
+
+
+def bench_unknown_MAC_record(fleet_size: int):
+    unknown_MACs = Unknown_MAC_cache()
+    keys = [f"{0xFFFF000000000000 + i:016x}" for i in range(fleet_size)]
+    for key in keys:
+        unknown_MACs.record(key)
+
+    def run(loops: int):
+        record = unknown_MACs.record
+        for key in itertools.islice(itertools.cycle(keys), loops):
+            record(key)
+
+    return run
+
+
+def bench_persistent_dump(fleet_size: int):
+    snapshots = [smart_switch_to_serializable(s) for s in make_switches(fleet_size)]
+
+    def run(loops: int):
+        for _ in range(loops):
+            persistent_data_utils.dump(snapshots, None)
+
+    return run
+
+
+def bench_persistent_load(fleet_size: int):
+    persistent_data_utils.dump(
+        [smart_switch_to_serializable(s) for s in make_switches(fleet_size)], None
+    )
+
+    def run(loops: int):
+        for _ in range(loops):
+            persistent_data_utils.load(None)
+
+    return run
+
+
+def bench_histogram_observe(fleet_size: int):
+    histogram = metrics.Histogram("bench_seconds", "Benchmark histogram.")
+    rng = random.Random(1)
+    values = [rng.lognormvariate(-7.0, 2.0) for _ in range(1024)]
+
+    def run(loops: int):
+        observe = histogram.observe
+        for value in itertools.islice(itertools.cycle(values), loops):
+            observe(value)
+
+    return run
+
+
+CASES: Dict[str, Tuple[Case, List[int]]] = {
+    "xbee_message_to_object": (bench_xbee_message_to_object, [FLEET_SIZES[0]]),
+    "cayenne_message_to_object": (bench_cayenne_message_to_object, [FLEET_SIZES[0]]),
+    "handle_serial_message": (bench_handle_serial_message, FLEET_SIZES),
+    "get_switch_from_MAC": (bench_get_switch_from_MAC, FLEET_SIZES),
+    "get_switch_from_GUID": (bench_get_switch_from_GUID, FLEET_SIZES),
+    "Unknown_MAC_cache.record": (bench_unknown_MAC_record, [FLEET_SIZES[0]]),
+    "persistent_data_utils.dump": (bench_persistent_dump, FLEET_SIZES),
+    "persistent_data_utils.load": (bench_persistent_load, FLEET_SIZES),
+    "metrics.Histogram.observe": (bench_histogram_observe, [FLEET_SIZES[0]]),
+}
+
+
+def measure(run: Callable[[int], None]) -> float:
+    """Returns the fastest of REPEATS runs, in seconds per operation."""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        run(loops)
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_REPEAT_SECONDS:
+            break
+        loops *= max(2, min(10, int(MIN_REPEAT_SECONDS / max(elapsed, 1e-9))))
+    best = elapsed / loops
+    for _ in range(REPEATS - 1):
+        start = time.perf_counter()
+        run(loops)
+        best = min(best, (time.perf_counter() - start) / loops)
+    return best
+
+
+def run_cases(
+    name_filter: str, limits: Optional[Dict[str, float]] = None
+) -> Dict[str, float]:
+    """
+    Runs every case whose name contains name_filter. A result above its entry
+    in limits is re-measured before being accepted.
+    """
+    limits = limits or {}
+    results = {}
+    for name, (case, fleet_sizes) in CASES.items():
+        if name_filter not in name:
+            continue
+        for fleet_size in fleet_sizes:
+            key = f"{name}[{fleet_size}]"
+            run = case(fleet_size)
+            results[key] = measure(run)
+            for _ in range(CONFIRM_RUNS):
+                if results[key] <= limits.get(key, float("inf")):
+                    break
+                results[key] = min(results[key], measure(run))
+            print(f"{key:>40}: {format_duration(results[key]):>10}", file=sys.stderr)
+    return results
+
+
+def format_duration(seconds: float) -> str:
+    if seconds < 1e-6:
+        return f"{seconds * 1e9:.0f} ns"
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.2f} us"
+    if seconds < 1.0:
+        return f"{seconds * 1e3:.2f} ms"
+    return f"{seconds:.2f} s"
+
+
+def machine_description() -> Dict[str, str]:
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": str(os.cpu_count()),
+    }
+
+
+def compare(results: Dict[str, float], baseline: Dict, threshold: float) -> int:
+    if baseline["machine"] != machine_description():
+        print(f"Baseline was Recorded on {baseline['machine']}; Ratios are Indicative Only")
+    regressions = 0
+    print(f"{'case':>40} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for key, current in results.items():
+        previous = baseline["results"].get(key)
+        if previous is None:
+            print(f"{key:>40} {'-':>10} {format_duration(current):>10} {'new':>7}")
+            continue
+        ratio = current / previous
+        flag = ""
+        if ratio > 1.0 + threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        elif ratio < 1.0 / (1.0 + threshold):
+            flag = "  faster"
+        print(
+            f"{key:>40} {format_duration(previous):>10} {format_duration(current):>10} "
+            f"{ratio:>6.2f}x{flag}"
+        )
+    print(f"{regressions} Regressions beyond {threshold:.0%}")
+    return regressions
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Hot path microbenchmarks")
+    parser.add_argument("--filter", default="", help="only run cases containing this text")
+    parser.add_argument("--baseline", default=BASELINE_FILENAME)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--threshold", type=float, default=0.25, help="slowdown reported as a regression"
+    )
+    return parser.parse_args()
+
+
+def main() -> int:
+    arguments = parse_arguments()
+    config.LOG_LEVEL = logging.WARNING
+    baseline = None
+    if os.path.exists(arguments.baseline):
+        with open(arguments.baseline) as fh:
+            baseline = json.load(fh)
+    limits = {}
+    if baseline is not None and not arguments.save_baseline:
+        limits = {
+            key: previous * (1.0 + arguments.threshold)
+            for key, previous in baseline["results"].items()
+        }
+    with tempfile.TemporaryDirectory(prefix="homegrid-microbench-") as directory:
+        config.PERSISTENT_DATA_FILENAME = os.path.join(directory, "state.bin")
+        # SmartSwitch.acquire_lock and the Cayenne library print.
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results = run_cases(arguments.filter, limits)
+
+    if arguments.save_baseline:
+        baseline = baseline or {}
+        merged = dict(baseline.get("results", {}))
+        merged.update(results)
+        with open(arguments.baseline, "w") as fh:
+            json.dump(
+                {"machine": machine_description(), "results": merged}, fh, indent=2, sort_keys=True
+            )
+            fh.write("\n")
+        print(f"Saved {len(results)} Results to {arguments.baseline}")
+        return 0
+
+    if baseline is None:
+        print(f"No Baseline at {arguments.baseline}; Run with --save-baseline First")
+        return 0
+    return 1 if compare(results, baseline, arguments.threshold) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,6 +9,7 @@ __version__ = "1.0.0"
 
 MQTT_USERNAME = "XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX"
 MQTT_PASSWORD = "XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX"
+MQTT_HOSTNAME = "mqtt.mydevices.com"
 MQTT_PORT = 8883
 
 CLIENT_ID_LIST = [
@@ -8,12 +8,14 @@ __version__ = "1.0.0"
 
 
 from cayenne.client import CayenneMessage
-from config import VIRTUAL_CHANNEL, LOGGING_FORMAT, LOG_LEVEL
-import logging
+from config import VIRTUAL_CHANNEL
+import homegrid_logger
 from typing import Optional
 
 
 class Cayenne_switch_message:
+    __slots__ = ("GUID", "topic", "channel", "message_id", "power_state")
+
     def __init__(
         self,
         GUID: str,
@@ -56,15 +58,18 @@ def cayenne_message_to_object(
         return None
 
 
+logger = homegrid_logger.Logger(__name__)
+
+
 def print_message(message: Cayenne_switch_message):
-    logger = logging.getLogger(__name__)
-    logging.basicConfig(format=LOGGING_FORMAT)
-    logger.setLevel(LOG_LEVEL)
-    logger.debug(f"TEST: GUID: {message.GUID}")
-    logger.debug(f"TEST: topic: {message.topic}")
-    logger.debug(f"TEST: channel: {message.channel}")
-    logger.debug(f"TEST: message_id: {message.message_id}")
-    logger.debug(f"TEST: Power State: {message.power_state}")
+    logger.debug(
+        "Cayenne Message: GUID %s, topic %s, channel %s, message_id %s, Power State %s",
+        message.GUID,
+        message.topic,
+        message.channel,
+        message.message_id,
+        message.power_state,
+    )
 
 
 def __test(message: CayenneMessage):
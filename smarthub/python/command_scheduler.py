@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Command Scheduler Module
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import config
+import heapq
+import homegrid_logger
+import itertools
+import metrics
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+def command_frame(MAC: str, power_state: bool) -> bytes:
+    # One command per line so the coordinator can split a read holding
+    # several.
+    return f"{MAC},{'on' if (power_state) else 'off'}\n".encode()
+
+
+class Switch_command:
+    __slots__ = (
+        "MAC",
+        "power_state",
+        "requested_time",
+        "attempts",
+        "first_sent_timestamp",
+        "due_time",
+    )
+
+    def __init__(self, MAC: str, power_state: bool, requested_time: float):
+        self.MAC = MAC
+        self.power_state = power_state
+        # time.monotonic() of the request the latency is measured from.
+        self.requested_time = requested_time
+        self.attempts = 0
+        # time.time() of the first write, comparable with reading timestamps.
+        self.first_sent_timestamp = 0.0
+        self.due_time = requested_time
+
+
+class Command_scheduler:
+    """
+    Sends power commands to the coordinator and confirms them against the
+    power_state the plugs report. write(MAC, frame) puts a command on the
+    serial port of the coordinator that reaches the switch.
+
+    At most one command per switch is outstanding and the newest request
+    wins, so a burst of dashboard clicks becomes one write. Writes are paced
+    to COMMAND_WRITES_PER_SECOND. A command is confirmed by the first reading
+    from its switch, parsed after it was sent, that shows the requested
+    state; until then it is re-sent after COMMAND_ACK_TIMEOUT_SECONDS,
+    growing by COMMAND_RETRY_BACKOFF each time, and abandoned after
+    COMMAND_MAX_ATTEMPTS writes.
+    """
+
+    def __init__(self, write):
+        self.logger = homegrid_logger.Logger(__name__)
+        self.write = write
+        self.condition = threading.Condition()
+        self.commands: Dict[str, Switch_command] = {}
+        # (due time, tie-breaker, MAC); entries whose due time no longer
+        # matches their command are stale and skipped.
+        self.due: List[Tuple[float, int, str]] = []
+        self.sequence = itertools.count()
+        self.next_write_time = 0.0
+        self.stop_requested = False
+        self.thread: Optional[threading.Thread] = None
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.requested = 0
+        self.coalesced = 0
+        self.written = 0
+        self.retried = 0
+        self.confirmed = 0
+        self.failed = 0
+        self.confirm_latency_total = 0.0
+        self.confirm_latency_max = 0.0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__scheduler_thread, name="command-scheduler")
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stop_requested = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        if self.commands:
+            self.logger.warning("Dropped %d Unconfirmed Commands", len(self.commands))
+
+    def pending(self) -> int:
+        return len(self.commands)
+
+    def request(self, MAC: str, power_state: bool):
+        now = time.monotonic()
+        metrics.COMMANDS_REQUESTED.inc()
+        with self.condition:
+            command = self.commands.get(MAC)
+            with self.stats_lock:
+                self.requested += 1
+                if command is not None:
+                    self.coalesced += 1
+            if command is not None:
+                metrics.COMMANDS_COALESCED.inc()
+                if 0 == command.attempts:
+                    # Not written yet; keep its place in line.
+                    command.power_state = power_state
+                    return
+                if command.power_state == power_state:
+                    # Already written; its retries cover this request too.
+                    return
+            command = Switch_command(MAC, power_state, now)
+            self.commands[MAC] = command
+            heapq.heappush(self.due, (command.due_time, next(self.sequence), MAC))
+            self.condition.notify()
+
+    def confirm(self, MAC: str, power_state: bool, timestamp: float):
+        """Called for every reading; only switches with a command take the lock."""
+        if MAC not in self.commands:
+            return
+        with self.condition:
+            command = self.commands.get(MAC)
+            if (
+                command is None
+                or 0 == command.attempts
+                or command.power_state != power_state
+                or timestamp < command.first_sent_timestamp
+            ):
+                return
+            del self.commands[MAC]
+        latency = time.monotonic() - command.requested_time
+        metrics.COMMAND_CONFIRM_SECONDS.observe(latency)
+        with self.stats_lock:
+            self.confirmed += 1
+            self.confirm_latency_total += latency
+            self.confirm_latency_max = max(self.confirm_latency_max, latency)
+        self.logger.debug(
+            "Confirmed %s %s after %d Attempts in %.3f s",
+            MAC,
+            "on" if (power_state) else "off",
+            command.attempts,
+            latency,
+        )
+
+    def __next_command(self) -> Optional[Switch_command]:
+        # Must be called with the condition held. Blocks until a command is
+        # due and the pacing allows a write, or until stop() is called.
+        while not self.stop_requested:
+            timeout = None
+            if self.due:
+                due_time, _, MAC = self.due[0]
+                command = self.commands.get(MAC)
+                if command is None or command.due_time != due_time:
+                    heapq.heappop(self.due)
+                    continue
+                now = time.monotonic()
+                start_time = max(due_time, self.next_write_time)
+                if start_time <= now:
+                    heapq.heappop(self.due)
+                    if command.attempts >= config.COMMAND_MAX_ATTEMPTS:
+                        del self.commands[MAC]
+                        with self.stats_lock:
+                            self.failed += 1
+                        metrics.COMMAND_FAILURES.inc()
+                        self.logger.warning(
+                            "No Confirmation from %s after %d Attempts", MAC, command.attempts
+                        )
+                        continue
+                    command.attempts += 1
+                    if 1 == command.attempts:
+                        command.first_sent_timestamp = time.time()
+                    else:
+                        with self.stats_lock:
+                            self.retried += 1
+                        metrics.COMMAND_RETRIES.inc()
+                    command.due_time = now + config.COMMAND_ACK_TIMEOUT_SECONDS * (
+                        config.COMMAND_RETRY_BACKOFF ** (command.attempts - 1)
+                    )
+                    heapq.heappush(self.due, (command.due_time, next(self.sequence), MAC))
+                    self.next_write_time = now + 1.0 / config.COMMAND_WRITES_PER_SECOND
+                    return command
+                timeout = start_time - now
+            self.condition.wait(timeout)
+        return None
+
+    def __scheduler_thread(self):
+        while True:
+            with self.condition:
+                command = self.__next_command()
+                if command is None:
+                    return
+                frame = command_frame(command.MAC, command.power_state)
+            # Written outside the lock so a slow port never holds up
+            # request() or confirm().
+            self.logger.info("Sending Message to Coordinator: %s", frame[:-1].decode())
+            try:
+                self.write(command.MAC, frame)
+                with self.stats_lock:
+                    self.written += 1
+                metrics.COMMAND_WRITES.inc()
+            except Exception as e:
+                # The ack timeout is already running, so this is retried.
+                self.logger.critical("Failed to Write to Serial Device: '%s'", e)
+
+    def take_stats(self) -> Dict[str, float]:
+        """Returns statistics since the previous call and resets them."""
+        with self.stats_lock:
+            report = {
+                "requested": self.requested,
+                "coalesced": self.coalesced,
+                "written": self.written,
+                "retried": self.retried,
+                "confirmed": self.confirmed,
+                "failed": self.failed,
+                "pending": self.pending(),
+                "confirm_latency_mean_ms": 1000.0 * self.confirm_latency_total / self.confirmed
+                if self.confirmed
+                else 0.0,
+                "confirm_latency_max_ms": 1000.0 * self.confirm_latency_max,
+            }
+            self.reset_stats()
+        return report
+
+    def log_stats(self):
+        stats = self.take_stats()
+        if not (stats["requested"] or stats["pending"]):
+            return
+        self.logger.info(
+            "Commands: requested %d, coalesced %d, written %d, retried %d, confirmed %d, "
+            "failed %d, pending %d, confirmation %.1f/%.1f ms mean/max",
+            stats["requested"],
+            stats["coalesced"],
+            stats["written"],
+            stats["retried"],
+            stats["confirmed"],
+            stats["failed"],
+            stats["pending"],
+            stats["confirm_latency_mean_ms"],
+            stats["confirm_latency_max_ms"],
+        )
@@ -13,22 +13,202 @@ import os
 
 LOG_LEVEL = logging.DEBUG
 
+# "threads" runs the serial reader, job processors, MQTT loop and backup timer
+# as threads that poll for shutdown; "asyncio" runs them as event-driven
+# tasks on one event loop, so an idle hub sleeps until something happens.
+HUB_RUNTIME = "threads"
+
 PERSISTENT_DATA_FILENAME = (
     str(os.path.dirname(os.path.abspath(__file__)))
     + "/"
     + "homegrid_persistent_data.bin"
 )
 
+SERIAL_PORT = "/dev/ttyUSB0"
+
+SERIAL_BAUDRATE = 115200
+
+SERIAL_TIMEOUT_SECONDS = 2
+
+SERIAL_READ_CHUNK_BYTES = 4096
+
+# One port per XBee coordinator, each read on its own so the house is not
+# limited to one radio's airtime; empty means SERIAL_PORT alone. Commands go
+# to the coordinator a switch was last heard on.
+SERIAL_PORTS = []
+
+# A coordinator with no readings for this long is treated as down, and
+# commands for switches last heard on it are written to every coordinator.
+COORDINATOR_SILENT_SECONDS = 10
+
+# Zigbee readings are sharded across this many workers by MAC, so readings
+# for one switch stay in order while different switches run in parallel.
+ZIGBEE_WORKER_COUNT = 4
+
+# "threads" handles readings on ZIGBEE_WORKER_COUNT threads of the hub
+# process. "processes" hands them through shared memory to that many worker
+# processes, each owning its shard's switches, so energy accounting and
+# telemetry payloads run on other cores; switch history is then kept by the
+# workers and only the readings archive can answer history queries.
+ZIGBEE_WORKER_MODE = "threads"
+
+# Shared-memory batches a worker process can have in flight, and readings
+# per batch.
+ZIGBEE_PROCESS_SLOTS = 8
+
+ZIGBEE_PROCESS_BATCH_READINGS = 512
+
+ZIGBEE_PROCESS_STOP_TIMEOUT_SECONDS = 10
+
+# A worker process that exits is restarted this many times, getting its
+# switches' state and unfinished batches again; after that its readings are
+# dropped and counted.
+ZIGBEE_PROCESS_MAX_RESTARTS = 3
+
+# Readings held for a worker process whose slots are all in flight; the
+# oldest beyond this are dropped and counted.
+ZIGBEE_PROCESS_BACKLOG_READINGS = 100000
+
+ZIGBEE_STATS_INTERVAL_SECONDS = 60
+
+# Prometheus text metrics are served at http://METRICS_HOST:METRICS_PORT/metrics.
+METRICS_ENABLED = True
+
+METRICS_HOST = "127.0.0.1"
+
+METRICS_PORT = 9105
+
+# Power commands are paced to what the coordinator and radio can carry.
+COMMAND_WRITES_PER_SECOND = 20
+
+# A command is re-sent if no reading confirms it within this long, growing by
+# COMMAND_RETRY_BACKOFF after each attempt; plugs report once a second.
+COMMAND_ACK_TIMEOUT_SECONDS = 3
+
+COMMAND_RETRY_BACKOFF = 2
+
+COMMAND_MAX_ATTEMPTS = 4
+
 BACKUP_INTERVAL_SECONDS = 30
 
+# A binary telemetry frame numbered at most this many behind the plug's
+# previous one arrived late and is dropped; one further behind means the plug
+# restarted its sequence.
+READING_SEQUENCE_REORDER_WINDOW = 32
+
+# Readings from a MAC with no switch are counted in a cache of at most this
+# many MACs, and each MAC is reported once per UNKNOWN_MAC_TTL_SECONDS.
+UNKNOWN_MAC_CACHE_SIZE = 1024
+
+UNKNOWN_MAC_TTL_SECONDS = 600
+
+# Register a switch for an unknown MAC, with the first client ID in
+# cayenne_credentials.CLIENT_ID_LIST that no switch uses.
+AUTO_PROVISION_SWITCHES = False
+
+# "journal" appends only changed switches each backup and compacts in the
+# background; "pickle" rewrites the whole file every backup; "mmap" keeps each
+# switch in a fixed-width record of a memory-mapped file, updated on every
+# reading, and a backup only msyncs it.
+PERSISTENT_DATA_BACKEND = "journal"
+
+# Records a new mmap state file starts with; it doubles when full.
+MAPPED_STATE_INITIAL_CAPACITY = 1024
+
+# Every reading is also kept in this SQLite database, written in batches
+# from a background thread.
+ARCHIVE_ENABLED = True
+
+ARCHIVE_FILENAME = (
+    str(os.path.dirname(os.path.abspath(__file__))) + "/" + "homegrid_archive.sqlite3"
+)
+
+# Readings waiting for the archive thread; beyond this they are dropped.
+ARCHIVE_QUEUE_SIZE = 100000
+
+# The archive thread commits after this many readings or this long after the
+# first reading of a batch, whichever comes first.
+ARCHIVE_BATCH_SIZE = 5000
+
+ARCHIVE_BATCH_INTERVAL_SECONDS = 1
+
+# Raw readings are kept this long; at one reading a second that is 86,400
+# rows per switch.
+ARCHIVE_RAW_RETENTION_SECONDS = 86400
+
+# Rollup resolution in seconds -> seconds kept, or None to keep forever.
+ARCHIVE_ROLLUPS = {60: 31 * 86400, 3600: 2 * 366 * 86400, 86400: None}
+
+ARCHIVE_RETENTION_INTERVAL_SECONDS = 3600
+
+JOURNAL_COMPACTION_BYTES = 4 * 1024 * 1024
+
 LOGGING_FORMAT = "[%(filename)s:%(lineno)s - %(funcName)28s() ] %(message)s"
 
-MQTT_LOOP_TIME_SECONDS = 2
+# Records waiting for the logging thread; beyond this they are dropped rather
+# than blocking the thread that logged them.
+LOG_QUEUE_SIZE = 10000
+
+# How long the logging thread lets records collect after being woken before
+# writing them out.
+LOG_FLUSH_INTERVAL_SECONDS = 0.05
+
+# Each warning or error message template may be logged this many times per
+# interval; further repeats are counted and reported once the interval ends.
+LOG_RATE_LIMIT_BURST = 5
+
+LOG_RATE_LIMIT_INTERVAL_SECONDS = 60
+
+# How often the MQTT event loop sends keepalives and checks for dropped
+# connections; incoming messages are handled as soon as they arrive.
+MQTT_MISC_INTERVAL_SECONDS = 1
+
+MQTT_RECONNECT_INTERVAL_SECONDS = 5
+
+# MQTT connections opened at once at start-up, each a TCP connect and TLS
+# handshake; one that fails is retried after MQTT_RECONNECT_INTERVAL_SECONDS,
+# doubling up to MQTT_CONNECT_RETRY_MAX_SECONDS.
+MQTT_CONNECT_CONCURRENCY = 16
+
+MQTT_CONNECT_RETRY_MAX_SECONDS = 300
+
+# CA bundle the broker's certificate is checked against; None uses the
+# system's.
+MQTT_CA_CERTS = None
+
+# How often the asyncio runtime runs paho's loop_misc(); it only has to beat
+# the 60 s keepalive Cayenne connects with.
+MQTT_ASYNCIO_MISC_INTERVAL_SECONDS = 15
+
+# Publish every channel of a reading as one message on the Cayenne JSON data
+# topic instead of one virtualWrite per channel.
+TELEMETRY_BATCH_PUBLISH = True
+
+# Load shedding: when records back up, publish only the newest per switch and
+# count the rest in homegrid_telemetry_records_coalesced_total. Off, every
+# reading is published.
+TELEMETRY_COALESCE = False
 
 NODE_POWER_AVERAGING_INTERVAL_SECONDS = 1
 
+# Longest gap between two readings of a switch that is credited as energy;
+# anything longer is treated as an outage.
+ENERGY_MAX_INTERVAL_SECONDS = 10
+
 KILOWATT_COST_DOLLARS = 0.15
 
+# Raw readings kept per switch in its in-memory ring buffer, allocated on the
+# switch's first reading at 17 bytes each: 15.3 KB per switch.
+HISTORY_RAW_CAPACITY = 900
+
+# Rollup resolution in seconds -> number of buckets kept. Each bucket costs
+# 40 bytes, allocated as the ring first covers it: the minute ring reaches
+# 57.6 KB after a day, the hour ring 13.4 KB after two weeks and the day ring
+# 14.6 KB after a year. benchmarks/bench_memory.py measures a switch's
+# history at 19 KB after its first reading, 84 KB after a day and 113 KB
+# after a year (11 GB for 100k switches).
+HISTORY_ROLLUPS = {60: 1440, 3600: 336, 86400: 366}
+
 
 class MyEnumMeta(EnumMeta):
     def __contains__(cls, item):
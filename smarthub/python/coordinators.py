@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Coordinators Module
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import config
+import homegrid_logger
+import metrics
+import serial
+from serial_line_framer import Serial_line_framer
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from xbee_message_parser import Xbee_coordinator_message
+
+
+class Coordinator:
+    """One XBee coordinator and the serial port it is attached to."""
+
+    def __init__(self, index: int, port: str):
+        self.index = index
+        self.port = port
+        self.serial_port: Optional[serial.Serial] = None
+        self.framer = Serial_line_framer()
+        # Counted as heard when opened so it is not silent before the first
+        # reading arrives.
+        self.last_heard = time.monotonic()
+        self.readings = 0
+        self.writes = 0
+
+    def __repr__(self) -> str:
+        return f"Coordinator {self.index} ({self.port})"
+
+    def open(self):
+        self.serial_port = serial.Serial(
+            self.port,
+            baudrate=config.SERIAL_BAUDRATE,
+            timeout=config.SERIAL_TIMEOUT_SECONDS,
+        )
+        self.framer = Serial_line_framer()
+        self.last_heard = time.monotonic()
+
+    def close(self):
+        # A port that failed may not close cleanly; it is dropped either way.
+        serial_port, self.serial_port = self.serial_port, None
+        if serial_port is not None:
+            try:
+                serial_port.close()
+            except Exception:
+                pass
+
+    def silent(self, now: float) -> bool:
+        return now - self.last_heard > config.COORDINATOR_SILENT_SECONDS
+
+    def write(self, frame: bytes):
+        if self.serial_port is None:
+            raise serial.SerialException(f"{self} is not Open")
+        self.serial_port.write(frame)
+        self.writes += 1
+
+
+class Coordinator_router:
+    """
+    Runs several coordinators and routes power commands between them.
+
+    Each coordinator has its own serial port and is read on its own, so the
+    hub is not limited to one radio's airtime. Every reading tells the
+    router which coordinator its switch is reachable through; a command goes
+    to that coordinator only. A command for a switch not heard yet, or last
+    heard on a coordinator that has had no readings for
+    COORDINATOR_SILENT_SECONDS, is written to every open coordinator: power
+    commands are idempotent, and the first reading back through another
+    coordinator moves the route there.
+
+    Routes are read by the command scheduler without a lock; each is
+    replaced by one dict assignment from the receiver of the coordinator
+    that heard the switch.
+    """
+
+    def __init__(self, ports: List[str], is_known: Callable[[str], bool] = lambda MAC: True):
+        self.logger = homegrid_logger.Logger(__name__)
+        self.coordinators = [Coordinator(index, port) for index, port in enumerate(ports)]
+        # Only switches the hub knows get a route, so noise and unregistered
+        # plugs cannot grow the table.
+        self.is_known = is_known
+        self.routes: Dict[str, Coordinator] = {}
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.routed = 0
+        self.broadcast = 0
+        self.moved = 0
+
+    def open(self):
+        """
+        Opens every coordinator's port. One that fails is logged and left
+        closed for its receiver to open later; only all of them failing raises.
+        """
+        error: Optional[Exception] = None
+        for coordinator in self.coordinators:
+            try:
+                coordinator.open()
+            except Exception as e:
+                error = e
+                self.logger.error("Unable to Open %s: %s", coordinator, e)
+        opened = sum(1 for coordinator in self.coordinators if coordinator.serial_port is not None)
+        if 0 == opened:
+            raise error
+        self.logger.info("Opened %d of %d Coordinators", opened, len(self.coordinators))
+
+    def close(self):
+        for coordinator in self.coordinators:
+            coordinator.close()
+
+    def heard(self, coordinator: Coordinator, batch: List[Xbee_coordinator_message]):
+        """Called by a coordinator's receiver with each batch it parsed."""
+        coordinator.last_heard = time.monotonic()
+        coordinator.readings += len(batch)
+        routes = self.routes
+        for message in batch:
+            previous = routes.get(message.MAC)
+            if previous is coordinator or not self.is_known(message.MAC):
+                continue
+            routes[message.MAC] = coordinator
+            if previous is not None:
+                with self.stats_lock:
+                    self.moved += 1
+                metrics.COORDINATOR_ROUTE_CHANGES.inc()
+                self.logger.info("Switch %s Moved from %s to %s", message.MAC, previous, coordinator)
+
+    def forget(self, MAC: str):
+        self.routes.pop(MAC, None)
+
+    def route(self, MAC: str) -> Optional[Coordinator]:
+        coordinator = self.routes.get(MAC)
+        if coordinator is None or coordinator.serial_port is None:
+            return None
+        if coordinator.silent(time.monotonic()):
+            return None
+        return coordinator
+
+    def write(self, MAC: str, frame: bytes):
+        """Writes a command for MAC; raises only if no coordinator took it."""
+        coordinator = self.route(MAC)
+        if coordinator is not None:
+            try:
+                coordinator.write(frame)
+                with self.stats_lock:
+                    self.routed += 1
+                metrics.COORDINATOR_COMMANDS_ROUTED.inc()
+                return
+            except Exception as e:
+                self.logger.error("Unable to Write to %s, Trying the Others: %s", coordinator, e)
+        error: Optional[Exception] = None
+        written = 0
+        for other in self.coordinators:
+            if other is coordinator or other.serial_port is None:
+                continue
+            try:
+                other.write(frame)
+                written += 1
+            except Exception as e:
+                error = e
+        if 0 == written:
+            raise error or serial.SerialException("No Coordinator is Open")
+        with self.stats_lock:
+            self.broadcast += 1
+        metrics.COORDINATOR_COMMANDS_BROADCAST.inc()
+
+    def silent_count(self) -> int:
+        now = time.monotonic()
+        return sum(1 for coordinator in self.coordinators if coordinator.silent(now))
+
+    def take_stats(self) -> Dict[str, float]:
+        """Returns statistics since the previous call and resets them."""
+        with self.stats_lock:
+            report = {
+                "routed": self.routed,
+                "broadcast": self.broadcast,
+                "moved": self.moved,
+                "routes": len(self.routes),
+                "silent": self.silent_count(),
+            }
+            self.reset_stats()
+        return report
+
+    def log_stats(self):
+        stats = self.take_stats()
+        if len(self.coordinators) < 2:
+            return
+        now = time.monotonic()
+        self.logger.info(
+            "Coordinators: %s; routes %d, moved %d; commands routed %d, broadcast %d",
+            ", ".join(
+                f"{coordinator.index} {'silent' if coordinator.silent(now) else 'up'} "
+                f"{coordinator.readings} readings"
+                for coordinator in self.coordinators
+            ),
+            stats["routes"],
+            stats["moved"],
+            stats["routed"],
+            stats["broadcast"],
+        )
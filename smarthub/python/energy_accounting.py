@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Energy Accounting Module
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import config
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+# Each power_draw a node reports is its average since the previous report, so
+# a reading is credited with the real time elapsed since the previous reading
+# of the same switch, measured from Xbee_coordinator_message.timestamp. After
+# an outage, a hub restart or a dropped run of frames the elapsed time says
+# nothing about what the load drew meanwhile, so it is capped at
+# ENERGY_MAX_INTERVAL_SECONDS. A reading with no predecessor is credited with
+# the nominal NODE_POWER_AVERAGING_INTERVAL_SECONDS.
+
+
+def reading_interval_seconds(previous_timestamp: Optional[float], timestamp: float) -> float:
+    if previous_timestamp is None:
+        return float(config.NODE_POWER_AVERAGING_INTERVAL_SECONDS)
+    interval = timestamp - previous_timestamp
+    if interval <= 0.0:
+        # Duplicate or out-of-order reading; it covers no new time.
+        return 0.0
+    return min(interval, float(config.ENERGY_MAX_INTERVAL_SECONDS))
+
+
+def watts_to_kwh(watts: float, seconds: float) -> float:
+    # E(kWh) = P(W) × t(hr) / 1000
+    return watts * seconds / 3_600_000.0
+
+
+def kwh_to_dollars(kwh: float) -> float:
+    # $ = E(kWh) * kilowatt cost
+    return kwh * float(config.KILOWATT_COST_DOLLARS)
+
+
+def reading_intervals_seconds(
+    timestamps: np.ndarray, previous_timestamp: Optional[float] = None
+) -> np.ndarray:
+    """Vector form of reading_interval_seconds for one switch's readings in order."""
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    intervals = np.empty(len(timestamps), dtype=np.float64)
+    if 0 == len(timestamps):
+        return intervals
+    intervals[0] = reading_interval_seconds(previous_timestamp, float(timestamps[0]))
+    np.subtract(timestamps[1:], timestamps[:-1], out=intervals[1:])
+    np.clip(
+        intervals[1:], 0.0, float(config.ENERGY_MAX_INTERVAL_SECONDS), out=intervals[1:]
+    )
+    return intervals
+
+
+def integrate_readings(
+    timestamps: np.ndarray,
+    power_draw: np.ndarray,
+    previous_timestamp: Optional[float] = None,
+) -> float:
+    """Returns the kWh consumed over one switch's readings, oldest first."""
+    intervals = reading_intervals_seconds(timestamps, previous_timestamp)
+    return float(np.dot(np.asarray(power_draw, dtype=np.float64), intervals)) / 3_600_000.0
+
+
+def integrate_fleet(
+    switch: np.ndarray,
+    timestamps: np.ndarray,
+    power_draw: np.ndarray,
+    previous_timestamps: Optional[Dict] = None,
+) -> Dict[object, Tuple[float, float]]:
+    """
+    Integrates readings of many switches at once.
+
+    Row i of every array is one reading; switch holds any hashable key (MAC,
+    or an integer id for large re-integrations) and rows need not be grouped
+    or sorted. previous_timestamps maps a switch to the timestamp of the last
+    reading already accounted for. Returns switch -> (kWh, newest timestamp).
+    """
+    switch = np.asarray(switch)
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    power_draw = np.asarray(power_draw, dtype=np.float64)
+    if 0 == len(switch):
+        return {}
+    group_starts = np.flatnonzero(np.r_[True, switch[1:] != switch[:-1]])
+    # tolist() turns NumPy scalars back into plain str/int keys.
+    group_keys = switch[group_starts].tolist()
+    intervals = np.empty(len(timestamps), dtype=np.float64)
+    np.subtract(timestamps[1:], timestamps[:-1], out=intervals[1:])
+    # Rows from the archive or from one switch's history are already grouped
+    # by switch and in time order; only sort when they are not.
+    in_order = len(set(group_keys)) == len(group_keys) and not np.any(
+        intervals[1:][switch[1:] == switch[:-1]] < 0.0
+    )
+    if not in_order:
+        keys, codes = np.unique(switch, return_inverse=True)
+        codes = codes.reshape(-1)
+        order = np.lexsort((timestamps, codes))
+        codes = codes[order]
+        timestamps = timestamps[order]
+        power_draw = power_draw[order]
+        np.subtract(timestamps[1:], timestamps[:-1], out=intervals[1:])
+        group_starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        group_keys = keys[codes[group_starts]].tolist()
+    group_ends = np.r_[group_starts[1:], len(timestamps)] - 1
+    np.clip(intervals, 0.0, float(config.ENERGY_MAX_INTERVAL_SECONDS), out=intervals)
+    previous_timestamps = previous_timestamps or {}
+    for key, start in zip(group_keys, group_starts.tolist()):
+        intervals[start] = reading_interval_seconds(
+            previous_timestamps.get(key), float(timestamps[start])
+        )
+    watt_seconds = np.add.reduceat(power_draw * intervals, group_starts)
+    return {
+        key: (energy / 3_600_000.0, last)
+        for key, energy, last in zip(
+            group_keys, watt_seconds.tolist(), timestamps[group_ends].tolist()
+        )
+    }
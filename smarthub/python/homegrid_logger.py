@@ -7,14 +7,199 @@ __author__ = "Nick Schiffer"
 __version__ = "1.0.0"
 
 
+import atexit
+import collections
 import config
 import logging
+import sys
+import threading
+import time
+from typing import Deque, Dict, Optional, Tuple
+
+
+class Deferred_handler(logging.Handler):
+    """
+    Queues records for the writer thread without blocking the caller.
+
+    Unlike logging.handlers.QueueHandler nothing is formatted in the calling
+    thread and no lock is taken per record: deque.append is atomic, and only
+    the first record after the writer thread empties the queue sets the event
+    that wakes it, so an idle hub never wakes it at all. When LOG_QUEUE_SIZE
+    records are already waiting the record is dropped and counted instead of
+    stalling a serial or MQTT thread behind a slow terminal.
+    """
+
+    def __init__(self, target: logging.Handler):
+        super().__init__()
+        self.target = target
+        self.records: Deque[logging.LogRecord] = collections.deque()
+        self.dropped = 0
+        self.records_ready = threading.Event()
+        self.stop_requested = threading.Event()
+        self.thread = threading.Thread(
+            target=self.__writer_thread, name="homegrid-logger", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # Handler.handle() would take the handler lock around emit().
+        if len(self.records) >= config.LOG_QUEUE_SIZE:
+            self.dropped += 1
+            return False
+        self.records.append(record)
+        if not self.records_ready.is_set():
+            self.records_ready.set()
+        return True
+
+    def emit(self, record: logging.LogRecord):
+        self.handle(record)
+
+    def flush(self):
+        while True:
+            try:
+                record = self.records.popleft()
+            except IndexError:
+                break
+            self.target.handle(record)
+        self.target.flush()
+
+    def close(self):
+        self.stop_requested.set()
+        self.records_ready.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.flush()
+        super().close()
+
+    def __writer_thread(self):
+        while not self.stop_requested.is_set():
+            self.records_ready.wait()
+            # Let a burst collect so it is written in one pass.
+            self.stop_requested.wait(config.LOG_FLUSH_INTERVAL_SECONDS)
+            # Cleared before flushing, so a record appended during the flush
+            # either is written by it or sets the event again.
+            self.records_ready.clear()
+            self.flush()
+
+
+class Rate_limit_filter(logging.Filter):
+    """
+    Passes at most LOG_RATE_LIMIT_BURST records per message template every
+    LOG_RATE_LIMIT_INTERVAL_SECONDS, for WARNING and above.
+
+    Call sites pass %-style templates, so every "Could not Find Switch with
+    MAC: %s" shares one budget whatever the MAC. The first record let through
+    after a suppression reports how many were dropped.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        # (logger name, level, template) -> [window start, passed, suppressed]
+        self.windows: Dict[Tuple[str, int, str], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= config.LOG_RATE_LIMIT_INTERVAL_SECONDS:
+                suppressed = window[2] if window is not None else 0
+                self.windows[key] = [now, 1, 0]
+            elif window[1] < config.LOG_RATE_LIMIT_BURST:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                return False
+        if suppressed and isinstance(record.args, tuple):
+            record.msg = f"{record.msg} (%d similar suppressed)"
+            record.args = record.args + (suppressed,)
+        return True
 
 
 class Logger:
-    LOGGING_FORMAT = "[%(filename)s:%(lineno)s - %(funcName)28s() ] %(message)s"
+    """
+    The hub's logging layer.
+
+    Call sites pass %-style templates and arguments, never f-strings, so a
+    disabled level costs one isEnabledFor check and an enabled one defers
+    formatting to the writer thread. Records go through a bounded queue to a
+    single stream handler and repeated warnings and errors are rate-limited.
+    """
 
-    def __init__(self, name):
+    rate_limit_filter = Rate_limit_filter()
+    handler: Optional[Deferred_handler] = None
+    configure_lock = threading.Lock()
+
+    def __init__(self, name: str):
+        self.configure()
         self.logger = logging.getLogger(name)
-        logging.basicConfig(format=self.LOGGING_FORMAT)
         self.logger.setLevel(config.LOG_LEVEL)
+        if self.rate_limit_filter not in self.logger.filters:
+            self.logger.addFilter(self.rate_limit_filter)
+
+    @classmethod
+    def configure(cls):
+        with cls.configure_lock:
+            if cls.handler is not None:
+                return
+            stream_handler = logging.StreamHandler(sys.stderr)
+            stream_handler.setFormatter(logging.Formatter(config.LOGGING_FORMAT))
+            cls.handler = Deferred_handler(stream_handler)
+            root = logging.getLogger()
+            # Replace anything basicConfig() set up so records are not also
+            # written synchronously.
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            root.addHandler(cls.handler)
+            cls.handler.start()
+            atexit.register(cls.shutdown)
+
+    @classmethod
+    def shutdown(cls):
+        """Writes out every queued record and stops the writer thread."""
+        with cls.configure_lock:
+            if cls.handler is None:
+                return
+            logging.getLogger().removeHandler(cls.handler)
+            cls.handler.close()
+            if cls.handler.dropped:
+                sys.stderr.write(f"homegrid_logger: {cls.handler.dropped} Records Dropped\n")
+            cls.handler = None
+
+    def isEnabledFor(self, level: int) -> bool:
+        return self.logger.isEnabledFor(level)
+
+    # stacklevel=2 attributes each record to the caller rather than to these
+    # wrappers, so filename, lineno and funcName in LOGGING_FORMAT stay right.
+
+    def debug(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(msg, *args, stacklevel=2, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(msg, *args, stacklevel=2, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.WARNING):
+            self.logger.warning(msg, *args, stacklevel=2, **kwargs)
+
+    warn = warning
+
+    def error(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.error(msg, *args, stacklevel=2, **kwargs)
+
+    def exception(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.exception(msg, *args, stacklevel=2, **kwargs)
+
+    def critical(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.CRITICAL):
+            self.logger.critical(msg, *args, stacklevel=2, **kwargs)
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Metrics Module
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import bisect
+import config
+import homegrid_logger
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import math
+import socket
+import threading
+from typing import Callable, List, Optional, Sequence
+
+# Upper bounds in seconds, 50 us to 10 s in roughly 1-2.5-5 steps, which
+# covers everything from a lock grab to a full persistence save.
+LATENCY_BUCKETS_SECONDS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        with self.lock:
+            self.value += amount
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {format_value(self.value)}",
+        ]
+
+
+class Gauge:
+    """
+    Read when scraped rather than updated on every change, so queue depths
+    cost nothing on the paths that fill and drain the queues.
+    """
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self) -> List[str]:
+        try:
+            value = self.read()
+        except Exception:
+            value = float("nan")
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {format_value(value)}",
+        ]
+
+
+class Histogram:
+    def __init__(
+        self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS_SECONDS
+    ):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # One count per bucket plus the overflow bucket; made cumulative only
+        # when rendered.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self) -> List[str]:
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{format_value(bound)}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {format_value(total)}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Duplicate Metric: {metric.name}")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str):
+        with self.lock:
+            self.metrics.pop(name, None)
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.register(Counter(name, help))
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, help, read))
+
+    def histogram(
+        self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS_SECONDS
+    ) -> Histogram:
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+SERIAL_READ_SECONDS = REGISTRY.histogram(
+    "homegrid_serial_read_seconds",
+    "Time in serial_port.read() for data the driver had already buffered.",
+)
+SERIAL_PARSE_SECONDS = REGISTRY.histogram(
+    "homegrid_serial_parse_seconds",
+    "Time to frame and parse one chunk read from the coordinator.",
+)
+ZIGBEE_QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "homegrid_zigbee_queue_wait_seconds",
+    "Time a batch of readings waited in zigbee_job_queue.",
+)
+ZIGBEE_SHARD_QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "homegrid_zigbee_shard_queue_wait_seconds",
+    "Time a batch of readings waited in its worker pool shard queue.",
+)
+ZIGBEE_PROCESS_ROUND_TRIP_SECONDS = REGISTRY.histogram(
+    "homegrid_zigbee_process_round_trip_seconds",
+    "Time from a batch being handed to a Zigbee worker process to its results coming back.",
+)
+SWITCH_LOCK_WAIT_SECONDS = REGISTRY.histogram(
+    "homegrid_switch_lock_wait_seconds",
+    "Time spent waiting to acquire a SmartSwitch lock.",
+)
+TELEMETRY_PUBLISH_SECONDS = REGISTRY.histogram(
+    "homegrid_telemetry_publish_seconds",
+    "Time to publish the telemetry of one switch to Cayenne.",
+)
+READING_TO_PUBLISH_SECONDS = REGISTRY.histogram(
+    "homegrid_reading_to_publish_seconds",
+    "Time from a reading being parsed to its telemetry being published.",
+)
+PERSISTENCE_SAVE_SECONDS = REGISTRY.histogram(
+    "homegrid_persistence_save_seconds",
+    "Time to save switch state to persistent storage.",
+)
+ARCHIVE_INSERT_SECONDS = REGISTRY.histogram(
+    "homegrid_archive_insert_seconds",
+    "Time to archive one batch of readings, rollups included.",
+)
+ARCHIVE_READINGS = REGISTRY.counter(
+    "homegrid_archive_readings_total",
+    "Readings written to the SQLite archive.",
+)
+ARCHIVE_DUPLICATES = REGISTRY.counter(
+    "homegrid_archive_duplicates_total",
+    "Readings not archived because one of the same switch and timestamp already was.",
+)
+ARCHIVE_DROPPED = REGISTRY.counter(
+    "homegrid_archive_dropped_total",
+    "Readings dropped because the archive queue was full.",
+)
+TELEMETRY_RECORDS_COALESCED = REGISTRY.counter(
+    "homegrid_telemetry_records_coalesced_total",
+    "Telemetry records not published because a newer record of the same switch replaced them.",
+)
+ZIGBEE_PROCESS_RESTARTS = REGISTRY.counter(
+    "homegrid_zigbee_process_restarts_total",
+    "Zigbee worker processes restarted after exiting.",
+)
+ZIGBEE_PROCESS_DROPPED = REGISTRY.counter(
+    "homegrid_zigbee_process_dropped_total",
+    "Readings dropped because their Zigbee worker process was gone or its backlog full.",
+)
+MQTT_CONNECT_SECONDS = REGISTRY.histogram(
+    "homegrid_mqtt_connect_seconds",
+    "Time to open one MQTT connection, TCP connect and TLS handshake included.",
+)
+MQTT_CONNECT_FAILURES = REGISTRY.counter(
+    "homegrid_mqtt_connect_failures_total",
+    "Attempts to open an MQTT connection that failed and were retried.",
+)
+PARSE_FAILURES = REGISTRY.counter(
+    "homegrid_parse_failures_total",
+    "Coordinator lines that could not be parsed.",
+)
+CHECKSUM_FAILURES = REGISTRY.counter(
+    "homegrid_checksum_failures_total",
+    "Coordinator lines dropped because their checksum did not match.",
+)
+READINGS_LOST = REGISTRY.counter(
+    "homegrid_readings_lost_total",
+    "Readings missing from gaps in plugs' telemetry sequence numbers.",
+)
+READINGS_OUT_OF_ORDER = REGISTRY.counter(
+    "homegrid_readings_out_of_order_total",
+    "Readings dropped because they repeated or were older than one already received.",
+)
+UNKNOWN_MACS = REGISTRY.counter(
+    "homegrid_unknown_mac_readings_total",
+    "Readings from a MAC with no registered switch.",
+)
+SWITCHES_PROVISIONED = REGISTRY.counter(
+    "homegrid_switches_provisioned_total",
+    "Switches registered automatically for an unknown MAC.",
+)
+COORDINATOR_COMMANDS_ROUTED = REGISTRY.counter(
+    "homegrid_coordinator_commands_routed_total",
+    "Power commands written to the one coordinator their switch was heard on.",
+)
+COORDINATOR_COMMANDS_BROADCAST = REGISTRY.counter(
+    "homegrid_coordinator_commands_broadcast_total",
+    "Power commands written to every coordinator, the switch's route being unknown or silent.",
+)
+COORDINATOR_ROUTE_CHANGES = REGISTRY.counter(
+    "homegrid_coordinator_route_changes_total",
+    "Switches heard on a different coordinator than before.",
+)
+COMMAND_CONFIRM_SECONDS = REGISTRY.histogram(
+    "homegrid_command_confirm_seconds",
+    "Time from a power command being requested to a reading confirming it.",
+)
+COMMANDS_REQUESTED = REGISTRY.counter(
+    "homegrid_commands_requested_total",
+    "Power commands requested from the cloud.",
+)
+COMMANDS_COALESCED = REGISTRY.counter(
+    "homegrid_commands_coalesced_total",
+    "Power commands merged into one already pending for the same switch.",
+)
+COMMAND_WRITES = REGISTRY.counter(
+    "homegrid_command_writes_total",
+    "Power commands written to the coordinator, retries included.",
+)
+COMMAND_RETRIES = REGISTRY.counter(
+    "homegrid_command_retries_total",
+    "Power commands written again after no confirmation.",
+)
+COMMAND_FAILURES = REGISTRY.counter(
+    "homegrid_command_failures_total",
+    "Power commands abandoned without confirmation.",
+)
+
+
+class Metrics_server:
+    """
+    Serves REGISTRY as Prometheus text at /metrics from a daemon thread.
+
+    The thread blocks in accept() rather than serve_forever()'s half-second
+    poll, so an idle hub is not woken twice a second; stop() connects to the
+    server itself to let the thread see the request to stop.
+    """
+
+    def __init__(
+        self,
+        registry: Registry = REGISTRY,
+        host: str = config.METRICS_HOST,
+        port: int = config.METRICS_PORT,
+    ):
+        self.logger = homegrid_logger.Logger(__name__)
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server: Optional[ThreadingHTTPServer] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stop_requested = False
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(
+            target=self.__server_thread, name="metrics-server", daemon=True
+        )
+        self.thread.start()
+        self.logger.info("Serving Metrics on http://%s:%d/metrics", self.host, self.port)
+
+    def __server_thread(self):
+        server = self.server
+        while not self.stop_requested:
+            server.handle_request()
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.stop_requested = True
+        try:
+            socket.create_connection((self.host, self.port), timeout=1).close()
+        except OSError:
+            pass
+        self.thread.join(timeout=1)
+        self.server.server_close()
+        self.server = None
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+MQTT Connector Module
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+from cayenne import client as cayenne_client
+from cayenne.client import CayenneMQTTClient
+import cayenne_credentials
+import config
+import functools
+import heapq
+import homegrid_logger
+import itertools
+import metrics
+import paho.mqtt.client as mqtt
+from smartswitch import SmartSwitch
+import ssl
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+
+def create_ssl_context() -> ssl.SSLContext:
+    # What CayenneMQTTClient.begin gets from tls_set(): TLS 1.2 with the
+    # certificate and hostname checked.
+    context = ssl.create_default_context(cafile=config.MQTT_CA_CERTS)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.maximum_version = ssl.TLSVersion.TLSv1_2
+    return context
+
+
+class Mqtt_connector:
+    """
+    Opens the MQTT connections of the switches in the background.
+
+    Up to MQTT_CONNECT_CONCURRENCY connections are opened at once, each a TCP
+    connect and TLS handshake costing several broker round trips, so
+    start-up no longer waits for the whole fleet in sequence and one
+    unreachable connection holds up nothing else. A connection that fails is
+    retried after MQTT_RECONNECT_INTERVAL_SECONDS, doubling up to
+    MQTT_CONNECT_RETRY_MAX_SECONDS.
+
+    A connection that drops is handed back by the MQTT loop with
+    reconnect() and reopened the same way, so a broker that accepts TCP but
+    stalls the handshake holds up one connector thread, never the loop.
+
+    A switch's client is set only once its socket is open, when on_open is
+    called to have the MQTT loop watch it, after a reconnect as well;
+    on_connected is called from the MQTT loop on every CONNACK, so telemetry
+    held back while the switch was not connected can be sent. Every client
+    shares one SSLContext instead of loading the CA bundle once per switch.
+    """
+
+    def __init__(
+        self,
+        on_message,
+        on_open: Optional[Callable[[CayenneMQTTClient], None]] = None,
+        on_connected: Optional[Callable[[SmartSwitch], None]] = None,
+    ):
+        self.logger = homegrid_logger.Logger(__name__)
+        self.on_message = on_message
+        self.on_open = on_open
+        self.on_connected = on_connected
+        self.ssl_context: Optional[ssl.SSLContext] = None
+        self.condition = threading.Condition()
+        # (due time, tie-breaker, switch, client, failed attempts, reconnect)
+        self.due: List[Tuple[float, int, SmartSwitch, CayenneMQTTClient, int, bool]] = []
+        self.switches: Dict[CayenneMQTTClient, SmartSwitch] = {}
+        # Clients handed back by the MQTT loop and not reopened yet.
+        self.reconnecting: Set[CayenneMQTTClient] = set()
+        self.sequence = itertools.count()
+        self.stop_requested = False
+        self.threads: List[threading.Thread] = []
+        self.start_time = 0.0
+        self.requested = 0
+        self.opened = 0
+
+    def start(self, switches: List[SmartSwitch]):
+        self.start_time = time.monotonic()
+        if 8883 == int(cayenne_credentials.MQTT_PORT):
+            self.ssl_context = create_ssl_context()
+        for switch in switches:
+            self.connect(switch)
+        for index in range(config.MQTT_CONNECT_CONCURRENCY):
+            thread = threading.Thread(target=self.__connector_thread, name=f"mqtt-connect-{index}")
+            self.threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stop_requested = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def pending(self) -> int:
+        return len(self.due)
+
+    def connect(self, switch: SmartSwitch):
+        """Queues a switch whose client has never been opened."""
+        client = self.__create_client(switch)
+        with self.condition:
+            self.requested += 1
+            self.switches[client] = switch
+            heapq.heappush(
+                self.due, (time.monotonic(), next(self.sequence), switch, client, 0, False)
+            )
+            self.condition.notify()
+
+    def reconnect(self, client: CayenneMQTTClient):
+        """
+        Thread-safe; queues a client whose connection dropped to be reopened.
+        The caller stops servicing it until on_open is called for it again.
+        """
+        with self.condition:
+            switch = self.switches.get(client)
+            if switch is None or client in self.reconnecting:
+                return
+            self.reconnecting.add(client)
+            heapq.heappush(
+                self.due, (time.monotonic(), next(self.sequence), switch, client, 0, True)
+            )
+            self.condition.notify()
+
+    def __create_client(self, switch: SmartSwitch) -> CayenneMQTTClient:
+        # CayenneMQTTClient.begin without the blocking connect and with the
+        # shared SSLContext.
+        client = CayenneMQTTClient()
+        client.on_message = self.on_message
+        client.rootTopic = f"v1/{cayenne_credentials.MQTT_USERNAME}/things/{switch.GUID}"
+        client.client = mqtt.Client(client_id=switch.GUID, clean_session=True, userdata=client)
+        client.client.on_connect = functools.partial(self.__on_connect, switch)
+        client.client.on_disconnect = cayenne_client.on_disconnect
+        client.client.on_message = cayenne_client.on_message
+        client.client.username_pw_set(
+            str(cayenne_credentials.MQTT_USERNAME), str(cayenne_credentials.MQTT_PASSWORD)
+        )
+        if self.ssl_context is not None:
+            client.client.tls_set_context(self.ssl_context)
+        return client
+
+    def __on_connect(self, switch: SmartSwitch, mqtt_client, client, flags, rc):
+        # Raises for a refused connection, as it always has.
+        cayenne_client.on_connect(mqtt_client, client, flags, rc)
+        if self.on_connected is not None:
+            self.on_connected(switch)
+
+    def __next_due(self):
+        # Must be called with the condition held.
+        while not self.stop_requested:
+            timeout = None
+            if self.due:
+                now = time.monotonic()
+                if self.due[0][0] <= now:
+                    return heapq.heappop(self.due)
+                timeout = self.due[0][0] - now
+            self.condition.wait(timeout)
+        return None
+
+    def __connector_thread(self):
+        while True:
+            with self.condition:
+                entry = self.__next_due()
+            if entry is None:
+                return
+            _, _, switch, client, attempts, reconnect = entry
+            self.__open(switch, client, attempts, reconnect)
+
+    def __open(
+        self, switch: SmartSwitch, client: CayenneMQTTClient, attempts: int, reconnect: bool
+    ):
+        # Never log the password.
+        self.logger.debug(
+            "Connecting Device %s as %s to %s:%s",
+            switch.GUID,
+            cayenne_credentials.MQTT_USERNAME,
+            cayenne_credentials.MQTT_HOSTNAME,
+            cayenne_credentials.MQTT_PORT,
+        )
+        start_time = time.perf_counter()
+        try:
+            if reconnect:
+                client.client.reconnect()
+            else:
+                client.client.connect(
+                    str(cayenne_credentials.MQTT_HOSTNAME), int(cayenne_credentials.MQTT_PORT), 60
+                )
+        except Exception as e:
+            metrics.MQTT_CONNECT_FAILURES.inc()
+            delay = min(
+                config.MQTT_RECONNECT_INTERVAL_SECONDS * 2**attempts,
+                config.MQTT_CONNECT_RETRY_MAX_SECONDS,
+            )
+            self.logger.warning("Unable to Connect %s, Retrying in %d s: %s", switch.GUID, delay, e)
+            with self.condition:
+                heapq.heappush(
+                    self.due,
+                    (
+                        time.monotonic() + delay,
+                        next(self.sequence),
+                        switch,
+                        client,
+                        attempts + 1,
+                        reconnect,
+                    ),
+                )
+                self.condition.notify()
+            return
+        metrics.MQTT_CONNECT_SECONDS.observe(time.perf_counter() - start_time)
+        if reconnect:
+            client.reconnect = False
+            with self.condition:
+                self.reconnecting.discard(client)
+            self.logger.info("Reconnected %s", switch.GUID)
+            if self.on_open is not None:
+                self.on_open(client)
+            return
+        switch.client = client
+        if self.on_open is not None:
+            self.on_open(client)
+        with self.condition:
+            self.opened += 1
+            opened, requested = self.opened, self.requested
+        if opened == requested:
+            self.logger.info(
+                "Opened %d MQTT Connections in %.3f s",
+                opened,
+                time.monotonic() - self.start_time,
+            )
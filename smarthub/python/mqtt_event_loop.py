@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+MQTT Event Loop Module
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import asyncio
+from cayenne.client import CayenneMQTTClient
+import collections
+import config
+import homegrid_logger
+import selectors
+import socket
+import time
+from typing import Callable, Deque, Dict, Iterable, Optional, Set
+
+
+class Mqtt_event_loop:
+    """
+    Services the sockets of every switch's MQTT client from one thread.
+
+    Each paho client is driven through its external-loop API: loop_read()
+    when its socket becomes readable, loop_write() when it has queued output,
+    and loop_misc() for keepalives every MQTT_MISC_INTERVAL_SECONDS. Publishes
+    from other threads only queue the packet and wake the selector, so all
+    socket I/O happens here and a cloud command is handled as soon as it
+    arrives instead of on the next polling pass.
+
+    Cayenne authenticates each device by its own client ID, so every switch
+    still needs its own connection; what is shared is the thread, the
+    selector and the wakeup socket.
+
+    reconnect never runs here: paho's reconnect() blocks for the TCP connect
+    and TLS handshake. A client whose connection dropped is handed to
+    reconnect, usually Mqtt_connector.reconnect, and left alone until opened()
+    is called for it; without reconnect it stays closed.
+    """
+
+    def __init__(
+        self,
+        get_clients: Callable[[], Iterable[CayenneMQTTClient]],
+        reconnect: Optional[Callable[[CayenneMQTTClient], None]] = None,
+    ):
+        self.logger = homegrid_logger.Logger(__name__)
+        self.get_clients = get_clients
+        self.reconnect = reconnect
+        self.selector = selectors.DefaultSelector()
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ, None)
+        self.registered_sockets: Dict[CayenneMQTTClient, socket.socket] = {}
+        # Handed to reconnect and not opened again yet.
+        self.reconnecting: Set[CayenneMQTTClient] = set()
+        self.write_requests: Deque[CayenneMQTTClient] = collections.deque()
+        self.opened_clients: Deque[CayenneMQTTClient] = collections.deque()
+        self.stop_requested = False
+
+    def __request_write(self, mqtt_client, userdata, sock):
+        # Called from whichever thread published; userdata is the
+        # CayenneMQTTClient that owns mqtt_client.
+        self.watch(userdata)
+
+    def watch(self, client: CayenneMQTTClient):
+        """Thread-safe; starts servicing a client or picks up its queued output."""
+        self.write_requests.append(client)
+        self.wake()
+
+    def opened(self, client: CayenneMQTTClient):
+        """Thread-safe; starts servicing a client again once it is reopened."""
+        self.opened_clients.append(client)
+        self.wake()
+
+    def wake(self):
+        try:
+            self.wake_writer.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def stop(self):
+        self.stop_requested = True
+        self.wake()
+
+    def run(self, should_stop: Callable[[], bool] = lambda: False):
+        next_misc_time = 0.0
+        while not (self.stop_requested or should_stop()):
+            now = time.monotonic()
+            if now >= next_misc_time:
+                self.__service_misc()
+                for client in self.get_clients():
+                    self.__update_registration(client)
+                next_misc_time = now + config.MQTT_MISC_INTERVAL_SECONDS
+            while self.opened_clients:
+                client = self.opened_clients.popleft()
+                self.reconnecting.discard(client)
+                self.__update_registration(client)
+            while self.write_requests:
+                self.__update_registration(self.write_requests.popleft())
+            for key, mask in self.selector.select(
+                timeout=max(0.0, next_misc_time - time.monotonic())
+            ):
+                if key.data is None:
+                    self.__drain_wake_socket()
+                    continue
+                client: CayenneMQTTClient = key.data
+                try:
+                    if mask & selectors.EVENT_READ:
+                        client.client.loop_read()
+                        # TLS can hold decrypted bytes that select() never
+                        # reports as readable.
+                        sock = client.client.socket()
+                        while sock is not None and getattr(sock, "pending", int)():
+                            client.client.loop_read()
+                            sock = client.client.socket()
+                    if mask & selectors.EVENT_WRITE:
+                        client.client.loop_write()
+                except Exception as e:
+                    self.logger.error("Error: %s", e)
+                self.__update_registration(client)
+        for sock in self.registered_sockets.values():
+            self.selector.unregister(sock)
+        self.registered_sockets = {}
+
+    def __drain_wake_socket(self):
+        try:
+            while self.wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def __update_registration(self, client: CayenneMQTTClient):
+        mqtt_client = client.client
+        if mqtt_client is None or client in self.reconnecting:
+            return
+        if mqtt_client.on_socket_register_write is None:
+            # Publishes from other threads queue the packet and ask us to
+            # write it instead of writing to the socket themselves.
+            mqtt_client.on_socket_register_write = self.__request_write
+        sock = mqtt_client.socket()
+        registered = self.registered_sockets.get(client)
+        if registered is not None and registered is not sock:
+            self.selector.unregister(registered)
+            del self.registered_sockets[client]
+            registered = None
+        if sock is None:
+            return
+        events = selectors.EVENT_READ
+        if mqtt_client.want_write():
+            events |= selectors.EVENT_WRITE
+        if registered is None:
+            self.selector.register(sock, events, client)
+            self.registered_sockets[client] = sock
+        elif self.selector.get_key(sock).events != events:
+            self.selector.modify(sock, events, client)
+
+    def __service_misc(self):
+        for client in self.get_clients():
+            if client.client is None or client in self.reconnecting:
+                continue
+            try:
+                client.client.loop_misc()
+            except Exception as e:
+                self.logger.error("Error: %s", e)
+            if not client.connected and client.reconnect and self.reconnect is not None:
+                self.__hand_off(client)
+
+    def __hand_off(self, client: CayenneMQTTClient):
+        # Drop the closed socket first; the reconnecting client's socket is
+        # only touched again after opened().
+        self.__update_registration(client)
+        self.reconnecting.add(client)
+        self.reconnect(client)
+
+
+class Mqtt_asyncio_driver:
+    """
+    Services the sockets of every switch's MQTT client from an asyncio loop.
+
+    The asyncio counterpart of Mqtt_event_loop: each socket is watched with
+    add_reader(), and add_writer() while paho has output queued. Publishes
+    from other threads hand the client to the loop with
+    call_soon_threadsafe(). Nothing polls: loop_misc() runs every
+    MQTT_ASYNCIO_MISC_INTERVAL_SECONDS, which only has to beat Cayenne's 60 s
+    keepalive, because a dropped connection shows up as a readable socket
+    and is handed to reconnect right away. As in Mqtt_event_loop, the
+    blocking reconnect() never runs on the loop, which also reads the
+    coordinators; the client is left alone until opened() is called for it.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        get_clients: Callable[[], Iterable[CayenneMQTTClient]],
+        reconnect: Optional[Callable[[CayenneMQTTClient], None]] = None,
+    ):
+        self.logger = homegrid_logger.Logger(__name__)
+        self.loop = loop
+        self.get_clients = get_clients
+        self.reconnect = reconnect
+        self.registered_sockets: Dict[CayenneMQTTClient, socket.socket] = {}
+        self.writing: Dict[CayenneMQTTClient, bool] = {}
+        # Handed to reconnect and not opened again yet.
+        self.reconnecting: Set[CayenneMQTTClient] = set()
+        self.misc_handle: Optional[asyncio.TimerHandle] = None
+        self.stopped = False
+
+    def start(self):
+        for client in self.get_clients():
+            self.__update_registration(client)
+        self.misc_handle = self.loop.call_soon(self.__service_misc)
+
+    def stop(self):
+        self.stopped = True
+        if self.misc_handle is not None:
+            self.misc_handle.cancel()
+        for client, sock in self.registered_sockets.items():
+            self.__remove(client, sock)
+        self.registered_sockets = {}
+        self.writing = {}
+
+    def __request_write(self, mqtt_client, userdata, sock):
+        # Called from whichever thread published; userdata is the
+        # CayenneMQTTClient that owns mqtt_client.
+        self.watch(userdata)
+
+    def watch(self, client: CayenneMQTTClient):
+        """Thread-safe; starts servicing a client or picks up its queued output."""
+        try:
+            self.loop.call_soon_threadsafe(self.__update_registration, client)
+        except RuntimeError:
+            # The loop has already closed during shutdown.
+            pass
+
+    def opened(self, client: CayenneMQTTClient):
+        """Thread-safe; starts servicing a client again once it is reopened."""
+        try:
+            self.loop.call_soon_threadsafe(self.__on_opened, client)
+        except RuntimeError:
+            pass
+
+    def __on_opened(self, client: CayenneMQTTClient):
+        self.reconnecting.discard(client)
+        self.__update_registration(client)
+
+    def __on_readable(self, client: CayenneMQTTClient):
+        try:
+            client.client.loop_read()
+            # TLS can hold decrypted bytes that the loop never reports as
+            # readable.
+            sock = client.client.socket()
+            while sock is not None and getattr(sock, "pending", int)():
+                client.client.loop_read()
+                sock = client.client.socket()
+        except Exception as e:
+            self.logger.error("Error: %s", e)
+        self.__update_registration(client)
+
+    def __on_writable(self, client: CayenneMQTTClient):
+        try:
+            client.client.loop_write()
+        except Exception as e:
+            self.logger.error("Error: %s", e)
+        self.__update_registration(client)
+
+    def __update_registration(self, client: CayenneMQTTClient):
+        mqtt_client = client.client
+        if self.stopped or mqtt_client is None or client in self.reconnecting:
+            return
+        if mqtt_client.on_socket_register_write is None:
+            mqtt_client.on_socket_register_write = self.__request_write
+        sock = mqtt_client.socket()
+        registered = self.registered_sockets.get(client)
+        if registered is not None and registered is not sock:
+            self.__remove(client, registered)
+            del self.registered_sockets[client]
+            registered = None
+        if sock is None:
+            if not client.connected and client.reconnect and self.reconnect is not None:
+                # Closed; its socket is only touched again after opened().
+                self.reconnecting.add(client)
+                self.reconnect(client)
+            return
+        if registered is None:
+            self.loop.add_reader(sock, self.__on_readable, client)
+            self.registered_sockets[client] = sock
+        want_write = mqtt_client.want_write()
+        if want_write != self.writing.get(client, False):
+            if want_write:
+                self.loop.add_writer(sock, self.__on_writable, client)
+            else:
+                self.loop.remove_writer(sock)
+            self.writing[client] = want_write
+
+    def __remove(self, client: CayenneMQTTClient, sock: socket.socket):
+        # paho may already have closed sock, and the loop then only finds it
+        # while something is still registered for it: drop the writer first,
+        # and only if there is one.
+        if self.writing.pop(client, False):
+            self.loop.remove_writer(sock)
+        self.loop.remove_reader(sock)
+
+    def __service_misc(self):
+        for client in self.get_clients():
+            if client.client is None or client in self.reconnecting:
+                continue
+            try:
+                client.client.loop_misc()
+            except Exception as e:
+                self.logger.error("Error: %s", e)
+            self.__update_registration(client)
+        self.misc_handle = self.loop.call_later(
+            config.MQTT_ASYNCIO_MISC_INTERVAL_SECONDS, self.__service_misc
+        )
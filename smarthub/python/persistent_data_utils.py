@@ -8,30 +8,458 @@ __version__ = "1.0.0"
 
 
 
-from typing import List
+import glob
+from typing import Dict, List, Optional
 import config
 import logging
+import mmap
+import os
 import pickle
+import struct
+import threading
+import zlib
 
 import smartswitch
 
 
-def dump(switches, logger: logging.Logger):
+JOURNAL_RECORD_HEADER = struct.Struct("<II")  # payload length, payload crc32
+JOURNAL_UPDATE = "U"
+JOURNAL_REMOVE = "R"
+
+MAPPED_STATE_MAGIC = b"HGSTATE1"
+MAPPED_STATE_HEADER = struct.Struct("<8sIII")  # magic, record size, capacity, slots used
+MAPPED_STATE_HEADER_BYTES = 64
+# last_time_seen, kWh, cost, in use, power state, MAC, GUID; 128 bytes.
+MAPPED_STATE_RECORD = struct.Struct("<ddd??14x24s64s")
+MAPPED_STATE_IN_USE = struct.Struct("<?")
+MAPPED_STATE_IN_USE_OFFSET = 24
+
+
+def _write_atomically(filename: str, data: bytes):
+    temporary_filename = filename + ".tmp"
+    with open(temporary_filename, "wb") as fh:
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(temporary_filename, filename)
+    _fsync_directory(filename)
+
+
+def _fsync_directory(filename: str):
+    directory_fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+def journal_segment_filenames() -> List[str]:
+    # Segments are named <data file>.journal.<n>; replay order is numeric.
+    prefix = config.PERSISTENT_DATA_FILENAME + ".journal."
+    segments = []
+    for filename in glob.glob(glob.escape(prefix) + "*"):
+        suffix = filename[len(prefix) :]
+        if suffix.isdigit():
+            segments.append((int(suffix), filename))
+    return [filename for _, filename in sorted(segments)]
+
+
+def dump(switches, logger: logging.Logger, journal_sequence: int = 0):
     if logger is not None:
-        logger.debug(f"Saving to filename: {config.PERSISTENT_DATA_FILENAME}")
-    with open(config.PERSISTENT_DATA_FILENAME, "wb") as fh:
-        pickler = pickle.Pickler(fh)
-        pickler.dump(switches)
+        logger.debug("Saving to filename: %s", config.PERSISTENT_DATA_FILENAME)
+    if journal_sequence:
+        data = pickle.dumps({"journal_sequence": journal_sequence, "switches": switches})
+    else:
+        data = pickle.dumps(switches)
+    # Write a temporary file and rename it over the old one so a crash
+    # mid-write leaves the previous copy intact.
+    _write_atomically(config.PERSISTENT_DATA_FILENAME, data)
+    if not journal_sequence:
+        # A full dump supersedes any journal left behind by the journal backend.
+        for filename in journal_segment_filenames():
+            os.remove(filename)
 
 
 def load(logger: logging.Logger) -> List[smartswitch.SmartSwitch]:
+    return State_journal(logger).load()
+
+
+def load_with_journal_sequence(logger: logging.Logger):
     if logger is not None:
-        logger.debug(f"Opening from filename: {config.PERSISTENT_DATA_FILENAME}")
+        logger.debug("Opening from filename: %s", config.PERSISTENT_DATA_FILENAME)
     switches: List[smartswitch.SmartSwitch] = []
+    journal_sequence = 0
     try:
         with open(config.PERSISTENT_DATA_FILENAME, "rb") as fh:
-            switches = pickle.load(fh)
+            data = pickle.load(fh)
+        # Files written by compaction carry the journal sequence they cover.
+        if isinstance(data, dict):
+            switches = data["switches"]
+            journal_sequence = data["journal_sequence"]
+        else:
+            switches = data
     except Exception as e:
         if logger is not None:
-            logger.warn(f"Unable to load persistent data: {e}")
-    return switches
+            logger.warn("Unable to load persistent data: %s", e)
+    return switches, journal_sequence
+
+
+class State_journal:
+    """
+    Append-only log of per-switch state changes on top of the pickled file.
+
+    Each save appends one record per changed or removed switch. Records hold
+    absolute values rather than increments, so replay is last-write-wins and
+    records already covered by the compacted file are skipped by sequence.
+    Once the journal grows past JOURNAL_COMPACTION_BYTES a new segment is
+    started and the full state is written out in the background.
+    """
+
+    def __init__(self, logger: Optional[logging.Logger]):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.segment_number = 0
+        self.segment_fh = None
+        self.journal_bytes = 0
+        self.compaction_thread: Optional[threading.Thread] = None
+
+    def load(self) -> List[smartswitch.SmartSwitchSerializable]:
+        base_switches, base_sequence = load_with_journal_sequence(self.logger)
+        switches: Dict[str, smartswitch.SmartSwitchSerializable] = {
+            switch.MAC: switch for switch in base_switches
+        }
+        self.sequence = base_sequence
+        replayed = 0
+        segments = journal_segment_filenames()
+        for filename in segments:
+            for record in self.__read_segment(filename):
+                sequence, operation, MAC = record[0], record[1], record[2]
+                self.sequence = max(self.sequence, sequence)
+                if sequence <= base_sequence:
+                    continue
+                replayed += 1
+                if operation == JOURNAL_REMOVE:
+                    switches.pop(MAC, None)
+                else:
+                    switches[MAC] = smartswitch.SmartSwitchSerializable(*record[2:])
+            self.journal_bytes += os.path.getsize(filename)
+        if segments:
+            self.segment_number = int(segments[-1].rsplit(".", 1)[1])
+        if self.logger is not None:
+            self.logger.debug(
+                "Replayed %d Journal Records from %d Segments", replayed, len(segments)
+            )
+        return list(switches.values())
+
+    def __read_segment(self, filename: str):
+        with open(filename, "rb") as fh:
+            data = fh.read()
+        offset = 0
+        while offset + JOURNAL_RECORD_HEADER.size <= len(data):
+            length, crc = JOURNAL_RECORD_HEADER.unpack_from(data, offset)
+            payload = data[
+                offset + JOURNAL_RECORD_HEADER.size : offset
+                + JOURNAL_RECORD_HEADER.size
+                + length
+            ]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                # A torn record from a crash mid-append ends the segment.
+                if self.logger is not None:
+                    self.logger.warn("Truncated Journal Record in %s", filename)
+                return
+            yield pickle.loads(payload)
+            offset += JOURNAL_RECORD_HEADER.size + length
+
+    def __open_next_segment(self):
+        if self.segment_fh is not None:
+            self.segment_fh.close()
+        self.segment_number += 1
+        self.segment_fh = open(
+            f"{config.PERSISTENT_DATA_FILENAME}.journal.{self.segment_number}", "ab"
+        )
+
+    def append(
+        self,
+        changed: List[smartswitch.SmartSwitchSerializable],
+        removed_MACs: List[str],
+    ):
+        if not changed and not removed_MACs:
+            return
+        with self.lock:
+            records = []
+            for MAC in removed_MACs:
+                self.sequence += 1
+                records.append((self.sequence, JOURNAL_REMOVE, MAC))
+            for switch in changed:
+                self.sequence += 1
+                records.append(
+                    (
+                        self.sequence,
+                        JOURNAL_UPDATE,
+                        switch.MAC,
+                        switch.GUID,
+                        switch.last_time_seen,
+                        switch.current_power_state,
+                        switch.cumulative_power_consumption_kwh,
+                        switch.cumulative_power_cost_dollars,
+                    )
+                )
+            chunks = []
+            for record in records:
+                payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+                chunks.append(
+                    JOURNAL_RECORD_HEADER.pack(len(payload), zlib.crc32(payload))
+                )
+                chunks.append(payload)
+            data = b"".join(chunks)
+            if self.segment_fh is None:
+                self.__open_next_segment()
+            self.segment_fh.write(data)
+            self.segment_fh.flush()
+            os.fsync(self.segment_fh.fileno())
+            self.journal_bytes += len(data)
+
+    def needs_compaction(self) -> bool:
+        return self.journal_bytes > config.JOURNAL_COMPACTION_BYTES and not (
+            self.compaction_thread is not None and self.compaction_thread.is_alive()
+        )
+
+    def compact(self, switches: List[smartswitch.SmartSwitchSerializable]):
+        # switches must reflect every record appended so far. New appends go
+        # to a fresh segment while the background thread writes the full
+        # state and then drops the segments it covers.
+        with self.lock:
+            sequence = self.sequence
+            self.__open_next_segment()
+            covered_segments = [
+                filename
+                for filename in journal_segment_filenames()
+                if int(filename.rsplit(".", 1)[1]) < self.segment_number
+            ]
+            self.journal_bytes = 0
+        self.compaction_thread = threading.Thread(
+            target=self.__compact, args=(list(switches), sequence, covered_segments)
+        )
+        self.compaction_thread.start()
+
+    def __compact(self, switches, sequence: int, covered_segments: List[str]):
+        try:
+            dump(switches, self.logger, journal_sequence=sequence)
+            for filename in covered_segments:
+                os.remove(filename)
+            if self.logger is not None:
+                self.logger.debug(
+                    "Compacted %d Journal Segments into %d Switches",
+                    len(covered_segments),
+                    len(switches),
+                )
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error("Journal Compaction Failed: %s", e)
+
+    def close(self):
+        if self.compaction_thread is not None:
+            self.compaction_thread.join()
+        with self.lock:
+            if self.segment_fh is not None:
+                self.segment_fh.close()
+                self.segment_fh = None
+
+
+class Mapped_state_record:
+    """One switch's slot in a Mapped_state_file."""
+
+    __slots__ = ("state_file", "offset")
+
+    def __init__(self, state_file: "Mapped_state_file", offset: int):
+        self.state_file = state_file
+        self.offset = offset
+
+    def write(self, switch: smartswitch.SmartSwitch):
+        # Must be called with the switch lock held.
+        MAPPED_STATE_RECORD.pack_into(
+            self.state_file.mm,
+            self.offset,
+            switch.last_time_seen,
+            switch.cumulative_power_consumption_kwh,
+            switch.cumulative_power_cost_dollars,
+            True,
+            switch.current_power_state,
+            _encode_field(switch.MAC, 24),
+            _encode_field(switch.GUID, 64),
+        )
+
+
+def _encode_field(value: str, size: int) -> bytes:
+    encoded = value.encode()
+    # struct would silently truncate it.
+    if len(encoded) > size:
+        raise ValueError(f"'{value}' is Longer than {size} Bytes")
+    return encoded
+
+
+class Mapped_state_file:
+    """
+    Switch state kept as fixed-width records in a memory-mapped file.
+
+    Each switch owns one MAPPED_STATE_RECORD slot, which
+    SmartSwitch.update_snapshot overwrites in place under the switch lock, so
+    a save is an msync of the dirty pages: nothing is pickled and no lock is
+    taken. Startup maps the file and builds switches straight from the
+    records.
+
+    A hub crash loses nothing, since the writes are already in the page
+    cache; a power loss loses what changed since the last msync and can
+    leave a record with fields from two readings. A missing file is created
+    from the pickle and journal files so the backend can be switched on an
+    existing hub.
+    """
+
+    def __init__(self, logger: Optional[logging.Logger], filename: Optional[str] = None):
+        self.logger = logger
+        self.filename = (
+            config.PERSISTENT_DATA_FILENAME + ".mmap" if filename is None else filename
+        )
+        # Serializes slot allocation and growth; record writes only need the
+        # switch lock.
+        self.lock = threading.Lock()
+        self.fh = None
+        self.mm: Optional[mmap.mmap] = None
+        self.capacity = 0
+        self.used = 0
+        self.free_slots: List[int] = []
+
+    def __file_size(self, capacity: int) -> int:
+        return MAPPED_STATE_HEADER_BYTES + capacity * MAPPED_STATE_RECORD.size
+
+    def __write_header(self):
+        MAPPED_STATE_HEADER.pack_into(
+            self.mm, 0, MAPPED_STATE_MAGIC, MAPPED_STATE_RECORD.size, self.capacity, self.used
+        )
+
+    def __create(self, capacity: int):
+        self.fh = open(self.filename, "w+b")
+        self.fh.truncate(self.__file_size(capacity))
+        self.mm = mmap.mmap(self.fh.fileno(), 0)
+        self.capacity = capacity
+        self.used = 0
+        self.__write_header()
+
+    def load(self) -> List[smartswitch.SmartSwitch]:
+        if self.logger is not None:
+            self.logger.debug("Mapping %s", self.filename)
+        if os.path.exists(self.filename):
+            try:
+                return self.__map_existing()
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.error("Unable to Map %s, Setting it Aside: %s", self.filename, e)
+                self.close()
+                os.replace(self.filename, self.filename + ".corrupt")
+        return self.__import_legacy()
+
+    def __map_existing(self) -> List[smartswitch.SmartSwitch]:
+        self.fh = open(self.filename, "r+b")
+        self.mm = mmap.mmap(self.fh.fileno(), 0)
+        magic, record_size, capacity, used = MAPPED_STATE_HEADER.unpack_from(self.mm, 0)
+        if (
+            magic != MAPPED_STATE_MAGIC
+            or record_size != MAPPED_STATE_RECORD.size
+            or used > capacity
+            or len(self.mm) < self.__file_size(capacity)
+        ):
+            raise ValueError("Bad Header")
+        self.capacity = capacity
+        self.used = used
+        switches = []
+        end = MAPPED_STATE_HEADER_BYTES + used * MAPPED_STATE_RECORD.size
+        records = MAPPED_STATE_RECORD.iter_unpack(self.mm[MAPPED_STATE_HEADER_BYTES:end])
+        for slot, record in enumerate(records):
+            last_time_seen, kwh, cost, in_use, power_state, MAC, GUID = record
+            if not in_use:
+                self.free_slots.append(slot)
+                continue
+            switch = smartswitch.SmartSwitch(
+                MAC.rstrip(b"\0").decode(),
+                GUID.rstrip(b"\0").decode(),
+                last_time_seen,
+                power_state,
+                kwh,
+                cost,
+            )
+            switch.state_record = Mapped_state_record(
+                self, MAPPED_STATE_HEADER_BYTES + slot * MAPPED_STATE_RECORD.size
+            )
+            switches.append(switch)
+        if self.logger is not None:
+            self.logger.debug("Mapped %d Switches, %d Free Slots", len(switches), len(self.free_slots))
+        return switches
+
+    def __import_legacy(self) -> List[smartswitch.SmartSwitch]:
+        switches = [
+            smartswitch.smart_switch_serializable_to_switch(switch)
+            for switch in State_journal(self.logger).load()
+        ]
+        self.__create(max(config.MAPPED_STATE_INITIAL_CAPACITY, 2 * len(switches)))
+        for switch in switches:
+            self.attach(switch)
+        self.flush()
+        if self.logger is not None:
+            self.logger.info("Imported %d Switches into %s", len(switches), self.filename)
+        return switches
+
+    def attach(self, switch: smartswitch.SmartSwitch):
+        """Gives a switch that has no record one and writes its state to it."""
+        with self.lock:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+            else:
+                if self.used == self.capacity:
+                    self.__grow()
+                slot = self.used
+                self.used += 1
+                self.__write_header()
+            record = Mapped_state_record(
+                self, MAPPED_STATE_HEADER_BYTES + slot * MAPPED_STATE_RECORD.size
+            )
+            try:
+                with switch.acquire_lock():
+                    record.write(switch)
+                    switch.state_record = record
+            except ValueError:
+                self.free_slots.append(slot)
+                raise
+
+    def release(self, switch: smartswitch.SmartSwitch):
+        with self.lock:
+            with switch.acquire_lock():
+                record = switch.state_record
+                if record is None:
+                    return
+                switch.state_record = None
+                MAPPED_STATE_IN_USE.pack_into(
+                    self.mm, record.offset + MAPPED_STATE_IN_USE_OFFSET, False
+                )
+            self.free_slots.append(
+                (record.offset - MAPPED_STATE_HEADER_BYTES) // MAPPED_STATE_RECORD.size
+            )
+
+    def __grow(self):
+        # Records write through self.mm on every call, so resizing the one
+        # mapping in place keeps them valid.
+        self.capacity *= 2
+        self.mm.resize(self.__file_size(self.capacity))
+        self.__write_header()
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
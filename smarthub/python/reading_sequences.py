@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Reading Sequences Module
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import config
+import homegrid_logger
+import metrics
+import threading
+from typing import Callable, Dict
+from xbee_message_parser import TELEMETRY_SEQUENCE_MODULUS, Xbee_coordinator_message
+
+
+class Reading_sequences:
+    """
+    Follows the sequence numbers of plugs sending binary telemetry frames.
+
+    A gap since a plug's previous reading counts the readings lost on the
+    air. A repeat of the previous number, or one at most
+    READING_SEQUENCE_REORDER_WINDOW behind it, arrived late or twice and is
+    dropped so it is not credited again. Number 0 is only sent first after a
+    plug starts, and is taken as its new start, as is a number further
+    behind, in case that first frame was lost. Readings in the text format
+    carry no number and are always accepted.
+
+    Like the Coordinator_router's routes, each plug's entry is replaced by
+    one dict assignment from the receiver that heard it, without a lock.
+    """
+
+    def __init__(self, is_known: Callable[[str], bool] = lambda MAC: True):
+        self.logger = homegrid_logger.Logger(__name__)
+        # Only switches the hub knows are followed, so noise cannot grow the
+        # table.
+        self.is_known = is_known
+        self.last: Dict[str, int] = {}
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.lost = 0
+        self.out_of_order = 0
+        self.restarts = 0
+
+    def __len__(self) -> int:
+        return len(self.last)
+
+    def accept(self, message: Xbee_coordinator_message) -> bool:
+        """Returns False for a reading that should be dropped."""
+        sequence = message.sequence
+        if sequence is None:
+            return True
+        previous = self.last.get(message.MAC)
+        if previous is None:
+            if self.is_known(message.MAC):
+                self.last[message.MAC] = sequence
+            return True
+        ahead = (sequence - previous) % TELEMETRY_SEQUENCE_MODULUS
+        behind = TELEMETRY_SEQUENCE_MODULUS - ahead
+        if 0 == sequence and 0 != previous:
+            ahead = TELEMETRY_SEQUENCE_MODULUS
+        elif 0 == ahead or behind <= config.READING_SEQUENCE_REORDER_WINDOW:
+            with self.stats_lock:
+                self.out_of_order += 1
+            metrics.READINGS_OUT_OF_ORDER.inc()
+            return False
+        self.last[message.MAC] = sequence
+        if ahead > TELEMETRY_SEQUENCE_MODULUS // 2:
+            with self.stats_lock:
+                self.restarts += 1
+            self.logger.info(
+                "Switch %s Restarted its Sequence at %d, was %d", message.MAC, sequence, previous
+            )
+        elif ahead > 1:
+            with self.stats_lock:
+                self.lost += ahead - 1
+            metrics.READINGS_LOST.inc(ahead - 1)
+        return True
+
+    def take_stats(self) -> Dict[str, int]:
+        """Returns statistics since the previous call and resets them."""
+        with self.stats_lock:
+            report = {
+                "lost": self.lost,
+                "out_of_order": self.out_of_order,
+                "restarts": self.restarts,
+                "followed": len(self.last),
+            }
+            self.reset_stats()
+        return report
+
+    def log_stats(self):
+        stats = self.take_stats()
+        if 0 == stats["followed"]:
+            return
+        self.logger.info(
+            "Reading Sequences: %d switches, %d readings lost, %d out of order, %d restarts",
+            stats["followed"],
+            stats["lost"],
+            stats["out_of_order"],
+            stats["restarts"],
+        )
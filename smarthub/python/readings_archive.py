@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Readings Archive Module
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import config
+import homegrid_logger
+import metrics
+import queue
+import sqlite3
+import threading
+import time
+from telemetry_publisher import Switch_telemetry
+from typing import Dict, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS switches (
+    id INTEGER PRIMARY KEY,
+    GUID TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS readings (
+    switch_id INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    power_state INTEGER NOT NULL,
+    power_draw REAL NOT NULL,
+    voltage REAL NOT NULL,
+    cumulative_power_consumption_kwh REAL NOT NULL,
+    cumulative_power_cost_dollars REAL NOT NULL,
+    PRIMARY KEY (switch_id, timestamp)
+) WITHOUT ROWID;
+"""
+
+ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup_{resolution} (
+    switch_id INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    power_sum REAL NOT NULL,
+    power_min REAL NOT NULL,
+    power_max REAL NOT NULL,
+    voltage_sum REAL NOT NULL,
+    voltage_min REAL NOT NULL,
+    voltage_max REAL NOT NULL,
+    cumulative_power_consumption_kwh REAL NOT NULL,
+    cumulative_power_cost_dollars REAL NOT NULL,
+    PRIMARY KEY (switch_id, bucket)
+) WITHOUT ROWID;
+"""
+
+INSERT_READING = "INSERT OR IGNORE INTO readings VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+# Merges the buckets of one batch's newly inserted readings into what
+# earlier batches left; the cumulative counters only grow, so the newest
+# value is the largest.
+UPSERT_ROLLUP = """
+INSERT INTO rollup_{resolution} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (switch_id, bucket) DO UPDATE SET
+    count = count + excluded.count,
+    power_sum = power_sum + excluded.power_sum,
+    power_min = min(power_min, excluded.power_min),
+    power_max = max(power_max, excluded.power_max),
+    voltage_sum = voltage_sum + excluded.voltage_sum,
+    voltage_min = min(voltage_min, excluded.voltage_min),
+    voltage_max = max(voltage_max, excluded.voltage_max),
+    cumulative_power_consumption_kwh = max(
+        cumulative_power_consumption_kwh, excluded.cumulative_power_consumption_kwh
+    ),
+    cumulative_power_cost_dollars = max(
+        cumulative_power_cost_dollars, excluded.cumulative_power_cost_dollars
+    )
+"""
+
+SELECT_READINGS = """
+SELECT timestamp, power_state, power_draw, voltage,
+    cumulative_power_consumption_kwh, cumulative_power_cost_dollars
+FROM readings JOIN switches ON switches.id = readings.switch_id
+WHERE switches.GUID = ? AND timestamp >= ? AND timestamp < ?
+ORDER BY timestamp
+"""
+
+SELECT_ROLLUPS = """
+SELECT bucket * {resolution}, count,
+    power_sum / count, power_min, power_max,
+    voltage_sum / count, voltage_min, voltage_max,
+    cumulative_power_consumption_kwh, cumulative_power_cost_dollars
+FROM rollup_{resolution} JOIN switches ON switches.id = rollup_{resolution}.switch_id
+WHERE switches.GUID = ? AND bucket >= ? AND bucket < ?
+ORDER BY bucket
+"""
+
+
+def open_database(filename: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(filename, check_same_thread=False)
+    # WAL lets queries read while the writer thread commits, and with it
+    # synchronous=NORMAL only syncs at checkpoints rather than every commit.
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    for resolution in config.ARCHIVE_ROLLUPS:
+        connection.executescript(ROLLUP_SCHEMA.format(resolution=resolution))
+    return connection
+
+
+class Readings_archive:
+    """
+    Keeps a local history of every reading in a SQLite database.
+
+    archive() only queues the Switch_telemetry record, so a Zigbee worker
+    never waits on the disk. The writer thread collects readings for up to
+    ARCHIVE_BATCH_INTERVAL_SECONDS and inserts them, together with the
+    matching updates to each ARCHIVE_ROLLUPS table, in one transaction. A
+    reading already archived under the same switch and timestamp, from a
+    replayed batch or a coordinator failover, is ignored and counted, and
+    is left out of the rollups too. Raw readings and each rollup are deleted
+    once older than their retention. If ARCHIVE_QUEUE_SIZE readings are
+    already waiting, further readings are dropped and counted.
+    """
+
+    STOP = None
+
+    def __init__(self):
+        self.logger = homegrid_logger.Logger(__name__)
+        self.archive_queue = queue.Queue(config.ARCHIVE_QUEUE_SIZE)
+        self.thread: Optional[threading.Thread] = None
+        self.connection: Optional[sqlite3.Connection] = None
+        self.filename: Optional[str] = None
+        self.switch_ids: Dict[str, int] = {}
+        # Each querying thread gets its own read-only connection.
+        self.readers = threading.local()
+        self.next_retention_time = 0.0
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.archived = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.batches = 0
+
+    def start(self, filename: Optional[str] = None):
+        self.filename = config.ARCHIVE_FILENAME if filename is None else filename
+        self.connection = open_database(self.filename)
+        self.thread = threading.Thread(target=self.__writer_thread, name="readings-archive")
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.archive_queue.put(self.STOP)
+        self.thread.join()
+        self.thread = None
+        self.connection.close()
+
+    def archive(self, telemetry: Switch_telemetry):
+        if self.thread is None:
+            return
+        try:
+            self.archive_queue.put_nowait(telemetry)
+        except queue.Full:
+            with self.stats_lock:
+                self.dropped += 1
+            metrics.ARCHIVE_DROPPED.inc()
+
+    def __writer_thread(self):
+        running = True
+        while running:
+            try:
+                item = self.archive_queue.get(timeout=config.ARCHIVE_RETENTION_INTERVAL_SECONDS)
+            except queue.Empty:
+                self.__maybe_enforce_retention()
+                continue
+            batch: List[Switch_telemetry] = []
+            deadline = time.monotonic() + config.ARCHIVE_BATCH_INTERVAL_SECONDS
+            while True:
+                if item is self.STOP:
+                    running = False
+                    break
+                batch.append(item)
+                if len(batch) >= config.ARCHIVE_BATCH_SIZE:
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.archive_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self.insert(batch)
+                except sqlite3.Error as e:
+                    # The rollback may have taken new switch ids with it.
+                    self.switch_ids.clear()
+                    self.logger.error("Failed to Archive %d Readings: %s", len(batch), e)
+            self.__maybe_enforce_retention()
+
+    def __switch_id(self, GUID: str) -> int:
+        switch_id = self.switch_ids.get(GUID)
+        if switch_id is None:
+            self.connection.execute("INSERT OR IGNORE INTO switches (GUID) VALUES (?)", (GUID,))
+            switch_id = self.connection.execute(
+                "SELECT id FROM switches WHERE GUID = ?", (GUID,)
+            ).fetchone()[0]
+            self.switch_ids[GUID] = switch_id
+        return switch_id
+
+    def insert(self, batch: List[Switch_telemetry]):
+        """Archives a batch in one transaction; only the writer thread calls this."""
+        start_time = time.perf_counter()
+        inserted = 0
+        # Aggregated in Python first so each bucket a batch touches is one
+        # upsert rather than one per reading.
+        rollups: Dict[int, Dict[Tuple[int, int], list]] = {
+            resolution: {} for resolution in config.ARCHIVE_ROLLUPS
+        }
+        execute = self.connection.execute
+        with self.connection:
+            for telemetry in batch:
+                switch_id = self.__switch_id(telemetry.GUID)
+                power_draw = telemetry.power_draw
+                voltage = telemetry.voltage
+                kwh = telemetry.cumulative_power_consumption_kwh
+                cost = telemetry.cumulative_power_cost_dollars
+                # Only a reading the table did not hold yet goes into the
+                # rollups.
+                if not execute(
+                    INSERT_READING,
+                    (
+                        switch_id,
+                        telemetry.timestamp,
+                        telemetry.power_state,
+                        power_draw,
+                        voltage,
+                        kwh,
+                        cost,
+                    ),
+                ).rowcount:
+                    continue
+                inserted += 1
+                for resolution, buckets in rollups.items():
+                    key = (switch_id, int(telemetry.timestamp // resolution))
+                    bucket = buckets.get(key)
+                    if bucket is None:
+                        buckets[key] = [
+                            1,
+                            power_draw,
+                            power_draw,
+                            power_draw,
+                            voltage,
+                            voltage,
+                            voltage,
+                            kwh,
+                            cost,
+                        ]
+                        continue
+                    bucket[0] += 1
+                    bucket[1] += power_draw
+                    bucket[2] = min(bucket[2], power_draw)
+                    bucket[3] = max(bucket[3], power_draw)
+                    bucket[4] += voltage
+                    bucket[5] = min(bucket[5], voltage)
+                    bucket[6] = max(bucket[6], voltage)
+                    bucket[7] = max(bucket[7], kwh)
+                    bucket[8] = max(bucket[8], cost)
+            for resolution, buckets in rollups.items():
+                self.connection.executemany(
+                    UPSERT_ROLLUP.format(resolution=resolution),
+                    [key + tuple(values) for key, values in buckets.items()],
+                )
+        metrics.ARCHIVE_INSERT_SECONDS.observe(time.perf_counter() - start_time)
+        metrics.ARCHIVE_READINGS.inc(inserted)
+        if inserted < len(batch):
+            metrics.ARCHIVE_DUPLICATES.inc(len(batch) - inserted)
+        with self.stats_lock:
+            self.archived += inserted
+            self.duplicates += len(batch) - inserted
+            self.batches += 1
+
+    def __maybe_enforce_retention(self):
+        if time.monotonic() < self.next_retention_time:
+            return
+        self.next_retention_time = time.monotonic() + config.ARCHIVE_RETENTION_INTERVAL_SECONDS
+        try:
+            self.enforce_retention(time.time())
+        except sqlite3.Error as e:
+            self.logger.error("Failed to Enforce Archive Retention: %s", e)
+
+    def enforce_retention(self, now: float):
+        # One range delete per switch walks the (switch_id, time) primary
+        # key; a single delete on time alone would scan the whole table.
+        switch_ids = [row[0] for row in self.connection.execute("SELECT id FROM switches")]
+        deleted = 0
+        with self.connection:
+            cutoff = now - config.ARCHIVE_RAW_RETENTION_SECONDS
+            for switch_id in switch_ids:
+                deleted += self.connection.execute(
+                    "DELETE FROM readings WHERE switch_id = ? AND timestamp < ?",
+                    (switch_id, cutoff),
+                ).rowcount
+            for resolution, retention_seconds in config.ARCHIVE_ROLLUPS.items():
+                if retention_seconds is None:
+                    continue
+                cutoff_bucket = int((now - retention_seconds) // resolution)
+                for switch_id in switch_ids:
+                    deleted += self.connection.execute(
+                        f"DELETE FROM rollup_{resolution} WHERE switch_id = ? AND bucket < ?",
+                        (switch_id, cutoff_bucket),
+                    ).rowcount
+        if deleted:
+            self.logger.info("Deleted %d Archived Rows Past Retention", deleted)
+
+    def __reader(self) -> sqlite3.Connection:
+        connection = getattr(self.readers, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.filename}?mode=ro", uri=True)
+            self.readers.connection = connection
+        return connection
+
+    def readings(self, GUID: str, start: float, end: float) -> List[tuple]:
+        """
+        Raw readings of a switch with start <= timestamp < end, as
+        (timestamp, power_state, power_draw, voltage, kWh, dollars).
+        """
+        return self.__reader().execute(SELECT_READINGS, (GUID, start, end)).fetchall()
+
+    def rollups(self, GUID: str, resolution: int, start: float, end: float) -> List[tuple]:
+        """
+        Rollups of a switch at one ARCHIVE_ROLLUPS resolution for the buckets
+        overlapping [start, end), as (bucket start, count, power mean, min,
+        max, voltage mean, min, max, kWh, dollars).
+        """
+        if resolution not in config.ARCHIVE_ROLLUPS:
+            raise ValueError(f"No {resolution} s Rollup in the Archive")
+        return (
+            self.__reader()
+            .execute(
+                SELECT_ROLLUPS.format(resolution=resolution),
+                (GUID, int(start // resolution), int(-(-end // resolution))),
+            )
+            .fetchall()
+        )
+
+    def take_stats(self) -> Dict[str, int]:
+        """Returns statistics since the previous call and resets them."""
+        with self.stats_lock:
+            report = {
+                "archived": self.archived,
+                "duplicates": self.duplicates,
+                "dropped": self.dropped,
+                "batches": self.batches,
+                "queued": self.archive_queue.qsize(),
+            }
+            self.reset_stats()
+        return report
+
+    def log_stats(self):
+        if self.thread is None:
+            return
+        stats = self.take_stats()
+        if not (stats["archived"] or stats["duplicates"] or stats["dropped"]):
+            return
+        self.logger.info(
+            "Archive: archived %d in %d batches, %d duplicates, dropped %d, queued %d",
+            stats["archived"],
+            stats["batches"],
+            stats["duplicates"],
+            stats["dropped"],
+            stats["queued"],
+        )
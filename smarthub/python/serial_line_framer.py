@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Serial Line Framer Module
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+from typing import List
+
+
+class Serial_line_framer:
+    """
+    Splits a byte stream from the coordinator into text lines.
+
+    Bytes are fed in whatever chunks the serial port returns; a line split
+    across reads stays in the reusable buffer until its terminator arrives.
+    """
+
+    def __init__(self, max_line_bytes: int = 4096):
+        self.buffer = bytearray()
+        self.max_line_bytes = max_line_bytes
+        self.discarded_bytes = 0
+
+    def feed(self, data: bytes) -> List[str]:
+        self.buffer += data
+        end = self.buffer.rfind(b"\n")
+        if end < 0:
+            if len(self.buffer) > self.max_line_bytes:
+                # Noise without a terminator; drop it rather than grow forever.
+                self.discarded_bytes += len(self.buffer)
+                del self.buffer[:]
+            return []
+        complete = self.buffer[:end].decode(errors="replace")
+        del self.buffer[: end + 1]
+        lines = [line.strip() for line in complete.split("\n")]
+        return [line for line in lines if line]
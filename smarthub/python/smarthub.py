@@ -8,18 +8,35 @@ __version__ = "1.0.0"
 
 
 from active_switch_list import Active_switch_list
-from cayenne.client import CayenneMessage
+import asyncio
+from cayenne.client import CayenneMessage, CayenneMQTTClient
 import cayenne_message_parser
+from command_scheduler import Command_scheduler
+from concurrent.futures import ThreadPoolExecutor
 import config
+from coordinators import Coordinator, Coordinator_router
 import threading
-import logging
+import homegrid_logger
+import metrics
+from mqtt_connector import Mqtt_connector
+from mqtt_event_loop import Mqtt_asyncio_driver, Mqtt_event_loop
 import queue
-import serial
+from reading_sequences import Reading_sequences
+from readings_archive import Readings_archive
+from serial_line_framer import Serial_line_framer
 import signal
 from smartswitch import SmartSwitch
+from telemetry_publisher import Switch_telemetry, Telemetry_publisher
 import time
-from typing import List
-from xbee_message_parser import xbee_message_to_object, Xbee_coordinator_message
+from typing import List, Optional
+from unknown_switches import Switch_provisioner, Unknown_MAC_cache
+from xbee_message_parser import (
+    unframe_coordinator_line,
+    xbee_message_to_object,
+    Xbee_coordinator_message,
+)
+from zigbee_process_pool import Zigbee_process_pool
+from zigbee_worker_pool import Zigbee_worker_pool
 
 
 class SmartHub:
@@ -31,32 +48,172 @@ class SmartHub:
 
     active_switch_list: Active_switch_list = Active_switch_list()
 
-    serial_port = serial.Serial("/dev/ttyUSB0", baudrate=115200, timeout=2)
+    telemetry_publisher: Telemetry_publisher = Telemetry_publisher()
+
+    readings_archive: Readings_archive = Readings_archive()
+
+    coordinator_router: Coordinator_router = None
+
+    reading_sequences: Reading_sequences = None
 
     global_shutdown_requested = False
 
-    logger = logging.getLogger(__name__)
+    mqtt_connector: Mqtt_connector = None
+
+    unknown_MACs: Unknown_MAC_cache = Unknown_MAC_cache()
+
+    start_time = 0.0
+
+    first_reading_seconds: Optional[float] = None
+
+    first_reading_lock = threading.Lock()
+
+    logger = homegrid_logger.Logger(__name__)
 
     def __run_initialization(self):
-        self.__init_logger()
+        self.__open_coordinators()
         self.__initialize_active_switch_list()
-        self.__attach_signal_handlers()
+        if "processes" == config.ZIGBEE_WORKER_MODE:
+            self.zigbee_worker_pool = Zigbee_process_pool(
+                self.active_switch_list,
+                self.__handle_processed_reading,
+                self.__handle_unknown_MAC,
+                config.ZIGBEE_WORKER_COUNT,
+            )
+        else:
+            self.zigbee_worker_pool = Zigbee_worker_pool(
+                self.__handle_zigbee_message, config.ZIGBEE_WORKER_COUNT
+            )
+        self.command_scheduler = Command_scheduler(self.coordinator_router.write)
+        self.switch_provisioner = Switch_provisioner(
+            self.active_switch_list, self.unknown_MACs, self.__on_switch_provisioned
+        )
+        self.__register_queue_gauges()
+
+    def __register_queue_gauges(self):
+        for name in [
+            "cloud_message_queue",
+            "zigbee_message_queue",
+            "cloud_job_queue",
+            "zigbee_job_queue",
+        ]:
+            metrics.REGISTRY.gauge(
+                f"homegrid_{name}_depth",
+                f"Items waiting in SmartHub.{name}.",
+                getattr(self, name).qsize,
+            )
+        metrics.REGISTRY.gauge(
+            "homegrid_telemetry_queue_depth",
+            "Telemetry records waiting to be published.",
+            self.telemetry_publisher.telemetry_queue.qsize,
+        )
+        metrics.REGISTRY.gauge(
+            "homegrid_archive_queue_depth",
+            "Readings waiting to be archived.",
+            self.readings_archive.archive_queue.qsize,
+        )
+        metrics.REGISTRY.gauge(
+            "homegrid_zigbee_shard_queue_depth_max",
+            "Deepest Zigbee worker pool shard queue.",
+            lambda: max(self.zigbee_worker_pool.queue_depths()),
+        )
+        metrics.REGISTRY.gauge(
+            "homegrid_commands_pending",
+            "Power commands written or waiting to be, and not yet confirmed.",
+            self.command_scheduler.pending,
+        )
+        metrics.REGISTRY.gauge(
+            "homegrid_coordinators_silent",
+            "Coordinators with no readings for COORDINATOR_SILENT_SECONDS.",
+            self.coordinator_router.silent_count,
+        )
+        metrics.REGISTRY.gauge(
+            "homegrid_coordinator_routes",
+            "Switches with a learned coordinator route.",
+            lambda: len(self.coordinator_router.routes),
+        )
+        metrics.REGISTRY.gauge(
+            "homegrid_unknown_macs_cached",
+            "MACs with readings but no switch, remembered so each is reported once.",
+            lambda: len(self.unknown_MACs),
+        )
+        metrics.REGISTRY.gauge(
+            "homegrid_mqtt_clients_connected",
+            "Switches whose MQTT client is connected to Cayenne.",
+            lambda: sum(1 for client in self.__get_mqtt_clients() if client.connected),
+        )
+        metrics.REGISTRY.gauge(
+            "homegrid_telemetry_waiting_switches",
+            "Switches whose newest telemetry is held back until they connect.",
+            lambda: len(self.telemetry_publisher.waiting),
+        )
+        metrics.REGISTRY.gauge(
+            "homegrid_time_to_first_reading_seconds",
+            "Time from start-up to the first reading being processed.",
+            lambda: float("nan")
+            if self.first_reading_seconds is None
+            else self.first_reading_seconds,
+        )
 
     def __initialize_active_switch_list(self):
         self.active_switch_list.load_persistent_data()
-        self.active_switch_list.initialize_clients(self.__cloud_receiver_callback)
 
-    def __init_logger(self):
-        logging.basicConfig(format=config.LOGGING_FORMAT)
-        self.logger.setLevel(config.LOG_LEVEL)
+    def __start_mqtt_connector(self, opened):
+        # Started once the MQTT loop exists to watch each connection as it
+        # opens; readings are processed from the start and telemetry for a
+        # switch waits in the publisher until it connects.
+        self.mqtt_connector = self.active_switch_list.initialize_clients(
+            self.__cloud_receiver_callback,
+            on_open=opened,
+            on_connected=lambda switch: self.telemetry_publisher.client_connected(
+                switch.GUID, switch.client
+            ),
+        )
+
+    def __reconnect_mqtt_client(self, client: CayenneMQTTClient):
+        # Called by the MQTT loop for a dropped connection, which is reopened
+        # by the connector's threads rather than on the loop.
+        if self.mqtt_connector is not None:
+            self.mqtt_connector.reconnect(client)
+
+    def __on_switch_provisioned(self, switch: SmartSwitch):
+        if self.mqtt_connector is not None:
+            self.mqtt_connector.connect(switch)
+
+    def __get_mqtt_clients(self):
+        return [
+            switch.client
+            for switch in self.active_switch_list.active_switches
+            if switch.client is not None
+        ]
+
+    def __open_coordinators(self):
+        self.coordinator_router = Coordinator_router(
+            config.SERIAL_PORTS or [config.SERIAL_PORT],
+            lambda MAC: self.active_switch_list.get_switch_from_MAC(MAC) is not None,
+        )
+        self.coordinator_router.open()
+        self.reading_sequences = Reading_sequences(
+            lambda MAC: self.active_switch_list.get_switch_from_MAC(MAC) is not None
+        )
+
+    def __reopen_coordinator(self, coordinator: Coordinator) -> bool:
+        try:
+            coordinator.open()
+        except Exception as e:
+            self.logger.error("Unable to Reopen %s: %s", coordinator, e)
+            return False
+        self.logger.info("Reopened %s", coordinator)
+        return True
 
     def __attach_signal_handlers(self):
         signal.signal(signal.SIGTERM, self.__shutdown_handler)
         signal.signal(signal.SIGINT, self.__shutdown_handler)
 
     def __shutdown_handler(self, signum, frame):
-        self.logger.info(f"Received Shutdown Signal {signum}")
+        self.logger.info("Received Shutdown Signal %s", signum)
         self.global_shutdown_requested = True
+        self.mqtt_event_loop.stop()
 
     def __persistent_backup_thread(self):
         last_backup_time = time.time()
@@ -71,171 +228,320 @@ class SmartHub:
         parsed_message = cayenne_message_parser.cayenne_message_to_object(message)
         if parsed_message:
             cayenne_message_parser.print_message(parsed_message)
-            self.cloud_job_queue.put(parsed_message)
+            if "asyncio" == config.HUB_RUNTIME:
+                # Already on the event loop, and request() never blocks.
+                self.__handle_cloud_command(parsed_message)
+            else:
+                self.cloud_job_queue.put(parsed_message)
         else:
-            self.logger.warn(f"Unable to Parse Cayenne Message: {str(message)}")
+            self.logger.warn("Unable to Parse Cayenne Message: %s", message)
 
     def __mqtt_loop_thread(self):
-        while not self.global_shutdown_requested:
-            if self.active_switch_list.ready:
-                self.active_switch_list.loop()
-            time.sleep(config.MQTT_LOOP_TIME_SECONDS)
+        self.mqtt_event_loop.run(lambda: self.global_shutdown_requested)
 
-    def __zigbee_receiver_thread(self):
+    def __zigbee_receiver_thread(self, coordinator: Coordinator):
         while not self.global_shutdown_requested:
+            if coordinator.serial_port is None:
+                # Not opened at start-up, or closed after an error; the
+                # other coordinators carry on meanwhile.
+                time.sleep(config.SERIAL_TIMEOUT_SECONDS)
+                self.__reopen_coordinator(coordinator)
+                continue
             try:
-                serial_message = self.serial_port.readline().strip()
-                decoded_serial_message = serial_message.decode()
-                if 0 == len(decoded_serial_message):
-                    print("Got nothing")
+                # Block for the first byte, then take everything already
+                # buffered by the driver in one read.
+                in_waiting = coordinator.serial_port.in_waiting
+                read_start_time = time.perf_counter()
+                serial_data = coordinator.serial_port.read(
+                    min(max(1, in_waiting), config.SERIAL_READ_CHUNK_BYTES)
+                )
+                if 0 == len(serial_data):
                     continue
-                self.logger.debug(f"Serial Message Received: {decoded_serial_message}")
-                parsed_message = xbee_message_to_object(str(decoded_serial_message))
-                if parsed_message is not None:
-                    self.zigbee_job_queue.put(parsed_message)
-                else:
-                    self.logger.error(
-                        f"Failed to Parse Coordinator Message: '{str(decoded_serial_message)}'"
-                    )
+                if in_waiting:
+                    # Only reads of already-buffered data; otherwise this
+                    # would measure how long the radio was quiet.
+                    metrics.SERIAL_READ_SECONDS.observe(time.perf_counter() - read_start_time)
+                batch = self.__parse_coordinator_data(coordinator.framer, serial_data)
+                if batch:
+                    self.coordinator_router.heard(coordinator, batch)
+                    self.zigbee_job_queue.put(batch)
 
             except Exception as e:
-                self.logger.error(f"Exception while Parsing Coordinator Message: {e}")
+                self.logger.error(
+                    "Exception while Parsing Message from %s: %s", coordinator, e
+                )
+                coordinator.close()
+
+    def __parse_coordinator_data(
+        self, framer: Serial_line_framer, serial_data: bytes
+    ) -> List[Xbee_coordinator_message]:
+        parse_start_time = time.perf_counter()
+        batch: List[Xbee_coordinator_message] = []
+        for line in framer.feed(serial_data):
+            payload = unframe_coordinator_line(line)
+            if payload is None:
+                metrics.CHECKSUM_FAILURES.inc()
+                self.logger.error("Coordinator Message Failed its Checksum: '%s'", line)
+                continue
+            parsed_message = xbee_message_to_object(payload)
+            if parsed_message is not None:
+                if self.reading_sequences.accept(parsed_message):
+                    batch.append(parsed_message)
+            else:
+                metrics.PARSE_FAILURES.inc()
+                self.logger.error("Failed to Parse Coordinator Message: '%s'", line)
+        metrics.SERIAL_PARSE_SECONDS.observe(time.perf_counter() - parse_start_time)
+        return batch
 
     def __zigbee_job_processor_thread(self):
+        last_stats_time = time.time()
         while not self.global_shutdown_requested:
             try:
-                item: Xbee_coordinator_message = self.zigbee_job_queue.get(timeout=1)
-                self.logger.debug(f"Popped: {item}")
-                switch: SmartSwitch = self.active_switch_list.get_switch_from_MAC(
-                    item.MAC
+                batch: List[Xbee_coordinator_message] = self.zigbee_job_queue.get(
+                    timeout=1
                 )
-                if switch is not None:
-                    switch.handle_serial_message(item)
-                else:
-                    self.logger.error(f"Could not Find Switch with MAC: {item.MAC}")
-
+                # Readings are stamped when parsed, just before the put.
+                metrics.ZIGBEE_QUEUE_WAIT_SECONDS.observe(
+                    time.time() - batch[-1].timestamp
+                )
+                self.zigbee_worker_pool.submit(batch)
             except queue.Empty:
                 pass
+            current_time = time.time()
+            if current_time > (last_stats_time + config.ZIGBEE_STATS_INTERVAL_SECONDS):
+                self.__log_stats()
+                last_stats_time = current_time
+
+    def __log_stats(self):
+        self.zigbee_worker_pool.log_stats()
+        self.command_scheduler.log_stats()
+        self.coordinator_router.log_stats()
+        self.reading_sequences.log_stats()
+        self.readings_archive.log_stats()
+        if len(self.unknown_MACs):
+            self.logger.info(
+                "Unknown MACs: %d cached, %d evicted, busiest %s",
+                len(self.unknown_MACs),
+                self.unknown_MACs.evicted,
+                self.unknown_MACs.busiest(5),
+            )
+
+    def __handle_zigbee_message(self, item: Xbee_coordinator_message):
+        switch: SmartSwitch = self.active_switch_list.get_switch_from_MAC(item.MAC)
+        if switch is not None:
+            telemetry = switch.handle_serial_message(item)
+            self.command_scheduler.confirm(item.MAC, item.power_state, item.timestamp)
+            if telemetry is not None:
+                self.__handle_telemetry(telemetry)
+        else:
+            self.__handle_unknown_MAC(item)
+
+    def __handle_processed_reading(self, switch: SmartSwitch, telemetry: Switch_telemetry):
+        # Called by the Zigbee_process_pool result thread, in reading order.
+        self.command_scheduler.confirm(switch.MAC, telemetry.power_state, telemetry.timestamp)
+        self.__handle_telemetry(telemetry)
+
+    def __handle_telemetry(self, telemetry: Switch_telemetry):
+        self.telemetry_publisher.publish(telemetry)
+        self.readings_archive.archive(telemetry)
+        if self.first_reading_seconds is None:
+            self.__report_first_reading()
+
+    def __handle_unknown_MAC(self, item: Xbee_coordinator_message):
+        metrics.UNKNOWN_MACS.inc()
+        previous_readings = self.unknown_MACs.record(item.MAC)
+        if previous_readings is not None:
+            self.logger.error(
+                "Could not Find Switch with MAC: %s (%d Readings since Last Reported)",
+                item.MAC,
+                previous_readings,
+            )
+            if config.AUTO_PROVISION_SWITCHES:
+                self.switch_provisioner.provision(item.MAC)
+
+    def __report_first_reading(self):
+        with self.first_reading_lock:
+            if self.first_reading_seconds is not None:
+                return
+            self.first_reading_seconds = time.monotonic() - self.start_time
+        self.logger.info(
+            "Processed First Reading %.3f s after Start-up", self.first_reading_seconds
+        )
 
     def __cloud_job_processor_thread(self):
         while not self.global_shutdown_requested:
             item: cayenne_message_parser.Cayenne_switch_message = None
             try:
                 item = self.cloud_job_queue.get(timeout=1)
-                self.logger.debug(f"Popped: {item}")
+                self.logger.debug("Popped: %s", item)
             except queue.Empty:
                 continue
             if item is not None:
-                self.logger.debug(f"Getting Switch from {item.GUID}")
-                switch: SmartSwitch = self.active_switch_list.get_switch_from_GUID(
-                    GUID=item.GUID
-                )
-                if switch is not None:
-                    with switch.acquire_lock():
-                        self.logger.debug("Got Switch: ")
-                        self.logger.debug(f"MAC: {switch.MAC}")
-                        self.logger.debug(f"GUID: {switch.GUID}")
-                        serial_message: str = (
-                            switch.MAC + "," + ("on" if (item.power_state) else "off")
-                        )
-                        self.logger.info(
-                            "Sending Message to Coordinator: " + serial_message
-                        )
-                        try:
-                            self.serial_port.write(bytes(serial_message, "utf-8"))
-                        except Exception as e:
-                            self.logger.critical(
-                                f"Failed to Write to Serial Device: '{e}'"
-                            )
-                else:
-                    self.logger.error(f"Unable to Find Switch with GUID: '{item.GUID}'")
-
-    def __tester_thread(self):
-        count = 0
-        sample_messages = [
-            "1234,1,15.169,122.5637",
-            "1234,1,15.169,122.5637",
-            "1234,1,13.002,122.2096",
-            "1234,1,13.2187,122.1879",
-            "1234,1,13.2187,122.1807",
-            "1234,1,13.2187,122.2241",
-            "1234,1,13.2187,122.2385",
-            "1234,1,13.4354,122.2313",
-            "1234,1,13.4354,122.2313",
-            "1234,1,13.6521,122.0939",
-            "1234,1,13.6521,122.0145",
-            "1234,1,13.6521,122.1084",
-            "1234,1,13.6521,122.2385",
-            "1234,1,13.8688,122.2457",
-            "1234,1,2.6004,122.3614",
-            "1234,1,0.0,122.4264",
-            "1234,1,0.0,122.4192",
-            "1234,1,0.0,122.4481",
-            "1234,1,0.0,122.4336",
-            "1234,1,0.0,122.477",
-            "1234,1,0.0,122.5132",
-            "1234,1,0.0,122.5132",
-            "1234,1,0.0,122.5348",
-            "1234,1,0.0,122.5132",
-            "1234,1,4.334,122.4553",
-            "1234,1,7.5845,122.4264",
-            "1234,0,7.3678,122.4336",
-            "1234,0,7.5845,122.3975",
-            "1234,0,7.5845,121.8771",
-            "1234,0,7.5845,121.8771",
-            "1234,0,7.5845,122.4481",
-            "1234,0,7.5845,122.4336",
-            "1234,0,7.5845,122.4336",
-            "1234,0,7.5845,122.3975",
-            "1234,0,7.5845,122.4192",
-            "1234,0,7.5845,122.4409",
-            "1234,0,7.5845,122.4481",
-            "1234,0,7.5845,122.4192",
-            "1234,0,7.5845,122.4192",
-            "1234,0,7.5845,122.3975",
-            "1234,0,7.5845,122.3831",
-            "1234,0,7.5845,122.3975",
-            "1234,0,7.5845,122.3686",
-            "1234,0,7.5845,122.3686",
-            "1234,0,7.5845,122.3397",
-            "1234,0,7.5845,122.3035",
-            "1234,0,7.5845,122.2891",
-            "1234,0,7.5845,122.318",
-            "1234,0,7.5845,122.2891",
-            "1234,0,7.8012,122.2891",
-            "1234,0,7.8012,122.253",
-            "1234,0,7.5845,122.3686",
-            "1234,0,7.8012,122.4047",
-            "1234,0,7.5845,122.3831",
-        ]
-        index = 0
-        while not self.global_shutdown_requested:
-            self.logger.debug("Pushing to zigbee message queue")
-            self.zigbee_message_queue.put(sample_messages[index])
-            count += 1
-            index = (index + 1) % len(sample_messages)
-            time.sleep(10)
+                self.__handle_cloud_command(item)
 
-    def run(self):
-        self.__run_initialization()
+    def __handle_cloud_command(self, item: cayenne_message_parser.Cayenne_switch_message):
+        self.logger.debug("Getting Switch from %s", item.GUID)
+        switch: SmartSwitch = self.active_switch_list.get_switch_from_GUID(GUID=item.GUID)
+        if switch is not None:
+            self.logger.debug("Got Switch: MAC %s, GUID %s", switch.MAC, switch.GUID)
+            self.command_scheduler.request(switch.MAC, item.power_state)
+        else:
+            self.logger.error("Unable to Find Switch with GUID: '%s'", item.GUID)
+
+    def __run_threads(self):
+        self.mqtt_event_loop = Mqtt_event_loop(
+            self.__get_mqtt_clients, self.__reconnect_mqtt_client
+        )
+        self.__attach_signal_handlers()
+        self.__start_mqtt_connector(self.mqtt_event_loop.opened)
         thread_functions = [
-            self.__zigbee_receiver_thread,
             self.__cloud_job_processor_thread,
             self.__zigbee_job_processor_thread,
             self.__persistent_backup_thread,
             self.__mqtt_loop_thread,
-            # self.__tester_thread,
         ]
-        threads: List[threading.Thread] = []
-        for thread_function in thread_functions:
-            thread = threading.Thread(target=thread_function)
-            threads.append(thread)
+        threads: List[threading.Thread] = [
+            threading.Thread(target=thread_function) for thread_function in thread_functions
+        ]
+        # One receiver per coordinator, so a slow or failed port never holds
+        # up readings from the others.
+        for coordinator in self.coordinator_router.coordinators:
+            threads.append(
+                threading.Thread(
+                    target=self.__zigbee_receiver_thread,
+                    args=(coordinator,),
+                    name=f"coordinator-{coordinator.index}",
+                )
+            )
+        for thread in threads:
             thread.start()
 
         for thread in threads:
             thread.join()
+
+    async def __serve(self):
+        # Readings go straight from the serial callback to the worker pool
+        # and cloud commands straight from the MQTT callback to the command
+        # scheduler, so there are no job queues or processor threads to poll.
+        loop = asyncio.get_running_loop()
+        shutdown_requested = asyncio.Event()
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            loop.add_signal_handler(
+                signum, self.__async_shutdown_handler, signum, shutdown_requested
+            )
+        mqtt_driver = Mqtt_asyncio_driver(
+            loop, self.__get_mqtt_clients, self.__reconnect_mqtt_client
+        )
+        mqtt_driver.start()
+        self.__start_mqtt_connector(mqtt_driver.opened)
+        for coordinator in self.coordinator_router.coordinators:
+            self.__watch_coordinator(loop, coordinator)
+        # One worker, so the final save after shutdown can wait for a backup
+        # already in progress.
+        persistence_executor = ThreadPoolExecutor(1, thread_name_prefix="persistence")
+        tasks = [
+            asyncio.create_task(self.__persistent_backup_task(persistence_executor)),
+            asyncio.create_task(self.__stats_task()),
+        ]
+        await shutdown_requested.wait()
+        for coordinator in self.coordinator_router.coordinators:
+            if coordinator.serial_port is not None:
+                loop.remove_reader(coordinator.serial_port.fileno())
+        mqtt_driver.stop()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        persistence_executor.shutdown(wait=True)
+
+    def __async_shutdown_handler(self, signum, shutdown_requested: asyncio.Event):
+        self.logger.info("Received Shutdown Signal %s", signum)
+        self.global_shutdown_requested = True
+        shutdown_requested.set()
+
+    def __watch_coordinator(self, loop: asyncio.AbstractEventLoop, coordinator: Coordinator):
+        if self.global_shutdown_requested:
+            return
+        if coordinator.serial_port is None and not self.__reopen_coordinator(coordinator):
+            loop.call_later(
+                config.SERIAL_TIMEOUT_SECONDS, self.__watch_coordinator, loop, coordinator
+            )
+            return
+        # Only read once the loop reports the port readable, so never block.
+        coordinator.serial_port.timeout = 0
+        fileno = coordinator.serial_port.fileno()
+        loop.add_reader(fileno, self.__on_serial_readable, loop, coordinator, fileno)
+
+    def __on_serial_readable(
+        self, loop: asyncio.AbstractEventLoop, coordinator: Coordinator, fileno: int
+    ):
+        try:
+            read_start_time = time.perf_counter()
+            serial_data = coordinator.serial_port.read(config.SERIAL_READ_CHUNK_BYTES)
+            metrics.SERIAL_READ_SECONDS.observe(time.perf_counter() - read_start_time)
+            batch = self.__parse_coordinator_data(coordinator.framer, serial_data)
+            if batch:
+                self.coordinator_router.heard(coordinator, batch)
+                self.zigbee_worker_pool.submit(batch)
+        except Exception as e:
+            self.logger.error("Exception while Parsing Message from %s: %s", coordinator, e)
+            # A port that keeps failing would otherwise spin the loop; reopen
+            # it after the threaded reader's read timeout.
+            loop.remove_reader(fileno)
+            coordinator.close()
+            loop.call_later(
+                config.SERIAL_TIMEOUT_SECONDS,
+                self.__watch_coordinator,
+                loop,
+                coordinator,
+            )
+
+    async def __persistent_backup_task(self, executor: ThreadPoolExecutor):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(config.BACKUP_INTERVAL_SECONDS)
+            await loop.run_in_executor(executor, self.active_switch_list.save_persistent_data)
+
+    async def __stats_task(self):
+        while True:
+            await asyncio.sleep(config.ZIGBEE_STATS_INTERVAL_SECONDS)
+            self.__log_stats()
+
+    def run(self):
+        self.start_time = time.monotonic()
+        self.__run_initialization()
+        metrics_server = None
+        if config.METRICS_ENABLED:
+            metrics_server = metrics.Metrics_server()
+            try:
+                metrics_server.start()
+            except OSError as e:
+                self.logger.error("Unable to Serve Metrics: %s", e)
+                metrics_server = None
+        self.telemetry_publisher.start()
+        if config.ARCHIVE_ENABLED:
+            self.readings_archive.start()
+        self.zigbee_worker_pool.start()
+        self.command_scheduler.start()
+        if config.AUTO_PROVISION_SWITCHES:
+            self.switch_provisioner.start()
+        if "asyncio" == config.HUB_RUNTIME:
+            asyncio.run(self.__serve())
+        else:
+            self.__run_threads()
+        self.switch_provisioner.stop()
+        if self.mqtt_connector is not None:
+            self.mqtt_connector.stop()
+        self.command_scheduler.stop()
+        self.zigbee_worker_pool.stop()
+        self.telemetry_publisher.stop()
+        self.readings_archive.stop()
+        self.coordinator_router.close()
         self.active_switch_list.save_persistent_data()
+        self.active_switch_list.close_persistent_data()
+        if metrics_server is not None:
+            metrics_server.stop()
         self.logger.info("Bye :)")
+        homegrid_logger.Logger.shutdown()
 
 
 def main():
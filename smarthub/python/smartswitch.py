@@ -8,128 +8,215 @@ __version__ = "1.0.0"
 
 
 from typing_extensions import final
-import cayenne.client
-import config
 from contextlib import contextmanager
+import energy_accounting
+import homegrid_logger
+import metrics
+from switch_history import Switch_history
+from telemetry_publisher import Switch_telemetry
 import threading
 import time
+from typing import Optional
 from xbee_message_parser import Xbee_coordinator_message
 
+logger = homegrid_logger.Logger(__name__)
+
 
 class SmartSwitch:
+    __slots__ = (
+        "MAC",
+        "GUID",
+        "client",
+        "last_time_seen",
+        "lock",
+        "current_power_state",
+        "cumulative_power_consumption_kwh",
+        "cumulative_power_cost_dollars",
+        "version",
+        "snapshot",
+        "history",
+        "state_record",
+    )
+
     def __init__(
         self,
         MAC: str,
         GUID: str,
-        last_time_seen: float = time.time(),
+        last_time_seen: Optional[float] = None,
         current_power_state: bool = False,
         cumulative_power_consumption_kwh: float = 0.0,
         cumulative_power_cost_dollars: float = 0.0,
     ):
         self.MAC = MAC
         self.GUID = GUID
-        self.client = cayenne.client.CayenneMQTTClient()
-        self.last_time_seen = last_time_seen
+        # Set by the Mqtt_connector once the connection is open; a switch that
+        # is only loaded or persisted never carries an MQTT client.
+        self.client = None
+        self.last_time_seen = time.time() if last_time_seen is None else last_time_seen
         self.lock = threading.Lock()
         self.current_power_state = current_power_state
         self.cumulative_power_consumption_kwh = cumulative_power_consumption_kwh
         self.cumulative_power_cost_dollars = cumulative_power_cost_dollars
+        self.version = 0
+        self.snapshot = smart_switch_to_serializable(self)
+        # Allocated on the first reading so switches that never report cost
+        # no history memory.
+        self.history: Optional[Switch_history] = None
+        # persistent_data_utils.Mapped_state_record with the "mmap" backend.
+        self.state_record = None
+
+    def update_snapshot(self):
+        # Must be called with the lock held. The snapshot is immutable and is
+        # swapped in with a single reference assignment, so the backup thread
+        # can read it without taking the lock.
+        self.version += 1
+        if self.state_record is not None:
+            # The mapped record is what gets saved; update it in place.
+            self.state_record.write(self)
+        else:
+            self.snapshot = smart_switch_to_serializable(self)
 
     @contextmanager
     def acquire_lock(self):
-        ret = self.lock.acquire(blocking=True, timeout=threading.TIMEOUT_MAX)
-        print(f"ACQUIRED LOCK: {ret} {self}")
-        yield
-        print(f"RELEASING LOCK: {self}")
-        self.lock.release()
-        print(f"RELEASED LOCK: {self}")
-
-    def handle_serial_message(self, message: Xbee_coordinator_message):
+        start_time = time.perf_counter()
+        self.lock.acquire(blocking=True, timeout=threading.TIMEOUT_MAX)
+        metrics.SWITCH_LOCK_WAIT_SECONDS.observe(time.perf_counter() - start_time)
+        try:
+            yield
+        finally:
+            self.lock.release()
+
+    def handle_serial_message(
+        self, message: Xbee_coordinator_message
+    ) -> Optional[Switch_telemetry]:
+        # Only counters are updated under the lock; the returned record is
+        # handed to the Telemetry_publisher so network I/O never blocks the
+        # cloud command path for this switch.
         with self.acquire_lock():
             try:
                 self.current_power_state = message.power_state
-                self.last_time_seen = time.time()
-                kilowatt_hours_gained = self.___calculate_watts_to_kwh(message.power_draw)
+                # The node averages power since its previous report, so credit
+                # the real time since this switch was last seen.
+                interval_seconds = energy_accounting.reading_interval_seconds(
+                    self.last_time_seen, message.timestamp
+                )
+                self.last_time_seen = max(self.last_time_seen, message.timestamp)
+                kilowatt_hours_gained = energy_accounting.watts_to_kwh(
+                    message.power_draw, interval_seconds
+                )
                 self.cumulative_power_consumption_kwh += kilowatt_hours_gained
-                self.cumulative_power_cost_dollars += self.___calculate_kwh_to_dollars(
+                self.cumulative_power_cost_dollars += energy_accounting.kwh_to_dollars(
                     kilowatt_hours_gained
                 )
-
-                self.client.virtualWrite(
-                    config.VIRTUAL_CHANNEL.POWER_DRAW.value,
+                self.update_snapshot()
+                if self.history is None:
+                    self.history = Switch_history()
+                self.history.add(
+                    message.timestamp,
+                    message.power_state,
                     message.power_draw,
-                    dataType="pow",
-                    dataUnit="w",
-                )
-
-                self.client.virtualWrite(
-                    config.VIRTUAL_CHANNEL.POWER_TOGGLE.value,
-                    1 if (message.power_state) else 0,
-                    dataType="digital_sensor",
-                    dataUnit="d",
-                )
-
-                self.client.virtualWrite(
-                    config.VIRTUAL_CHANNEL.POWER_INDICATOR.value,
-                    1 if (message.power_state) else 0,
-                    dataType="digital_sensor",
-                    dataUnit="d",
-                )
-
-                self.client.virtualWrite(
-                    config.VIRTUAL_CHANNEL.VOLTAGE.value,
                     message.voltage,
-                    dataType="voltage",
-                    dataUnit="v",
                 )
-
-                self.client.virtualWrite(
-                    config.VIRTUAL_CHANNEL.POWER_STATE.value,
-                    1.0 if (message.power_state) else 0.0,
-                    dataType="analog_sensor",
-                    dataUnit="null",
-                )
-
-                self.client.virtualWrite(
-                    config.VIRTUAL_CHANNEL.CUMULATIVE_POWER_CONSUMPTION_KWH.value,
+                return Switch_telemetry(
+                    self.client,
+                    self.GUID,
+                    message.power_state,
+                    message.power_draw,
+                    message.voltage,
                     self.cumulative_power_consumption_kwh,
-                    dataType="energy",
-                    dataUnit="kwh",
-                )
-
-                self.client.virtualWrite(
-                    config.VIRTUAL_CHANNEL.CUMULATIVE_POWER_COST_DOLLARS.value,
                     self.cumulative_power_cost_dollars,
-                    dataType="analog_sensor",
-                    dataUnit="null",
+                    message.timestamp,
                 )
             except Exception as e:
-                print(f"exception: {e}")
-
-    @staticmethod
-    def ___calculate_watts_to_kwh(watts: float) -> float:
-        # E(kWh) = P(W) × t(hr) / 1000
-        return float(
-            float(watts)
-            * float(1.0 / 60.0)
-            * float(config.NODE_POWER_AVERAGING_INTERVAL_SECONDS)
-            / float(1000.0)
-        )
+                logger.error("Exception while Handling %s: %s", self.MAC, e)
+                return None
 
-    @staticmethod
-    def ___calculate_kwh_to_dollars(kwh: float) -> float:
-        # $ = E(kWh) * kilowatt cost
-        return kwh * float(config.KILOWATT_COST_DOLLARS)
+    def apply_processed_reading(
+        self,
+        power_state: bool,
+        last_time_seen: float,
+        cumulative_power_consumption_kwh: float,
+        cumulative_power_cost_dollars: float,
+    ):
+        """
+        Takes the state a Zigbee worker process computed for this switch from
+        a reading, so it is saved like any other.
+        """
+        with self.acquire_lock():
+            self.current_power_state = power_state
+            self.last_time_seen = last_time_seen
+            self.cumulative_power_consumption_kwh = cumulative_power_consumption_kwh
+            self.cumulative_power_cost_dollars = cumulative_power_cost_dollars
+            self.update_snapshot()
 
 
 class SmartSwitchSerializable:
-    def __init__(self, switch: SmartSwitch):
-        self.MAC = switch.MAC
-        self.GUID = switch.GUID
-        self.last_time_seen = switch.last_time_seen
-        self.current_power_state = switch.current_power_state
-        self.cumulative_power_consumption_kwh = switch.cumulative_power_consumption_kwh
-        self.cumulative_power_cost_dollars = switch.cumulative_power_cost_dollars
+    __slots__ = (
+        "MAC",
+        "GUID",
+        "last_time_seen",
+        "current_power_state",
+        "cumulative_power_consumption_kwh",
+        "cumulative_power_cost_dollars",
+        "version",
+    )
+
+    def __init__(
+        self,
+        MAC: str,
+        GUID: str,
+        last_time_seen: float,
+        current_power_state: bool,
+        cumulative_power_consumption_kwh: float,
+        cumulative_power_cost_dollars: float,
+        version: int = 0,
+    ):
+        self.MAC = MAC
+        self.GUID = GUID
+        self.last_time_seen = last_time_seen
+        self.current_power_state = current_power_state
+        self.cumulative_power_consumption_kwh = cumulative_power_consumption_kwh
+        self.cumulative_power_cost_dollars = cumulative_power_cost_dollars
+        self.version = version
+
+    def __getstate__(self):
+        return (
+            self.MAC,
+            self.GUID,
+            self.last_time_seen,
+            self.current_power_state,
+            self.cumulative_power_consumption_kwh,
+            self.cumulative_power_cost_dollars,
+            self.version,
+        )
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            self.__init__(*state)
+            return
+        # Pickles written before __slots__ carry the instance __dict__, and
+        # the oldest ones have no version.
+        self.__init__(
+            state["MAC"],
+            state["GUID"],
+            state["last_time_seen"],
+            state["current_power_state"],
+            state["cumulative_power_consumption_kwh"],
+            state["cumulative_power_cost_dollars"],
+            state.get("version", 0),
+        )
+
+
+def smart_switch_to_serializable(switch: SmartSwitch) -> SmartSwitchSerializable:
+    return SmartSwitchSerializable(
+        switch.MAC,
+        switch.GUID,
+        switch.last_time_seen,
+        switch.current_power_state,
+        switch.cumulative_power_consumption_kwh,
+        switch.cumulative_power_cost_dollars,
+        switch.version,
+    )
 
 
 def smart_switch_serializable_to_switch(switch: SmartSwitchSerializable) -> SmartSwitch:
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Switch History Module
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import array
+import config
+import energy_accounting
+import numpy as np
+from typing import Dict, Optional
+
+
+class Rollup_ring:
+    """
+    Fixed-size min/max/mean rollups of power and voltage at one resolution.
+
+    Slots are direct-mapped by bucket number, counted from the first bucket
+    the ring saw ((bucket - origin) % capacity), so a reading updates its
+    bucket in O(1) even when it arrives late, and a bucket older than
+    capacity * resolution_seconds is overwritten.
+
+    Storage is array.array, which is several times cheaper than NumPy for
+    the per-reading scalar updates; queries read it through zero-copy NumPy
+    views. The columns start empty and double as buckets are used, up to
+    capacity, so a ring costs 40 bytes per bucket it has covered: a day's
+    ring holds one bucket after a day rather than a year's worth.
+    """
+
+    def __init__(self, resolution_seconds: int, capacity: int):
+        self.resolution_seconds = resolution_seconds
+        self.capacity = capacity
+        self.newest_bucket = -1
+        # Set by the first reading; older buckets are not kept.
+        self.origin = -1
+        self.allocated = 0
+        self.bucket = array.array("q")
+        self.count = array.array("i")
+        self.power_sum = array.array("d")
+        self.power_min = array.array("f")
+        self.power_max = array.array("f")
+        self.voltage_sum = array.array("d")
+        self.voltage_min = array.array("f")
+        self.voltage_max = array.array("f")
+
+    def __grow(self, slots: int):
+        size = min(self.capacity, max(slots, 2 * self.allocated))
+        extra = size - self.allocated
+        # Concatenation allocates exactly size; extending in place would
+        # over-allocate.
+        self.bucket = self.bucket + array.array("q", [-1]) * extra
+        self.count = self.count + array.array("i", [0]) * extra
+        self.power_sum = self.power_sum + array.array("d", [0.0]) * extra
+        self.power_min = self.power_min + array.array("f", [0.0]) * extra
+        self.power_max = self.power_max + array.array("f", [0.0]) * extra
+        self.voltage_sum = self.voltage_sum + array.array("d", [0.0]) * extra
+        self.voltage_min = self.voltage_min + array.array("f", [0.0]) * extra
+        self.voltage_max = self.voltage_max + array.array("f", [0.0]) * extra
+        self.allocated = size
+
+    def add(self, timestamp: float, power_draw: float, voltage: float):
+        bucket = int(timestamp // self.resolution_seconds)
+        if self.origin < 0:
+            self.origin = bucket
+        elif bucket < self.origin:
+            return
+        slot = (bucket - self.origin) % self.capacity
+        if slot >= self.allocated:
+            self.__grow(slot + 1)
+        if self.bucket[slot] != bucket:
+            if self.bucket[slot] > bucket:
+                # Older than anything the ring still holds.
+                return
+            self.bucket[slot] = bucket
+            if bucket > self.newest_bucket:
+                self.newest_bucket = bucket
+            self.count[slot] = 1
+            self.power_sum[slot] = self.power_min[slot] = self.power_max[slot] = power_draw
+            self.voltage_sum[slot] = voltage
+            self.voltage_min[slot] = self.voltage_max[slot] = voltage
+            return
+        self.count[slot] += 1
+        self.power_sum[slot] += power_draw
+        self.voltage_sum[slot] += voltage
+        if power_draw < self.power_min[slot]:
+            self.power_min[slot] = power_draw
+        if power_draw > self.power_max[slot]:
+            self.power_max[slot] = power_draw
+        if voltage < self.voltage_min[slot]:
+            self.voltage_min[slot] = voltage
+        if voltage > self.voltage_max[slot]:
+            self.voltage_max[slot] = voltage
+
+    def query(self, start_time: float, end_time: float) -> Dict[str, np.ndarray]:
+        first = int(start_time // self.resolution_seconds)
+        last = min(int(end_time // self.resolution_seconds), self.newest_bucket)
+        first = max(first, last - self.capacity + 1, self.origin)
+        buckets = np.arange(first, last + 1, dtype=np.int64)
+        slots = (buckets - self.origin) % self.capacity
+        allocated = slots < self.allocated
+        buckets = buckets[allocated]
+        slots = slots[allocated]
+        present = np.frombuffer(self.bucket, dtype=np.int64)[slots] == buckets
+        slots = slots[present]
+        count = np.frombuffer(self.count, dtype=np.int32)[slots]
+        return {
+            "start_time": (buckets[present] * self.resolution_seconds).astype(np.float64),
+            "count": count,
+            "power_min": np.frombuffer(self.power_min, dtype=np.float32)[slots],
+            "power_max": np.frombuffer(self.power_max, dtype=np.float32)[slots],
+            "power_mean": np.frombuffer(self.power_sum, dtype=np.float64)[slots] / count,
+            "voltage_min": np.frombuffer(self.voltage_min, dtype=np.float32)[slots],
+            "voltage_max": np.frombuffer(self.voltage_max, dtype=np.float32)[slots],
+            "voltage_mean": np.frombuffer(self.voltage_sum, dtype=np.float64)[slots]
+            / count,
+        }
+
+
+class Switch_history:
+    """
+    Recent raw readings of one switch plus 1-minute, 1-hour and 1-day rollups.
+
+    The raw ring is preallocated, 17 bytes per reading; the rollup rings
+    grow as they cover buckets, so memory per switch is bounded however long
+    the hub runs but a switch only pays for the rollups it has filled; see
+    HISTORY_RAW_CAPACITY and HISTORY_ROLLUPS. Not thread-safe; SmartSwitch
+    guards it with its lock.
+    """
+
+    def __init__(self):
+        capacity = config.HISTORY_RAW_CAPACITY
+        self.raw_capacity = capacity
+        self.raw_head = 0
+        self.raw_count = 0
+        self.raw_timestamp = array.array("d", [0.0]) * capacity
+        self.raw_power_draw = array.array("f", [0.0]) * capacity
+        self.raw_voltage = array.array("f", [0.0]) * capacity
+        self.raw_power_state = array.array("b", [0]) * capacity
+        self.rollups: Dict[int, Rollup_ring] = {
+            resolution_seconds: Rollup_ring(resolution_seconds, rollup_capacity)
+            for resolution_seconds, rollup_capacity in config.HISTORY_ROLLUPS.items()
+        }
+
+    def add(self, timestamp: float, power_state: bool, power_draw: float, voltage: float):
+        head = self.raw_head
+        self.raw_timestamp[head] = timestamp
+        self.raw_power_draw[head] = power_draw
+        self.raw_voltage[head] = voltage
+        self.raw_power_state[head] = 1 if (power_state) else 0
+        self.raw_head = (head + 1) % self.raw_capacity
+        if self.raw_count < self.raw_capacity:
+            self.raw_count += 1
+        for rollup in self.rollups.values():
+            rollup.add(timestamp, power_draw, voltage)
+
+    def query(
+        self,
+        start_time: float,
+        end_time: float,
+        resolution_seconds: Optional[int] = None,
+    ) -> Dict[str, np.ndarray]:
+        """
+        Returns readings with start_time <= time <= end_time, oldest first.
+
+        With no resolution the raw readings still held in the ring buffer are
+        returned; otherwise resolution_seconds must be one of HISTORY_ROLLUPS.
+        """
+        if resolution_seconds is not None:
+            if resolution_seconds not in self.rollups:
+                raise ValueError(f"No Rollup at {resolution_seconds} s")
+            return self.rollups[resolution_seconds].query(start_time, end_time)
+
+        # Oldest entry first: the ring is [head, capacity) then [0, head).
+        order = np.roll(np.arange(self.raw_capacity), -self.raw_head)
+        order = order[self.raw_capacity - self.raw_count :]
+        raw_timestamp = np.frombuffer(self.raw_timestamp, dtype=np.float64)
+        timestamp = raw_timestamp[order]
+        selected = order[(timestamp >= start_time) & (timestamp <= end_time)]
+        return {
+            "timestamp": raw_timestamp[selected],
+            "power_state": np.frombuffer(self.raw_power_state, dtype=np.int8)[
+                selected
+            ].astype(np.bool_),
+            "power_draw": np.frombuffer(self.raw_power_draw, dtype=np.float32)[selected],
+            "voltage": np.frombuffer(self.raw_voltage, dtype=np.float32)[selected],
+        }
+
+    def energy_kwh(self, start_time: float, end_time: float) -> float:
+        """Re-integrates the raw readings between start_time and end_time."""
+        readings = self.query(start_time, end_time)
+        return energy_accounting.integrate_readings(
+            readings["timestamp"], readings["power_draw"]
+        )
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Telemetry Publisher Module
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import config
+import json
+import homegrid_logger
+import metrics
+import queue
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+
+class Switch_telemetry(NamedTuple):
+    client: Any
+    GUID: str
+    power_state: bool
+    power_draw: float
+    voltage: float
+    cumulative_power_consumption_kwh: float
+    cumulative_power_cost_dollars: float
+    timestamp: float
+    # The JSON data payload, when a Zigbee worker process prepared it.
+    payload: Optional[bytes] = None
+
+
+def telemetry_to_channels(telemetry: Switch_telemetry) -> List[Dict[str, Any]]:
+    power_bit = 1 if (telemetry.power_state) else 0
+    return [
+        {
+            "channel": config.VIRTUAL_CHANNEL.POWER_DRAW.value,
+            "value": telemetry.power_draw,
+            "type": "pow",
+            "unit": "w",
+        },
+        {
+            "channel": config.VIRTUAL_CHANNEL.POWER_TOGGLE.value,
+            "value": power_bit,
+            "type": "digital_sensor",
+            "unit": "d",
+        },
+        {
+            "channel": config.VIRTUAL_CHANNEL.POWER_INDICATOR.value,
+            "value": power_bit,
+            "type": "digital_sensor",
+            "unit": "d",
+        },
+        {
+            "channel": config.VIRTUAL_CHANNEL.VOLTAGE.value,
+            "value": telemetry.voltage,
+            "type": "voltage",
+            "unit": "v",
+        },
+        {
+            "channel": config.VIRTUAL_CHANNEL.POWER_STATE.value,
+            "value": float(power_bit),
+            "type": "analog_sensor",
+            "unit": "null",
+        },
+        {
+            "channel": config.VIRTUAL_CHANNEL.CUMULATIVE_POWER_CONSUMPTION_KWH.value,
+            "value": telemetry.cumulative_power_consumption_kwh,
+            "type": "energy",
+            "unit": "kwh",
+        },
+        {
+            "channel": config.VIRTUAL_CHANNEL.CUMULATIVE_POWER_COST_DOLLARS.value,
+            "value": telemetry.cumulative_power_cost_dollars,
+            "type": "analog_sensor",
+            "unit": "null",
+        },
+    ]
+
+
+class Client_connected(NamedTuple):
+    GUID: str
+    client: Any
+
+
+class Telemetry_publisher:
+    """
+    Publishes switch telemetry to Cayenne from a background thread.
+
+    SmartSwitch.handle_serial_message only updates counters under the switch
+    lock and returns an immutable Switch_telemetry record; network I/O happens
+    here. Everything queued is drained at once and published per switch, one
+    message per record in arrival order, so a backlog costs no readings.
+    With TELEMETRY_COALESCE, a load-shedding mode, only the newest record per
+    switch is sent instead.
+
+    A switch whose client is not connected yet, or has dropped, keeps only
+    its newest record, which is sent when client_connected() reports the
+    connection or before the switch's next published record. Records
+    replaced either way are counted in records_coalesced and
+    homegrid_telemetry_records_coalesced_total.
+    """
+
+    STOP = None
+
+    def __init__(self):
+        self.logger = homegrid_logger.Logger(__name__)
+        self.telemetry_queue = queue.Queue()
+        self.thread = None
+        self.records_received = 0
+        self.records_coalesced = 0
+        self.batches_published = 0
+        # GUID -> newest record held back for a switch that is not connected;
+        # only the publisher thread touches it.
+        self.waiting: Dict[str, Switch_telemetry] = {}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__publisher_thread)
+        self.thread.start()
+
+    def stop(self):
+        self.telemetry_queue.put(self.STOP)
+        if self.thread is not None:
+            self.thread.join()
+
+    def publish(self, telemetry: Switch_telemetry):
+        self.telemetry_queue.put(telemetry)
+
+    def client_connected(self, GUID: str, client):
+        """Sends the record held back for a switch, from any thread."""
+        self.telemetry_queue.put(Client_connected(GUID, client))
+
+    def __publisher_thread(self):
+        running = True
+        while running:
+            # GUID -> its records in arrival order
+            pending: Dict[str, List[Switch_telemetry]] = {}
+            item = self.telemetry_queue.get()
+            while True:
+                if item is self.STOP:
+                    running = False
+                    break
+                if isinstance(item, Client_connected):
+                    # Records may predate the switch's client.
+                    records = pending.get(item.GUID, [])
+                    waiting = self.waiting.pop(item.GUID, None)
+                    if waiting is not None:
+                        records.insert(0, waiting)
+                    if records:
+                        pending[item.GUID] = [
+                            record._replace(client=item.client) for record in records
+                        ]
+                else:
+                    self.records_received += 1
+                    records = pending.setdefault(item.GUID, [])
+                    if records and config.TELEMETRY_COALESCE:
+                        self.__count_coalesced(len(records))
+                        records.clear()
+                    records.append(item)
+                try:
+                    item = self.telemetry_queue.get_nowait()
+                except queue.Empty:
+                    break
+            for records in pending.values():
+                for telemetry in records:
+                    self.__publish_or_hold(telemetry)
+
+    def __publish_or_hold(self, telemetry: Switch_telemetry):
+        client = telemetry.client
+        if client is None or not client.connected:
+            if telemetry.GUID in self.waiting:
+                self.__count_coalesced(1)
+            self.waiting[telemetry.GUID] = telemetry
+            return
+        waiting = self.waiting.pop(telemetry.GUID, None)
+        try:
+            if waiting is not None:
+                # Held back while not connected, so older than this.
+                self.publish_now(waiting._replace(client=client))
+            self.publish_now(telemetry)
+        except Exception as e:
+            self.logger.error("Failed to Publish Telemetry for %s: %s", telemetry.GUID, e)
+
+    def __count_coalesced(self, count: int):
+        self.records_coalesced += count
+        metrics.TELEMETRY_RECORDS_COALESCED.inc(count)
+
+    def publish_now(self, telemetry: Switch_telemetry):
+        client = telemetry.client
+        if client is None or not client.connected:
+            return
+        start_time = time.perf_counter()
+        if config.TELEMETRY_BATCH_PUBLISH:
+            payload = telemetry.payload
+            if payload is None:
+                payload = json.dumps(telemetry_to_channels(telemetry))
+            # One message on the Cayenne JSON data topic carries every channel.
+            # Publish through paho directly; CayenneMQTTClient.mqttPublish
+            # prints every payload to stdout.
+            client.client.publish(f"{client.rootTopic}/data/json", payload, 0, False)
+        else:
+            for channel in telemetry_to_channels(telemetry):
+                client.virtualWrite(
+                    channel["channel"],
+                    channel["value"],
+                    dataType=channel["type"],
+                    dataUnit=channel["unit"],
+                )
+        self.batches_published += 1
+        metrics.TELEMETRY_PUBLISH_SECONDS.observe(time.perf_counter() - start_time)
+        metrics.READING_TO_PUBLISH_SECONDS.observe(time.time() - telemetry.timestamp)
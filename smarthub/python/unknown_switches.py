@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Unknown Switches Module
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+from active_switch_list import Active_switch_list
+import cayenne_credentials
+import collections
+import config
+import homegrid_logger
+import metrics
+import queue
+from smartswitch import SmartSwitch
+import threading
+import time
+from typing import Callable, List, Optional
+
+
+class Unknown_MAC_cache:
+    """
+    Remembers MACs that sent readings but have no switch.
+
+    The first reading from such a MAC is reported; later ones only bump a
+    counter until the entry is UNKNOWN_MAC_TTL_SECONDS old, so a plug left
+    unregistered costs one dict lookup per frame rather than a log record
+    every second. At most UNKNOWN_MAC_CACHE_SIZE MACs are kept, the oldest
+    evicted first.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # MAC -> [expiry time, readings]
+        self.entries: "collections.OrderedDict[str, list]" = collections.OrderedDict()
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def record(self, MAC: str) -> Optional[int]:
+        """
+        Counts a reading from an unknown MAC. Returns None while the MAC is
+        cached, otherwise the readings counted for it before its entry
+        expired (0 the first time), meaning it should be reported.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(MAC)
+            if entry is not None and now < entry[0]:
+                entry[1] += 1
+                return None
+            previous = 0
+            if entry is not None:
+                previous = entry[1]
+                del self.entries[MAC]
+            elif len(self.entries) >= config.UNKNOWN_MAC_CACHE_SIZE:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+            self.entries[MAC] = [now + config.UNKNOWN_MAC_TTL_SECONDS, 1]
+        return previous
+
+    def forget(self, MAC: str):
+        with self.lock:
+            self.entries.pop(MAC, None)
+
+    def busiest(self, count: int) -> List[tuple]:
+        """The cached MACs with the most readings, as (MAC, readings)."""
+        with self.lock:
+            entries = [(MAC, entry[1]) for MAC, entry in self.entries.items()]
+        return sorted(entries, key=lambda entry: entry[1], reverse=True)[:count]
+
+
+class Switch_provisioner:
+    """
+    Registers a switch for an unknown MAC from a background thread.
+
+    The switch gets the first Cayenne client ID in
+    cayenne_credentials.CLIENT_ID_LIST that no switch uses, and on_provisioned
+    is called so its MQTT client is opened like any other. Provisioning runs
+    off the Zigbee workers, which only queue the MAC; a MAC that finds no
+    free client ID stays unknown and is tried again when its cache entry
+    expires.
+    """
+
+    STOP = None
+
+    def __init__(
+        self,
+        active_switch_list: Active_switch_list,
+        unknown_MACs: Unknown_MAC_cache,
+        on_provisioned: Optional[Callable[[SmartSwitch], None]] = None,
+    ):
+        self.logger = homegrid_logger.Logger(__name__)
+        self.active_switch_list = active_switch_list
+        self.unknown_MACs = unknown_MACs
+        self.on_provisioned = on_provisioned
+        self.provision_queue = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__provisioner_thread, name="provisioner")
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.provision_queue.put(self.STOP)
+        self.thread.join()
+        self.thread = None
+
+    def provision(self, MAC: str):
+        self.provision_queue.put(MAC)
+
+    def __provisioner_thread(self):
+        while True:
+            MAC = self.provision_queue.get()
+            if MAC is self.STOP:
+                return
+            try:
+                self.__provision(MAC)
+            except Exception as e:
+                self.logger.error("Failed to Provision Switch for MAC %s: %s", MAC, e)
+
+    def __free_GUID(self) -> Optional[str]:
+        for GUID in cayenne_credentials.CLIENT_ID_LIST:
+            if self.active_switch_list.get_switch_from_GUID(GUID) is None:
+                return GUID
+        return None
+
+    def __provision(self, MAC: str):
+        if self.active_switch_list.get_switch_from_MAC(MAC) is not None:
+            self.unknown_MACs.forget(MAC)
+            return
+        GUID = self.__free_GUID()
+        if GUID is None:
+            self.logger.warning("No Unassigned Cayenne Client ID for MAC %s", MAC)
+            return
+        switch = SmartSwitch(MAC, GUID)
+        self.active_switch_list.add_switch(switch)
+        self.unknown_MACs.forget(MAC)
+        metrics.SWITCHES_PROVISIONED.inc()
+        self.logger.info("Provisioned Switch for MAC %s as %s", MAC, GUID)
+        if self.on_provisioned is not None:
+            self.on_provisioned(switch)
@@ -7,20 +7,92 @@ __author__ = "Nick Schiffer"
 __version__ = "1.0.0"
 
 
+import numpy as np
+import struct
 import time
-from typing import Optional
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+
+# Binary telemetry frame sent by plug.py, relayed by the coordinator as hex:
+# version, state (0 is on), sequence, power in centiwatts and voltage in
+# centivolts, little-endian with no padding.
+TELEMETRY_FRAME_VERSION = 1
+TELEMETRY_FRAME = struct.Struct("<BBHIH")
+TELEMETRY_FRAME_DTYPE = np.dtype(
+    [
+        ("version", np.uint8),
+        ("state", np.uint8),
+        ("sequence", "<u2"),
+        ("power", "<u4"),
+        ("voltage", "<u2"),
+    ]
+)
+# A plug numbers its first frame after starting 0, then counts 1 to 65535
+# and wraps back to 1.
+TELEMETRY_SEQUENCE_MODULUS = (1 << 16) - 1
 
 
 class Xbee_coordinator_message:
-    def __init__(self, MAC: str, power_state: bool, power_draw: float, voltage: float):
+    __slots__ = ("MAC", "power_state", "power_draw", "voltage", "timestamp", "sequence")
+
+    def __init__(
+        self,
+        MAC: str,
+        power_state: bool,
+        power_draw: float,
+        voltage: float,
+        sequence: Optional[int] = None,
+    ):
         self.MAC = MAC
         self.power_state = power_state
         self.power_draw = power_draw
         self.voltage = voltage
         self.timestamp = time.time()
+        # Only binary telemetry frames carry one; None for the text format.
+        self.sequence = sequence
+
+
+def unframe_coordinator_line(line: str) -> Optional[str]:
+    """
+    Strips and checks the "*<checksum>" the coordinator appends to each line,
+    two hex digits of 0xFF minus the low byte of the sum of the line's bytes,
+    as in an XBee API frame. A line without one, from older coordinator
+    firmware, is returned as is; one whose checksum does not match gives None.
+    """
+    star = len(line) - 3
+    if star < 0 or "*" != line[star]:
+        return line
+    body = line[:star]
+    try:
+        checksum = int(line[star + 1 :], 16)
+    except ValueError:
+        return None
+    if 0xFF - (sum(body.encode()) & 0xFF) != checksum:
+        return None
+    return body
+
+
+def telemetry_frame_to_object(MAC: str, frame: str) -> Optional[Xbee_coordinator_message]:
+    """Decodes the hex of a binary telemetry frame; None if it is not one."""
+    try:
+        version, state, sequence, centiwatts, centivolts = TELEMETRY_FRAME.unpack(
+            bytes.fromhex(frame)
+        )
+    except (ValueError, struct.error):
+        return None
+    if TELEMETRY_FRAME_VERSION != version or state > 1:
+        return None
+    return Xbee_coordinator_message(MAC, 0 == state, centiwatts / 100, centivolts / 100, sequence)
 
 
 def xbee_message_to_object(message: str) -> Optional[Xbee_coordinator_message]:
+    """
+    Parses "<MAC>,<state>,<power>,<voltage>" or, from plugs sending binary
+    frames, "<MAC>,<frame as hex>".
+    """
+    MAC, _, values = message.partition(",")
+    if "," not in values:
+        return telemetry_frame_to_object(MAC, values)
     try:
         components = message.split(",")
         MAC = str(components[0])
@@ -34,9 +106,203 @@ def xbee_message_to_object(message: str) -> Optional[Xbee_coordinator_message]:
         return None
 
 
+class Xbee_coordinator_batch:
+    """
+    Columnar form of many coordinator messages.
+
+    Row i of every array belongs to the same reading. MAC is an object array
+    of str so values can be used directly as Active_switch_list keys.
+    sequence is -1 for readings in the text format.
+    """
+
+    def __init__(
+        self,
+        MAC: np.ndarray,
+        power_state: np.ndarray,
+        power_draw: np.ndarray,
+        voltage: np.ndarray,
+        timestamp: np.ndarray,
+        sequence: Optional[np.ndarray] = None,
+    ):
+        self.MAC = MAC
+        self.power_state = power_state
+        self.power_draw = power_draw
+        self.voltage = voltage
+        self.timestamp = timestamp
+        self.sequence = np.full(len(MAC), -1, dtype=np.int32) if sequence is None else sequence
+
+    def __len__(self) -> int:
+        return len(self.MAC)
+
+    def messages(self) -> Iterator[Xbee_coordinator_message]:
+        for MAC, power_state, power_draw, voltage, timestamp, sequence in zip(
+            self.MAC.tolist(),
+            self.power_state.tolist(),
+            self.power_draw.tolist(),
+            self.voltage.tolist(),
+            self.timestamp.tolist(),
+            self.sequence.tolist(),
+        ):
+            message = Xbee_coordinator_message(
+                MAC, power_state, power_draw, voltage, None if sequence < 0 else sequence
+            )
+            message.timestamp = timestamp
+            yield message
+
+
+def telemetry_frames_to_array(frames: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decodes the hex of many binary telemetry frames. Returns the frames as a
+    TELEMETRY_FRAME_DTYPE array and a mask of the ones that are valid.
+    """
+    decoded = np.zeros(len(frames), dtype=TELEMETRY_FRAME_DTYPE)
+    try:
+        decoded[:] = np.frombuffer(bytes.fromhex("".join(frames)), dtype=TELEMETRY_FRAME_DTYPE)
+    except ValueError:
+        # One bad hex digit fails the whole join; find it row by row.
+        for index, frame in enumerate(frames):
+            try:
+                decoded[index] = np.frombuffer(bytes.fromhex(frame), dtype=TELEMETRY_FRAME_DTYPE)[0]
+            except ValueError:
+                pass
+    good = (TELEMETRY_FRAME_VERSION == decoded["version"]) & (decoded["state"] <= 1)
+    return decoded, good
+
+
+def xbee_messages_to_batch(
+    messages: Sequence[str],
+    timestamps: Union[None, float, Sequence[float]] = None,
+) -> Tuple[Xbee_coordinator_batch, List[str]]:
+    """
+    Parses many coordinator lines at once.
+
+    Returns the readings as an Xbee_coordinator_batch, in line order, and the
+    lines that are not readings (such as "<MAC>,Config Success") as a reject
+    list. timestamps is either one receive time for every line or one per
+    line; it defaults to now.
+    """
+    if timestamps is None:
+        timestamps = time.time()
+    per_line_timestamps = not isinstance(timestamps, (int, float))
+
+    MACs: List[str] = []
+    fields: List[str] = []
+    rows: List[int] = []
+    frame_MACs: List[str] = []
+    frames: List[str] = []
+    frame_rows: List[int] = []
+    rejects: List[str] = []
+    for index, message in enumerate(messages):
+        commas = message.count(",")
+        if 1 == commas:
+            MAC, _, frame = message.partition(",")
+            if 2 * TELEMETRY_FRAME.size == len(frame):
+                frame_MACs.append(MAC)
+                frames.append(frame)
+                frame_rows.append(index)
+                continue
+        if 3 != commas:
+            rejects.append(message)
+            continue
+        MAC, _, values = message.partition(",")
+        MACs.append(MAC)
+        fields.append(values)
+        rows.append(index)
+
+    # Every number in the batch is converted in one C-level pass; only a
+    # batch containing a bad number pays for finding it row by row.
+    try:
+        values = np.fromstring(",".join(fields), dtype=np.float64, sep=",")
+    except ValueError:
+        values = None
+    if values is not None and values.size == 3 * len(fields):
+        values = values.reshape(-1, 3)
+    else:
+        values = np.empty((len(fields), 3), dtype=np.float64)
+        good = np.ones(len(fields), dtype=bool)
+        for index, row in enumerate(fields):
+            try:
+                values[index] = [float(value) for value in row.split(",")]
+            except ValueError:
+                good[index] = False
+        for index in np.flatnonzero(~good).tolist():
+            rejects.append(messages[rows[index]])
+        values = values[good]
+        MACs = [MAC for MAC, keep in zip(MACs, good.tolist()) if keep]
+        rows = [row for row, keep in zip(rows, good.tolist()) if keep]
+
+    state = values[:, 0]
+    integral = state == np.floor(state)
+    if not integral.all():
+        for index in np.flatnonzero(~integral).tolist():
+            rejects.append(messages[rows[index]])
+        values = values[integral]
+        state = values[:, 0]
+        MACs = [MAC for MAC, keep in zip(MACs, integral.tolist()) if keep]
+        rows = [row for row, keep in zip(rows, integral.tolist()) if keep]
+
+    # Same convention as xbee_message_to_object: the plug reports 0 when on.
+    power_state = 0.0 == state
+    power_draw = values[:, 1]
+    voltage = values[:, 2]
+    sequence = np.full(len(MACs), -1, dtype=np.int32)
+    if frames:
+        decoded, good = telemetry_frames_to_array(frames)
+        if not good.all():
+            for index in np.flatnonzero(~good).tolist():
+                rejects.append(messages[frame_rows[index]])
+            decoded = decoded[good]
+            frame_MACs = [MAC for MAC, keep in zip(frame_MACs, good.tolist()) if keep]
+            frame_rows = [row for row, keep in zip(frame_rows, good.tolist()) if keep]
+        MACs += frame_MACs
+        power_state = np.concatenate([power_state, 0 == decoded["state"]])
+        power_draw = np.concatenate([power_draw, decoded["power"] / 100])
+        voltage = np.concatenate([voltage, decoded["voltage"] / 100])
+        sequence = np.concatenate([sequence, decoded["sequence"].astype(np.int32)])
+        if rows and frame_rows:
+            # A plug part way through migrating may send both formats; keep
+            # its readings in the order they arrived.
+            order = np.argsort(np.asarray(rows + frame_rows), kind="stable")
+            MACs = [MACs[index] for index in order.tolist()]
+            power_state = power_state[order]
+            power_draw = power_draw[order]
+            voltage = voltage[order]
+            sequence = sequence[order]
+        rows += frame_rows
+        rows.sort()
+
+    MAC_array = np.empty(len(MACs), dtype=object)
+    MAC_array[:] = MACs
+    if per_line_timestamps:
+        timestamp_array = np.asarray(timestamps, dtype=np.float64)[
+            np.asarray(rows, dtype=np.intp)
+        ]
+    else:
+        timestamp_array = np.full(len(MACs), float(timestamps))
+
+    batch = Xbee_coordinator_batch(
+        MAC=MAC_array,
+        power_state=power_state,
+        power_draw=np.ascontiguousarray(power_draw),
+        voltage=np.ascontiguousarray(voltage),
+        timestamp=timestamp_array,
+        sequence=sequence,
+    )
+    return batch, rejects
+
+
 if __name__ == "__main__":
     sample_message_good = "0013a20041cc5773,1,15.169,122.5637"
     sample_message_bad = "0013a20041cc5773,Config Success"
+    sample_message_framed = "0013a20041cc5773,1,15.169,122.5637*c6"
+    sample_message_binary = "0013a20041cc5773,01010700ed050000e02f"
+
+    if sample_message_good != unframe_coordinator_line(sample_message_framed):
+        print("Unframe Failed")
+        exit(1)
+    if unframe_coordinator_line(sample_message_framed[:-1] + "f") is not None:
+        print("Checksum Not Checked")
+        exit(1)
 
     parsed_message = xbee_message_to_object(message=sample_message_good)
     if parsed_message is None:
@@ -48,4 +314,22 @@ if __name__ == "__main__":
     print(f"Power Draw: {parsed_message.power_draw}")
     print(f"Voltage: {parsed_message.voltage}")
     print(f"Timestamp: {parsed_message.timestamp}")
+
+    binary_message = xbee_message_to_object(sample_message_binary)
+    if binary_message is None or (False, 15.17, 122.56, 7) != (
+        binary_message.power_state,
+        binary_message.power_draw,
+        binary_message.voltage,
+        binary_message.sequence,
+    ):
+        print("Binary Frame Parse Failed")
+        exit(1)
+
+    batch, rejects = xbee_messages_to_batch(
+        [sample_message_binary, sample_message_good, sample_message_bad]
+    )
+    if 2 != len(batch) or [sample_message_bad] != rejects or [7, -1] != batch.sequence.tolist():
+        print("Batch Parse Failed")
+        exit(1)
+    print(f"Batch MAC: {batch.MAC}, Rejects: {rejects}")
     exit(0)
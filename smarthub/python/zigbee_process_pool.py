@@ -0,0 +1,662 @@
+#!/usr/bin/env python3
+"""
+Zigbee Process Pool Module
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+from active_switch_list import Active_switch_list
+import collections
+import config
+import homegrid_logger
+import json
+import metrics
+import multiprocessing
+from multiprocessing import connection, shared_memory
+import numpy as np
+import signal
+from smartswitch import (
+    SmartSwitch,
+    SmartSwitchSerializable,
+    smart_switch_serializable_to_switch,
+    smart_switch_to_serializable,
+)
+from telemetry_publisher import Switch_telemetry, telemetry_to_channels
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from xbee_message_parser import Xbee_coordinator_message
+import zlib
+
+# One reading handed to a worker process; switch is the index of the switch
+# in that worker's table.
+READING_DTYPE = np.dtype(
+    [
+        ("switch", np.int32),
+        ("power_state", np.bool_),
+        ("power_draw", np.float64),
+        ("voltage", np.float64),
+        ("timestamp", np.float64),
+    ]
+)
+
+# What the worker computed for one reading. payload_length is -1 when the
+# JSON payload did not fit in PAYLOAD_BYTES, or was not prepared.
+RESULT_DTYPE = np.dtype(
+    [
+        ("switch", np.int32),
+        ("ok", np.bool_),
+        ("power_state", np.bool_),
+        ("power_draw", np.float64),
+        ("voltage", np.float64),
+        ("cumulative_power_consumption_kwh", np.float64),
+        ("cumulative_power_cost_dollars", np.float64),
+        ("last_time_seen", np.float64),
+        ("timestamp", np.float64),
+        ("payload_length", np.int32),
+    ]
+)
+
+# Room for each reading's Cayenne JSON payload, about 500 bytes.
+PAYLOAD_BYTES = 1024
+
+ADD_SWITCH = "add"
+REMOVE_SWITCH = "remove"
+REKEY_SWITCH = "rekey"
+PROCESS_BATCH = "batch"
+STOP = None
+
+
+def shared_memory_size(slots: int, readings: int) -> int:
+    return slots * readings * (READING_DTYPE.itemsize + RESULT_DTYPE.itemsize + PAYLOAD_BYTES)
+
+
+def batch_views(buffer, slots: int, readings: int) -> Tuple[np.ndarray, np.ndarray, memoryview]:
+    """The reading slots, result slots and payload area of one worker's shared memory."""
+    reading_bytes = slots * readings * READING_DTYPE.itemsize
+    result_bytes = slots * readings * RESULT_DTYPE.itemsize
+    reading_slots = np.ndarray((slots, readings), READING_DTYPE, buffer, 0)
+    result_slots = np.ndarray((slots, readings), RESULT_DTYPE, buffer, reading_bytes)
+    payloads = memoryview(buffer)[reading_bytes + result_bytes :]
+    return reading_slots, result_slots, payloads
+
+
+def worker_process(
+    shard: int,
+    settings: Dict[str, Any],
+    requests: connection.Connection,
+    results: connection.Connection,
+    memory_name: str,
+    slots: int,
+    readings: int,
+):
+    """
+    Entry point of a worker process. Owns the SmartSwitch state of its
+    shard's switches and handles each batch the hub process hands it.
+    """
+    # Ctrl-C reaches the whole process group; the hub stops its workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for name, value in settings.items():
+        setattr(config, name, value)
+    logger = homegrid_logger.Logger(__name__)
+    memory = shared_memory.SharedMemory(memory_name)
+    reading_slots, result_slots, payloads = batch_views(memory.buf, slots, readings)
+    switches: List[Optional[SmartSwitch]] = []
+    try:
+        while True:
+            request = requests.recv()
+            if request is STOP:
+                return
+            if ADD_SWITCH == request[0]:
+                _, index, serializable = request
+                switches.extend([None] * (index + 1 - len(switches)))
+                switches[index] = smart_switch_serializable_to_switch(serializable)
+                continue
+            if REMOVE_SWITCH == request[0]:
+                switches[request[1]] = None
+                continue
+            if REKEY_SWITCH == request[0]:
+                _, index, MAC = request
+                switches[index].MAC = MAC
+                continue
+            _, slot, count = request
+            try:
+                handle_batch(switches, reading_slots[slot, :count], result_slots[slot], payloads, slot)
+            except Exception as e:
+                logger.error("Worker Process %d Failed to Handle a Batch: %s", shard, e)
+                result_slots[slot, :count]["ok"] = False
+            results.send((slot, count))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        # The views must go before the memory can be closed.
+        del reading_slots, result_slots, payloads
+        memory.close()
+        homegrid_logger.Logger.shutdown()
+
+
+def handle_batch(
+    switches: List[Optional[SmartSwitch]],
+    batch: np.ndarray,
+    result_slot: np.ndarray,
+    payloads: memoryview,
+    slot: int,
+):
+    count = len(batch)
+    payload_base = slot * len(result_slot) * PAYLOAD_BYTES
+    ok: List[bool] = []
+    cumulative_kwh: List[float] = []
+    cumulative_dollars: List[float] = []
+    last_time_seen: List[float] = []
+    payload_lengths: List[int] = []
+    for row, (index, power_state, power_draw, voltage, timestamp) in enumerate(
+        zip(
+            batch["switch"].tolist(),
+            batch["power_state"].tolist(),
+            batch["power_draw"].tolist(),
+            batch["voltage"].tolist(),
+            batch["timestamp"].tolist(),
+        )
+    ):
+        switch = switches[index]
+        telemetry = None
+        if switch is not None:
+            message = Xbee_coordinator_message(switch.MAC, power_state, power_draw, voltage)
+            message.timestamp = timestamp
+            telemetry = switch.handle_serial_message(message)
+        if telemetry is None:
+            # Failed, or for a switch removed while its readings were queued.
+            ok.append(False)
+            cumulative_kwh.append(0.0)
+            cumulative_dollars.append(0.0)
+            last_time_seen.append(0.0)
+            payload_lengths.append(-1)
+            continue
+        ok.append(True)
+        cumulative_kwh.append(telemetry.cumulative_power_consumption_kwh)
+        cumulative_dollars.append(telemetry.cumulative_power_cost_dollars)
+        last_time_seen.append(switch.last_time_seen)
+        payload_length = -1
+        if config.TELEMETRY_BATCH_PUBLISH:
+            payload = json.dumps(telemetry_to_channels(telemetry)).encode()
+            if len(payload) <= PAYLOAD_BYTES:
+                start = payload_base + row * PAYLOAD_BYTES
+                payloads[start : start + len(payload)] = payload
+                payload_length = len(payload)
+        payload_lengths.append(payload_length)
+    result = result_slot[:count]
+    result["switch"] = batch["switch"]
+    result["power_state"] = batch["power_state"]
+    result["power_draw"] = batch["power_draw"]
+    result["voltage"] = batch["voltage"]
+    result["timestamp"] = batch["timestamp"]
+    result["ok"] = ok
+    result["cumulative_power_consumption_kwh"] = cumulative_kwh
+    result["cumulative_power_cost_dollars"] = cumulative_dollars
+    result["last_time_seen"] = last_time_seen
+    result["payload_length"] = payload_lengths
+
+
+class Worker_process:
+    """The hub process's side of one worker process."""
+
+    def __init__(self, shard: int, slots: int, readings: int):
+        self.shard = shard
+        self.readings = readings
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=shared_memory_size(slots, readings)
+        )
+        self.reading_slots, self.result_slots, self.payloads = batch_views(
+            self.memory.buf, slots, readings
+        )
+        self.free_slots: List[int] = list(range(slots))
+        self.sent_times: List[float] = [0.0] * slots
+        # (slot, count) of the batches sent and not yet back, in the order
+        # sent, which is the order their results come back in.
+        self.in_flight: Deque[Tuple[int, int]] = collections.deque()
+        # Readings waiting for a free slot, in arrival order.
+        self.backlog: Deque[Tuple[int, bool, float, float, float]] = collections.deque()
+        # Index in the worker's table -> the hub's switch; None once removed.
+        self.switches: List[Optional[SmartSwitch]] = []
+        # Guards the slots, the backlog and the request pipe.
+        self.lock = threading.Lock()
+        self.process: Optional[multiprocessing.Process] = None
+        self.requests: Optional[connection.Connection] = None
+        self.results: Optional[connection.Connection] = None
+        self.restarts = 0
+        # Set once the process is gone for good; its readings are dropped.
+        self.dead = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.handled = 0
+        self.dropped = 0
+        self.round_trip_total = 0.0
+        self.round_trip_max = 0.0
+        self.batches = 0
+
+    def slots_in_use(self) -> int:
+        return len(self.sent_times) - len(self.free_slots)
+
+    def close(self):
+        del self.reading_slots, self.result_slots, self.payloads
+        self.memory.close()
+        self.memory.unlink()
+
+
+class Zigbee_process_pool:
+    """
+    Processes Zigbee readings in worker processes, so a large fleet is not
+    limited to the one core the hub process's threads share.
+
+    Readings are still framed and parsed in the hub process. Every switch
+    belongs to the worker its MAC hashes to, and that worker keeps the
+    switch's SmartSwitch state: energy accounting, history and the Cayenne
+    JSON payload all run there. Readings go to a worker as fixed-layout
+    records in a shared-memory slot, and only the slot number crosses the
+    pipe. The worker writes its results into the matching result slot, and
+    the hub process's result thread copies the new counters into its own
+    switch, for persistence, and hands a Switch_telemetry carrying the
+    prepared payload to handle_result.
+
+    A worker handles its batches in order, so readings for one switch are
+    applied in arrival order. When all of a worker's ZIGBEE_PROCESS_SLOTS
+    slots are in flight, further readings wait in a backlog in the hub
+    process rather than block the serial receiver, up to
+    ZIGBEE_PROCESS_BACKLOG_READINGS.
+
+    A worker that exits is restarted on the same shared memory, up to
+    ZIGBEE_PROCESS_MAX_RESTARTS times. It is sent the hub's state for its
+    switches, which holds every result applied so far, and then the batches
+    still in flight and the backlog, so no reading is lost or counted twice.
+    Past that limit the worker is dead and its readings are dropped and
+    counted in homegrid_zigbee_process_dropped_total.
+
+    Switches are given to a worker on their first reading with the state
+    the hub holds for them. The pool listens to the Active_switch_list: a
+    removed switch is dropped from its worker, so its readings go to
+    handle_unknown again, and a re-keyed switch keeps its worker and state
+    under the new MAC. Their history lives in the worker, so
+    Active_switch_list.query_history has nothing to answer from in this
+    mode; the readings archive has it.
+    """
+
+    def __init__(
+        self,
+        active_switch_list: Active_switch_list,
+        handle_result: Callable[[SmartSwitch, Switch_telemetry], None],
+        handle_unknown: Callable[[Xbee_coordinator_message], None],
+        worker_count: int = config.ZIGBEE_WORKER_COUNT,
+    ):
+        self.logger = homegrid_logger.Logger(__name__)
+        self.active_switch_list = active_switch_list
+        self.handle_result = handle_result
+        self.handle_unknown = handle_unknown
+        self.worker_count = max(1, worker_count)
+        self.workers: List[Worker_process] = []
+        # MAC -> (worker, index in its table)
+        self.assignments: Dict[str, Tuple[Worker_process, int]] = {}
+        self.assign_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.result_thread: Optional[threading.Thread] = None
+        self.context = multiprocessing.get_context("spawn")
+        self.settings: Dict[str, Any] = {}
+        self.stopping = False
+
+    def shard_for(self, MAC: str) -> int:
+        # The same mapping as Zigbee_worker_pool.
+        return zlib.crc32(MAC.encode()) % self.worker_count
+
+    def start(self):
+        self.active_switch_list.add_listener(self)
+        # Workers are spawned rather than forked from a hub already running
+        # threads, so they get the hub's settings explicitly.
+        self.settings = {name: getattr(config, name) for name in dir(config) if name.isupper()}
+        start_time = time.perf_counter()
+        for shard in range(self.worker_count):
+            worker = Worker_process(
+                shard, config.ZIGBEE_PROCESS_SLOTS, config.ZIGBEE_PROCESS_BATCH_READINGS
+            )
+            self.__spawn(worker)
+            self.workers.append(worker)
+        self.result_thread = threading.Thread(
+            target=self.__result_thread, name="zigbee-process-results"
+        )
+        self.result_thread.start()
+        self.logger.info(
+            "Started %d Zigbee Worker Processes in %.3f s",
+            self.worker_count,
+            time.perf_counter() - start_time,
+        )
+
+    def __spawn(self, worker: Worker_process):
+        request_reader, worker.requests = self.context.Pipe(duplex=False)
+        worker.results, result_writer = self.context.Pipe(duplex=False)
+        worker.process = self.context.Process(
+            target=worker_process,
+            args=(
+                worker.shard,
+                self.settings,
+                request_reader,
+                result_writer,
+                worker.memory.name,
+                len(worker.sent_times),
+                worker.readings,
+            ),
+            name=f"zigbee-process-{worker.shard}",
+            daemon=True,
+        )
+        worker.process.start()
+        # Only the worker keeps these ends, so its exit shows up as EOF.
+        request_reader.close()
+        result_writer.close()
+
+    def stop(self):
+        self.active_switch_list.remove_listener(self)
+        self.stopping = True
+        # Let readings already handed over come back and be published.
+        deadline = time.monotonic() + config.ZIGBEE_PROCESS_STOP_TIMEOUT_SECONDS
+        while time.monotonic() < deadline and any(
+            worker.backlog or worker.slots_in_use() for worker in self.workers
+        ):
+            time.sleep(0.01)
+        for worker in self.workers:
+            with worker.lock:
+                try:
+                    worker.requests.send(STOP)
+                except (OSError, ValueError):
+                    pass
+        for worker in self.workers:
+            worker.process.join(config.ZIGBEE_PROCESS_STOP_TIMEOUT_SECONDS)
+            if worker.process.is_alive():
+                self.logger.warning("Terminating Zigbee Worker Process %d", worker.shard)
+                worker.process.terminate()
+                worker.process.join()
+        if self.result_thread is not None:
+            self.result_thread.join()
+            self.result_thread = None
+        for worker in self.workers:
+            worker.requests.close()
+            worker.results.close()
+            worker.close()
+        self.workers = []
+        self.assignments = {}
+
+    def submit(self, messages: List[Xbee_coordinator_message]):
+        batches: Dict[Worker_process, List[Tuple[int, bool, float, float, float]]] = {}
+        assignments = self.assignments
+        for message in messages:
+            assignment = assignments.get(message.MAC)
+            if assignment is None:
+                switch = self.active_switch_list.get_switch_from_MAC(message.MAC)
+                if switch is None:
+                    self.handle_unknown(message)
+                    continue
+                assignment = self.__assign(switch)
+                if assignment is None:
+                    self.handle_unknown(message)
+                    continue
+            worker, index = assignment
+            batches.setdefault(worker, []).append(
+                (index, message.power_state, message.power_draw, message.voltage, message.timestamp)
+            )
+        for worker, readings in batches.items():
+            with worker.lock:
+                if worker.dead:
+                    self.__drop(worker, len(readings))
+                    continue
+                worker.backlog.extend(readings)
+                overflow = len(worker.backlog) - config.ZIGBEE_PROCESS_BACKLOG_READINGS
+                if overflow > 0:
+                    for _ in range(overflow):
+                        worker.backlog.popleft()
+                    self.__drop(worker, overflow)
+                self.__dispatch(worker)
+
+    def queue_depths(self) -> List[int]:
+        """Batches in flight plus backlogged readings, per worker."""
+        return [worker.slots_in_use() + len(worker.backlog) for worker in self.workers]
+
+    def forget(self, MAC: str):
+        """Drops a switch removed from the Active_switch_list from its worker."""
+        with self.assign_lock:
+            assignment = self.assignments.pop(MAC, None)
+            if assignment is None:
+                return
+            worker, index = assignment
+            with worker.lock:
+                worker.switches[index] = None
+                self.__send(worker, (REMOVE_SWITCH, index))
+
+    def rekey(self, old_MAC: str, new_MAC: str):
+        """
+        Follows a switch to its new MAC. It stays with its worker, even if
+        the new MAC hashes elsewhere, so its readings stay in order.
+        """
+        with self.assign_lock:
+            assignment = self.assignments.pop(old_MAC, None)
+            if assignment is None:
+                return
+            self.assignments[new_MAC] = assignment
+            worker, index = assignment
+            with worker.lock:
+                self.__send(worker, (REKEY_SWITCH, index, new_MAC))
+
+    def __assign(self, switch: SmartSwitch) -> Optional[Tuple[Worker_process, int]]:
+        with self.assign_lock:
+            assignment = self.assignments.get(switch.MAC)
+            if assignment is not None:
+                return assignment
+            if self.active_switch_list.get_switch_from_MAC(switch.MAC) is not switch:
+                # Removed since it was looked up.
+                return None
+            worker = self.workers[self.shard_for(switch.MAC)]
+            with worker.lock:
+                index = len(worker.switches)
+                worker.switches.append(switch)
+                with switch.lock:
+                    state: SmartSwitchSerializable = smart_switch_to_serializable(switch)
+                # Sent before any batch that refers to it.
+                self.__send(worker, (ADD_SWITCH, index, state))
+            assignment = (worker, index)
+            self.assignments[switch.MAC] = assignment
+            return assignment
+
+    def __dispatch(self, worker: Worker_process):
+        # Must be called with worker.lock held.
+        while worker.backlog and worker.free_slots:
+            slot = worker.free_slots.pop()
+            count = min(len(worker.backlog), worker.readings)
+            worker.reading_slots[slot, :count] = [
+                worker.backlog.popleft() for _ in range(count)
+            ]
+            worker.sent_times[slot] = time.monotonic()
+            worker.in_flight.append((slot, count))
+            self.__send(worker, (PROCESS_BATCH, slot, count))
+
+    def __send(self, worker: Worker_process, request):
+        # Must be called with worker.lock held.
+        try:
+            worker.requests.send(request)
+        except (OSError, ValueError):
+            # The worker has exited; the result thread restarts it and sends
+            # its switches and unfinished batches again.
+            pass
+
+    def __drop(self, worker: Worker_process, count: int):
+        with self.stats_lock:
+            worker.dropped += count
+        metrics.ZIGBEE_PROCESS_DROPPED.inc(count)
+
+    def __restart(self, worker: Worker_process):
+        # Called from the result thread once the worker's results pipe has
+        # closed, so every result it sent has been applied.
+        worker.process.join(config.ZIGBEE_PROCESS_STOP_TIMEOUT_SECONDS)
+        if worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join()
+        exitcode = worker.process.exitcode
+        with worker.lock:
+            worker.requests.close()
+            worker.results.close()
+            if self.stopping or worker.restarts >= config.ZIGBEE_PROCESS_MAX_RESTARTS:
+                dropped = len(worker.backlog) + sum(count for _, count in worker.in_flight)
+                worker.dead = True
+                worker.backlog.clear()
+                worker.in_flight.clear()
+                worker.free_slots = list(range(len(worker.sent_times)))
+                self.__drop(worker, dropped)
+                if not self.stopping:
+                    self.logger.critical(
+                        "Zigbee Worker Process %d Exited with %s, Dropping its Readings",
+                        worker.shard,
+                        exitcode,
+                    )
+                return
+            worker.restarts += 1
+            metrics.ZIGBEE_PROCESS_RESTARTS.inc()
+            self.logger.error(
+                "Zigbee Worker Process %d Exited with %s, Restarting with %d Batches in Flight",
+                worker.shard,
+                exitcode,
+                len(worker.in_flight),
+            )
+            self.__spawn(worker)
+            for index, switch in enumerate(worker.switches):
+                if switch is None:
+                    continue
+                with switch.lock:
+                    state: SmartSwitchSerializable = smart_switch_to_serializable(switch)
+                self.__send(worker, (ADD_SWITCH, index, state))
+            now = time.monotonic()
+            for slot, count in worker.in_flight:
+                worker.sent_times[slot] = now
+                self.__send(worker, (PROCESS_BATCH, slot, count))
+            self.__dispatch(worker)
+
+    def __result_thread(self):
+        workers = {worker.results: worker for worker in self.workers}
+        while workers:
+            for ready in connection.wait(list(workers)):
+                worker = workers[ready]
+                try:
+                    slot, count = ready.recv()
+                except (EOFError, OSError):
+                    del workers[ready]
+                    self.__restart(worker)
+                    if not worker.dead:
+                        workers[worker.results] = worker
+                    continue
+                round_trip = time.monotonic() - worker.sent_times[slot]
+                metrics.ZIGBEE_PROCESS_ROUND_TRIP_SECONDS.observe(round_trip)
+                try:
+                    self.__apply_results(worker, slot, count)
+                except Exception as e:
+                    self.logger.error(
+                        "Exception while Applying Results from Worker Process %d: %s",
+                        worker.shard,
+                        e,
+                    )
+                with self.stats_lock:
+                    worker.handled += count
+                    worker.batches += 1
+                    worker.round_trip_total += round_trip
+                    worker.round_trip_max = max(worker.round_trip_max, round_trip)
+                with worker.lock:
+                    worker.in_flight.popleft()
+                    worker.free_slots.append(slot)
+                    self.__dispatch(worker)
+
+    def __apply_results(self, worker: Worker_process, slot: int, count: int):
+        results = worker.result_slots[slot, :count]
+        payload_base = slot * worker.readings * PAYLOAD_BYTES
+        payloads = worker.payloads
+        switches = worker.switches
+        for row, (
+            index,
+            ok,
+            power_state,
+            power_draw,
+            voltage,
+            cumulative_kwh,
+            cumulative_dollars,
+            last_time_seen,
+            timestamp,
+            payload_length,
+        ) in enumerate(
+            zip(
+                results["switch"].tolist(),
+                results["ok"].tolist(),
+                results["power_state"].tolist(),
+                results["power_draw"].tolist(),
+                results["voltage"].tolist(),
+                results["cumulative_power_consumption_kwh"].tolist(),
+                results["cumulative_power_cost_dollars"].tolist(),
+                results["last_time_seen"].tolist(),
+                results["timestamp"].tolist(),
+                results["payload_length"].tolist(),
+            )
+        ):
+            switch = switches[index]
+            if not ok or switch is None:
+                continue
+            switch.apply_processed_reading(
+                power_state, last_time_seen, cumulative_kwh, cumulative_dollars
+            )
+            payload = None
+            if payload_length >= 0:
+                start = payload_base + row * PAYLOAD_BYTES
+                payload = bytes(payloads[start : start + payload_length])
+            self.handle_result(
+                switch,
+                Switch_telemetry(
+                    switch.client,
+                    switch.GUID,
+                    power_state,
+                    power_draw,
+                    voltage,
+                    cumulative_kwh,
+                    cumulative_dollars,
+                    timestamp,
+                    payload,
+                ),
+            )
+
+    def take_stats(self) -> List[Dict[str, float]]:
+        """Returns per-worker statistics since the previous call and resets them."""
+        report = []
+        with self.stats_lock:
+            for worker in self.workers:
+                report.append(
+                    {
+                        "shard": worker.shard,
+                        "handled": worker.handled,
+                        "dropped": worker.dropped,
+                        "switches": len(worker.switches),
+                        "slots_in_use": worker.slots_in_use(),
+                        "backlog": len(worker.backlog),
+                        "round_trip_mean_ms": 1000.0 * worker.round_trip_total / worker.batches
+                        if worker.batches
+                        else 0.0,
+                        "round_trip_max_ms": 1000.0 * worker.round_trip_max,
+                    }
+                )
+                worker.reset_stats()
+        return report
+
+    def log_stats(self):
+        for worker in self.take_stats():
+            self.logger.info(
+                "Worker Process %d: handled %d, dropped %d, switches %d, slots in use %d, "
+                "backlog %d, round trip %.1f/%.1f ms mean/max",
+                worker["shard"],
+                worker["handled"],
+                worker["dropped"],
+                worker["switches"],
+                worker["slots_in_use"],
+                worker["backlog"],
+                worker["round_trip_mean_ms"],
+                worker["round_trip_max_ms"],
+            )
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Zigbee Worker Pool Module
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import config
+import homegrid_logger
+import metrics
+import queue
+import threading
+import time
+from typing import Callable, Dict, List
+from xbee_message_parser import Xbee_coordinator_message
+import zlib
+
+
+class Shard_stats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.handled = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.end_to_end_total = 0.0
+        self.end_to_end_max = 0.0
+
+    def record(self, queue_wait: float, end_to_end: float):
+        self.handled += 1
+        self.queue_wait_total += queue_wait
+        self.end_to_end_total += end_to_end
+        if queue_wait > self.queue_wait_max:
+            self.queue_wait_max = queue_wait
+        if end_to_end > self.end_to_end_max:
+            self.end_to_end_max = end_to_end
+
+
+class Zigbee_worker_pool:
+    """
+    Processes Zigbee readings on a fixed set of worker threads.
+
+    Every reading for a MAC hashes to the same shard, and each shard is one
+    queue drained by one worker, so readings for a switch are handled in
+    arrival order while a slow switch only holds up its own shard.
+    """
+
+    STOP = None
+
+    def __init__(
+        self,
+        handle_message: Callable[[Xbee_coordinator_message], None],
+        worker_count: int = config.ZIGBEE_WORKER_COUNT,
+    ):
+        self.logger = homegrid_logger.Logger(__name__)
+        self.handle_message = handle_message
+        self.worker_count = max(1, worker_count)
+        self.shard_queues: List[queue.Queue] = [
+            queue.Queue() for _ in range(self.worker_count)
+        ]
+        self.shard_stats: List[Shard_stats] = [
+            Shard_stats() for _ in range(self.worker_count)
+        ]
+        self.stats_lock = threading.Lock()
+        self.threads: List[threading.Thread] = []
+
+    def shard_for(self, MAC: str) -> int:
+        # crc32 rather than hash() so the mapping is stable across restarts.
+        return zlib.crc32(MAC.encode()) % self.worker_count
+
+    def start(self):
+        for shard in range(self.worker_count):
+            thread = threading.Thread(
+                target=self.__worker_thread, args=(shard,), name=f"zigbee-worker-{shard}"
+            )
+            self.threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        for shard_queue in self.shard_queues:
+            shard_queue.put(self.STOP)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def submit(self, messages: List[Xbee_coordinator_message]):
+        enqueue_time = time.monotonic()
+        if 1 == self.worker_count:
+            self.shard_queues[0].put((enqueue_time, messages))
+            return
+        shards: Dict[int, List[Xbee_coordinator_message]] = {}
+        for message in messages:
+            shards.setdefault(self.shard_for(message.MAC), []).append(message)
+        for shard, shard_messages in shards.items():
+            self.shard_queues[shard].put((enqueue_time, shard_messages))
+
+    def queue_depths(self) -> List[int]:
+        return [shard_queue.qsize() for shard_queue in self.shard_queues]
+
+    def __worker_thread(self, shard: int):
+        shard_queue = self.shard_queues[shard]
+        stats = self.shard_stats[shard]
+        while True:
+            item = shard_queue.get()
+            if item is self.STOP:
+                return
+            enqueue_time, messages = item
+            queue_wait = time.monotonic() - enqueue_time
+            metrics.ZIGBEE_SHARD_QUEUE_WAIT_SECONDS.observe(queue_wait)
+            for message in messages:
+                try:
+                    self.handle_message(message)
+                except Exception as e:
+                    self.logger.error("Exception while Handling %s: %s", message.MAC, e)
+                end_to_end = time.time() - message.timestamp
+                with self.stats_lock:
+                    stats.record(queue_wait, end_to_end)
+
+    def take_stats(self) -> List[Dict[str, float]]:
+        """Returns per-shard statistics since the previous call and resets them."""
+        report = []
+        with self.stats_lock:
+            for shard, stats in enumerate(self.shard_stats):
+                handled = stats.handled
+                report.append(
+                    {
+                        "shard": shard,
+                        "handled": handled,
+                        "queue_depth": self.shard_queues[shard].qsize(),
+                        "queue_wait_mean_ms": 1000.0 * stats.queue_wait_total / handled
+                        if handled
+                        else 0.0,
+                        "queue_wait_max_ms": 1000.0 * stats.queue_wait_max,
+                        "end_to_end_mean_ms": 1000.0 * stats.end_to_end_total / handled
+                        if handled
+                        else 0.0,
+                        "end_to_end_max_ms": 1000.0 * stats.end_to_end_max,
+                    }
+                )
+                stats.reset()
+        return report
+
+    def log_stats(self):
+        for shard in self.take_stats():
+            self.logger.info(
+                "Shard %d: handled %d, depth %d, queue wait %.1f/%.1f ms mean/max, "
+                "end-to-end %.1f/%.1f ms mean/max",
+                shard["shard"],
+                shard["handled"],
+                shard["queue_depth"],
+                shard["queue_wait_mean_ms"],
+                shard["queue_wait_max_ms"],
+                shard["end_to_end_mean_ms"],
+                shard["end_to_end_max_ms"],
+            )
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Coordinator Loop Benchmark
+
+Runs coordinator.py on Linux with the XBee's xbee and sys modules stubbed:
+xbee.receive() hands out frames from a queue and stdout.buffer keeps what
+was written. With --stdin xbee, stdin.buffer.read() returns None when no
+command is waiting, as it does on the XBee; with --stdin pipe, commands
+arrive on a real pipe, which the coordinator polls. Every pass of the loop
+is timed with --frames readings queued on the radio, half of them binary
+telemetry frames, and a command line arriving every --command-every passes,
+in two writes so half a line waits in between. It reports:
+
+- frames/s: readings forwarded per second of loop time; the old loop took
+  one xbee.receive() per 0.1 s pass, at most 10 frames/s;
+- writes: stdout.buffer.write() calls, one per pass with frames to forward;
+- bytes/frame: framed, checksummed line length on the serial port;
+- max pass ms: the longest pass, which bounds how long a command waits;
+  a read that blocked on half a line would show here;
+- hub accepted: lines the hub's unframe_coordinator_line and
+  xbee_message_to_object both take, and whether a corrupted line is caught.
+
+Loop time under CPython is far shorter than on the XBee's MicroPython, so
+frames/s here is an upper bound; the pass and write counts carry over.
+
+    python3 benchmarks/bench_coordinator.py --frames 100000 --stdin pipe
+"""
+
+__author__ = "Nick Schiffer"
+__version__ = "1.0.0"
+
+
+import os
+import sys
+
+PLUG_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HUB_DIRECTORY = os.path.join(PLUG_DIRECTORY, "..", "..", "smarthub", "python")
+sys.path.insert(0, HUB_DIRECTORY)
+
+import argparse
+import collections
+import importlib.util
+import random
+import time
+import types
+from xbee_message_parser import (
+    TELEMETRY_FRAME,
+    TELEMETRY_FRAME_VERSION,
+    unframe_coordinator_line,
+    xbee_message_to_object,
+)
+
+
+class Fake_stdin_buffer:
+    def __init__(self):
+        self.pending = bytearray()
+
+    def read(self, size: int):
+        # Like the XBee's stdin: None rather than blocking when nothing waits.
+        if not self.pending:
+            return None
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+
+class Fake_stdin:
+    def __init__(self):
+        self.buffer = Fake_stdin_buffer()
+
+    def send(self, data: bytes):
+        self.buffer.pending += data
+
+    def close(self):
+        pass
+
+
+class Pipe_stdin:
+    """stdin on the read end of a pipe, as when the coordinator runs on Linux."""
+
+    def __init__(self):
+        read_end, self.write_end = os.pipe()
+        self.file = os.fdopen(read_end, "r")
+        self.buffer = self.file.buffer
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def send(self, data: bytes):
+        os.write(self.write_end, data)
+
+    def close(self):
+        os.close(self.write_end)
+        self.file.close()
+
+
+class Fake_stdout_buffer:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data: bytes):
+        self.chunks.append(data)
+        return len(data)
+
+
+def load_coordinator(stdin):
+    """Imports coordinator.py against stub xbee and sys modules."""
+    frames = collections.deque()
+    transmitted = []
+    fake_xbee = types.ModuleType("xbee")
+    fake_xbee.receive = lambda: frames.popleft() if frames else None
+    fake_xbee.transmit = lambda address, data: transmitted.append((address, data))
+
+    fake_sys = types.ModuleType("sys")
+    fake_sys.stdin = stdin
+    fake_sys.stdout = types.SimpleNamespace(buffer=Fake_stdout_buffer())
+
+    real_sys = sys.modules["sys"]
+    sys.modules["xbee"] = fake_xbee
+    sys.modules["sys"] = fake_sys
+    try:
+        spec = importlib.util.spec_from_file_location(
+            "coordinator", os.path.join(PLUG_DIRECTORY, "coordinator.py")
+        )
+        coordinator = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(coordinator)
+    finally:
+        sys.modules["sys"] = real_sys
+        del sys.modules["xbee"]
+    return coordinator, frames, transmitted, fake_sys.stdout.buffer
+
+
+def make_frames(count: int, plugs: int):
+    # Every other plug sends binary telemetry frames, the rest text.
+    rng = random.Random(1)
+    MACs = [bytes.fromhex(f"0013a200{index:08x}") for index in range(plugs)]
+    frames = []
+    for index in range(count):
+        if index & 1:
+            payload = TELEMETRY_FRAME.pack(
+                TELEMETRY_FRAME_VERSION, 1, index // plugs + 1, rng.randrange(100000), 12000
+            )
+        else:
+            payload = f"0,{rng.random() * 1000.0:.4f},{120.0 + rng.random():.4f}".encode()
+        frames.append({"sender_eui64": MACs[index % plugs], "payload": payload})
+    return frames
+
+
+def measure(arguments: argparse.Namespace):
+    stdin = Pipe_stdin() if "pipe" == arguments.stdin else Fake_stdin()
+    coordinator, frames, transmitted, stdout_buffer = load_coordinator(stdin)
+    if (coordinator.stdin_poll is None) != ("xbee" == arguments.stdin):
+        raise RuntimeError("Coordinator did not Read stdin as Expected")
+    frames.extend(make_frames(arguments.frames, arguments.plugs))
+
+    commands = 0
+    passes = 0
+    longest = 0.0
+    elapsed = 0.0
+    command = b""
+    while frames or command or coordinator.command_buffer:
+        if command:
+            stdin.send(command)
+            command = b""
+        elif 0 == passes % arguments.command_every:
+            command = b"0013a20000000001,%s\n" % (b"on" if commands & 1 else b"off")
+            stdin.send(command[:10])
+            command = command[10:]
+            commands += 1
+        start = time.perf_counter()
+        coordinator.run_pass()
+        duration = time.perf_counter() - start
+        elapsed += duration
+        longest = max(longest, duration)
+        passes += 1
+    idle = not coordinator.run_pass()
+    stdin.close()
+
+    output = b"".join(stdout_buffer.chunks)
+    lines = output.decode().splitlines()
+    accepted = sum(
+        1
+        for line in lines
+        if (payload := unframe_coordinator_line(line)) is not None
+        and xbee_message_to_object(payload) is not None
+    )
+    corrupted = lines[0][:20] + ("1" if "0" == lines[0][20] else "0") + lines[0][21:]
+    return {
+        "frames": arguments.frames,
+        "frames/s": arguments.frames / elapsed,
+        "passes": passes,
+        "writes": len(stdout_buffer.chunks),
+        "bytes/frame": len(output) / arguments.frames,
+        "max pass ms": 1e3 * longest,
+        "commands sent": commands,
+        "commands transmitted": len(transmitted),
+        "hub accepted": accepted,
+        "corruption caught": unframe_coordinator_line(corrupted) is None,
+        "idle when empty": idle,
+    }
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--frames", type=int, default=100000, help="readings queued on the radio")
+    parser.add_argument("--plugs", type=int, default=500)
+    parser.add_argument("--command-every", type=int, default=10, help="passes between command lines")
+    parser.add_argument("--stdin", choices=["xbee", "pipe"], default="xbee")
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    results = measure(arguments)
+    print("old loop: 1 frame per 0.1 s pass, at most 10 frames/s")
+    for name, value in results.items():
+        if isinstance(value, float):
+            print(f"{name:>22}: {value:.1f}")
+        else:
+            print(f"{name:>22}: {value}")
+
+
+if __name__ == "__main__":
+    main()
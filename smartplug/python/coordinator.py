@@ -3,6 +3,26 @@ import binascii
 import xbee
 import time
 
+try:
+    import uselect as select
+except ImportError:
+    try:
+        import select
+    except ImportError:
+        select = None
+
+try:
+    from os import read as read_fd
+except ImportError:
+    read_fd = None
+
+# Received frames forwarded per pass before hub commands are checked again
+MAX_FRAMES_PER_PASS = 64
+# Most command bytes taken from the hub per pass
+MAX_COMMAND_BYTES = 512
+# Pause only when a pass found nothing to do
+IDLE_SLEEP_SECONDS = 0.002
+
 # Pi to XBee Functions
 
 
@@ -17,32 +37,93 @@ def transmit_command_message(command_list):
             print("Transmission failure: {}".format(str(e)))
 
 
+# Bytes of a command line whose terminator has not arrived yet
+command_buffer = b""
+
+# Polls stdin's descriptor and reads only what is waiting on it, since a
+# buffered read() would block until it had all MAX_COMMAND_BYTES. Without
+# select or a descriptor, stdin.buffer.read() returns None when nothing is
+# waiting, as on the XBee.
+stdin_fd = None
+stdin_poll = None
+if select is not None and read_fd is not None:
+    try:
+        stdin_fd = stdin.fileno()
+        stdin_poll = select.poll()
+        stdin_poll.register(stdin_fd, select.POLLIN)
+    except Exception:
+        stdin_poll = None
+
+
+def read_command_bytes():
+    if stdin_poll is None:
+        return stdin.buffer.read(MAX_COMMAND_BYTES)
+    if not stdin_poll.poll(0):
+        return None
+    return read_fd(stdin_fd, MAX_COMMAND_BYTES)
+
+
 def command_message_receiver_handler():
-    # Process input line
-    line = stdin.buffer.read()
+    global command_buffer
+    # Process every complete "MAC,on|off\n" line read so far
+    data = read_command_bytes()
 
-    if line:
-        line = line.decode()
-        command_list = line.split(",")  # CSV delimiter
-        transmit_command_message(command_list)
+    if data:
+        command_buffer += data
+        lines = command_buffer.split(b"\n")
+        command_buffer = lines.pop()
+        for line in lines:
+            line = line.decode().strip()
+            if line:
+                command_list = line.split(",")  # CSV delimiter
+                transmit_command_message(command_list)
+        return True
+    return False
 
 
 # XBee to Pi Functions
-def sensor_message_receiver_handler():
-    received_msg = xbee.receive()
 
-    if received_msg:
+
+def frame_line(line):
+    # "<line>*<checksum>\n", the checksum computed like an XBee API frame's:
+    # 0xFF minus the low byte of the sum of the line's bytes.
+    return line + "*{:02x}\n".format(0xFF - (sum(line) & 0xFF)).encode()
+
+
+def sensor_message_receiver_handler():
+    # Drain every frame the radio has queued, up to MAX_FRAMES_PER_PASS, and
+    # hand them to the Pi in one write.
+    lines = []
+    while len(lines) < MAX_FRAMES_PER_PASS:
+        received_msg = xbee.receive()
+        if not received_msg:
+            break
         # Create HEX string representation of byte array
-        sender_mac_addr = "".join(
-            "{:02x}".format(x) for x in received_msg["sender_eui64"]
-        )
-        payload = received_msg["payload"].decode()
-        # Serially printout received message
-        stdout.buffer.write("{},{}\r\n".format(sender_mac_addr, payload))
+        sender_mac_addr = binascii.hexlify(received_msg["sender_eui64"])
+        payload = received_msg["payload"]
+        if payload and payload[0] < 0x20:
+            # A binary telemetry frame; its version byte is never printable
+            payload = binascii.hexlify(payload)
+        lines.append(frame_line(sender_mac_addr + b"," + payload))
+
+    if lines:
+        # Serially printout received messages
+        stdout.buffer.write(b"".join(lines))
+    return len(lines)
+
+
+def run_pass():
+    # Returns True if there was anything to do
+    commands = command_message_receiver_handler()
+    frames = sensor_message_receiver_handler()
+    return commands or frames > 0
+
 
+def main():
+    while True:
+        if not run_pass():
+            time.sleep(IDLE_SLEEP_SECONDS)
 
-while True:
-    command_message_receiver_handler()
-    sensor_message_receiver_handler()
 
-    time.sleep(0.1)
+if __name__ == "__main__":
+    main()
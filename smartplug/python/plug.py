@@ -7,6 +7,14 @@ OFF_STATE = 1
 
 STATE = ON_STATE
 
+# Send readings as binary telemetry frames rather than "state,power,vrms"
+# text, which the hub also still accepts.
+BINARY_TELEMETRY = True
+TELEMETRY_FRAME_VERSION = 1
+
+# 0 marks the first frame after starting, then 1 to 65535 and back to 1
+telemetry_sequence = 0
+
 coordinator_mac_addr64 = None
 
 red_pin = Pin("D2", mode=Pin.OUT, value=0)
@@ -130,6 +138,23 @@ def get_sensor_payload():
     return '{},{}'.format(read_power_avg(),read_vrms_irms_avg())
 
 
+def get_telemetry_frame(state):
+    # version, state, sequence, power in centiwatts, voltage in centivolts;
+    # little-endian, 10 bytes. Decoded by the hub's xbee_message_parser.
+    global telemetry_sequence
+    centiwatts = min(max(int(read_power_avg() * 100 + 0.5), 0), 0xFFFFFFFF)
+    centivolts = min(max(int(read_vrms_irms_avg() * 100 + 0.5), 0), 0xFFFF)
+    frame = (
+        bytes([TELEMETRY_FRAME_VERSION, state])
+        + telemetry_sequence.to_bytes(2, "little")
+        + centiwatts.to_bytes(4, "little")
+        + centivolts.to_bytes(2, "little")
+    )
+    # Counted even if the transmit fails, so the hub sees the gap
+    telemetry_sequence = telemetry_sequence % 65535 + 1
+    return frame
+
+
 def transmit_sensor_payload(state, coordinator_mac_addr64, time_tracker):
     if (
         time_tracker.is_transmit_sensor_payload_timer_expired()
@@ -137,12 +162,13 @@ def transmit_sensor_payload(state, coordinator_mac_addr64, time_tracker):
     ):
         time_tracker.set_transmit_sensor_payload_timer()
         sensor_payload = None
-        sensor_payload = get_sensor_payload()
+        if BINARY_TELEMETRY:
+            sensor_payload = get_telemetry_frame(state)
+        else:
+            sensor_payload = "{},{}".format(state, get_sensor_payload())
         if sensor_payload:
             try:
-                xbee.transmit(
-                    coordinator_mac_addr64, "{},{}".format(state, sensor_payload)
-                )
+                xbee.transmit(coordinator_mac_addr64, sensor_payload)
             except Exception as e:
                 print("Transmission failure: {}".format(str(e)))
 